@@ -47,6 +47,11 @@
 # 0.0.8  20150512 add removal of test_spec.json and muts_all.json if present to
 #                 clean operation 
 # 0.0.9  20150609 integrating with mbed_usb.py
+# 0.0.10 20150703 --matrix to build and test target:toolchain cells in parallel
+# 0.0.11 20150706 --build-cache to reuse builds of unchanged commits
+# 0.0.12 20150708 --incremental to only rebuild targets whose sources have changed
+# 0.0.13 20150710 --ccache to compile GCC_ARM and ARM builds through ccache
+# 0.0.14 20150713 find the --target-id device with mbed_lstools rather than parsing mbedls output
 #                  
 # todo: check for failures in junit xml as well as errors.
 #
@@ -66,7 +71,14 @@ import xunitparser
 import os               # getenv()
 import shutil           # for rmtree()
 import re
-import mbed_usb
+import copy
+import json
+import threading
+import multiprocessing  # cpu_count()
+import hashlib
+import tarfile
+import errno
+import distutils.spawn  # find_executable()
 
 
 # error codes are positive numbers because sys.exit() returns a +ve number to the env
@@ -102,6 +114,27 @@ GCC_CR_PATH = "C:/mbed_tools/nxp/LPCXpresso_7.1.1_125/lpcxpresso/tools/bin"
 #IAR_PATH = "C:/Program Files (x86)/IAR Systems/Embedded Workbench 7.0/arm"
 IAR_PATH = "C:/mbed_tools/IAR Systems/Embedded Workbench 7.0/arm"
 
+# labels of the TOOLCHAIN_<label> source directories built by each toolchain
+TOOLCHAIN_LABELS = {"ARM" : ["ARM", "ARM_STD"],
+                    "uARM" : ["uARM", "ARM", "ARM_MICRO"],
+                    "GCC_ARM" : ["GCC_ARM", "GCC"],
+                    "GCC_CS" : ["GCC_CS", "GCC"],
+                    "GCC_CR" : ["GCC_CR", "GCC"],
+                    "IAR" : ["IAR"]}
+
+# compiler cache shared by the jobs, see ccache_setup20()
+CCACHE_EXE = "ccache"
+CCACHE_DIR_PATH = "c:/mbed_tools/ccache"
+CCACHE_SIZE_MB = 5120
+# toolchain -> (private_settings.py variable of the directory of the compilers, compilers run through ccache)
+CCACHE_TOOLCHAINS = {"GCC_ARM" : ("GCC_ARM_PATH", ["arm-none-eabi-gcc", "arm-none-eabi-g++"]),
+                     "ARM" : ("ARM_BIN", ["armcc"]),
+                     "uARM" : ("ARM_BIN", ["armcc"])}
+
+# build results cache shared by the jobs, see mbed_jenkins_build_cache
+BUILD_CACHE_PATH = "c:/mbed_tools/build_cache"
+BUILD_CACHE_SIZE_MB = 4096
+
 WRKSPC_TOOLS_DIR="workspace_tools"
 TEST_SPC_JSN_PATHNAME = WRKSPC_TOOLS_DIR + "/test_spec.json"
 MUTS_ALL_JSN_PATHNAME = WRKSPC_TOOLS_DIR + "/muts_all.json"
@@ -130,15 +163,26 @@ def dbg(str):
 # get the com port: mbedls | grep 075002000750051938359374 | awk '{print $3}' | sed 's/^.//'
 # get the mds: mbedls | grep 075002000750051938359374 | awk '{print $2}' | sed 's/^.//'
 
-# exception for breaking out of loops
-class BreakInnerLoop(Exception): pass
-
 ##############################################################################
 # jenkins
 ##############################################################################
 class mbed_jenkins:
     """A class to manage jenkins builds/test"""
     TARGET_ID_DEF = '000000000000000000000000'
+    # mbed_usb_daemon.MbedHubController, see get_hub_controller()
+    hub_controller = None
+    # mbed_jenkins_build_cache, see get_build_cache()
+    build_cache = None
+    build_cache_lock = threading.Lock()
+    # held while walking, restoring into or removing from the build directory,
+    # which the parallel matrix builds share, see build20()
+    build_dir_lock = threading.Lock()
+    # mbed_jenkins_workspace, see get_workspace()
+    workspace = None
+    # pathname of the ccache executable when the builds are run through it, see ccache_setup20()
+    ccache_exe = None
+    # mbed_jenkins_device_inventory, see get_device_inventory()
+    device_inventory = None
 
     #def __init__(self):
 
@@ -148,11 +192,14 @@ class mbed_jenkins:
         print str
         return
 
-    def doBashCmd(self, strBashCommand):
+    def doBashCmd(self, strBashCommand, stdout=None):
+        # stdout is an optional file the output (and errors) of the command are written to
+        if stdout is not None:
+            return subprocess.call(strBashCommand.split(), shell=True, stdout=stdout, stderr=subprocess.STDOUT)
         ret = subprocess.call(strBashCommand.split(), shell=True)
         return ret
 
-    def build20(self, toolchain, target):
+    def build20(self, toolchain, target, stdout=None):
         # do the build:
         # python.exe build.py -t GCC_ARM -m LPC1768
 
@@ -160,13 +207,100 @@ class mbed_jenkins:
         ret = MBED_SUCCESS 
         if args.build is True:
             if args.jenkins is True: 
-                bashCommand = "python ./workspace_tools/" + "build.py -t " + toolchain + " -m " + target
+                repo_dir = "./"
             else:
                 # cmdline
-                bashCommand = "python " + args.project + "/workspace_tools/" + "build.py -t " + toolchain + " -m " + target
-            ret = self.doBashCmd(bashCommand)
+                repo_dir = args.project + "/"
+
+            # with --incremental only build the target and toolchain if its sources or settings have changed
+            workspace = self.get_workspace(args)
+            build_cache = self.get_build_cache(args)
+            if workspace is not None or build_cache is not None:
+                # both identify the build by the toolchain settings and version,
+                # worked out once as getting the version runs the compiler
+                private_settings = self.private_settings20(toolchain)
+                toolchain_version = self.toolchain_version20(toolchain)
+
+            fingerprint = None
+            if workspace is not None:
+                fingerprint = workspace.fingerprint(target, toolchain, private_settings, toolchain_version)
+                with self.build_dir_lock:
+                    if workspace.is_up_to_date(target, toolchain, fingerprint) is True:
+                        dbg(sys._getframe().f_code.co_name + ": " + target + ":" + toolchain + " build is up to date")
+                        return MBED_SUCCESS
+                    workspace.invalidate(target, toolchain)
+
+            # restore the libraries from a previous build of the same sources if possible
+            key = None
+            if build_cache is not None:
+                key = build_cache.key(repo_dir, toolchain, toolchain_version, target, private_settings)
+                if key is not None:
+                    with self.build_dir_lock:
+                        restored = build_cache.restore(key, repo_dir + "build")
+                    if restored is True:
+                        dbg(sys._getframe().f_code.co_name + ": restored " + target + ":" + toolchain + " build from cache " + key)
+                        if fingerprint is not None:
+                            workspace.record(target, toolchain, fingerprint)
+                        return MBED_SUCCESS
+
+            ccache_stats = None
+            if self.ccache_exe is not None and toolchain in CCACHE_TOOLCHAINS:
+                ccache_stats = self.ccache_stats20()
+
+            bashCommand = "python " + repo_dir + "workspace_tools/" + "build.py -t " + toolchain + " -m " + target
+            ret = self.doBashCmd(bashCommand, stdout)
+
+            if ccache_stats is not None:
+                self.ccache_report20(target + ":" + toolchain, ccache_stats, self.ccache_stats20())
+            if ret == MBED_SUCCESS and key is not None:
+                with self.build_dir_lock:
+                    build_cache.store(key, repo_dir + "build", toolchain, target)
+            if ret == MBED_SUCCESS and fingerprint is not None:
+                workspace.record(target, toolchain, fingerprint)
         return ret    
 
+    def get_build_cache(self, args):
+        """ return the build cache, or None if --build-cache isnt specified
+        """
+        if args.build_cache is not True:
+            return None
+        with self.build_cache_lock:
+            if self.build_cache is None:
+                mbed_jenkins.build_cache = mbed_jenkins_build_cache(args.build_cache_dir, args.build_cache_size * 1024 * 1024)
+        return self.build_cache
+
+    def get_workspace(self, args):
+        """ return the incremental workspace, or None if --incremental isnt specified
+        """
+        if args.incremental is not True:
+            return None
+        with self.build_cache_lock:
+            if self.workspace is None:
+                if args.jenkins is True: 
+                    repo_dir = "./"
+                else:
+                    # cmdline
+                    repo_dir = args.project + "/"
+                mbed_jenkins.workspace = mbed_jenkins_workspace(repo_dir)
+        return self.workspace
+
+    def toolchain_version20(self, toolchain):
+        """
+        return the version reported by the toolchain compiler, or "" if it couldnt be run
+        """
+        if toolchain == "GCC_ARM":
+            cmd = [GCC_ARM_PATH + "/arm-none-eabi-gcc", "--version"]
+        elif toolchain in ["ARM", "uARM"]:
+            cmd = [ARM_PATH + "/bin/armcc", "--vsn"]
+        else:
+            return ""
+        try:
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = process.communicate()[0]
+        except OSError:
+            return ""
+        return output.strip()
+
     def clone20(self):
         dbg(sys._getframe().f_code.co_name + ":entered.")
         ret = MBED_SUCCESS 
@@ -180,87 +314,197 @@ class mbed_jenkins:
             ret = self.doBashCmd(bashCommand)
         return ret    
 
-    def make_private_settings20(self, args):
+    def private_settings20(self, toolchain):
+        """
+        return the list of lines needed in workspace_tools/private_settings.py to build with toolchain
+        """
+        if toolchain == "GCC_ARM": 
+            return ["GCC_ARM_PATH = \"" + GCC_ARM_PATH + "\""]
+
+        if toolchain in ["ARM", "uARM", "uARM2"]:
+            arm_path = ARM_PATH
+            if toolchain == "uARM2": 
+                arm_path = ARM_PATH_2
+            lines = ["from os.path import join",
+                     "ARM_PATH = \"" + arm_path + "\"",
+                     "ARM_BIN = join(ARM_PATH, \"bin\")",
+                     "ARM_INC = join(ARM_PATH, \"include\")",
+                     "ARM_LIB = join(ARM_PATH, \"lib\")"]
+            if toolchain == "ARM": 
+                lines.append("ARM_CPPLIB = join(ARM_LIB, \"cpplib\")")
+            else:
+                lines.append("ARM_CLIB = join(ARM_PATH, \"lib\", \"microlib\")")
+            return lines
+
+        return []
+
+    def private_settings20_release(self):
+        """
+        return the list of lines of the workspace_tools/private_settings.py written for
+        build_release.py, which builds with all the toolchains
+        """
+        return ["from os.path import join",
+                "",
+                "ARM_PATH = \"" + ARM_PATH + "\"",
+                "ARM_BIN = join(ARM_PATH, \"bin\")",
+                "ARM_INC = join(ARM_PATH, \"include\")",
+                "ARM_LIB = join(ARM_PATH, \"lib\")",
+                "ARM_CPPLIB = join(ARM_LIB, \"cpplib\")",
+                "",
+                "GCC_ARM_PATH = \"" + GCC_ARM_PATH + "\"",
+                "",
+                "GCC_CS_PATH = \"" + GCC_CS_PATH + "\"",
+                "",
+                "GCC_CR_PATH = \"" + GCC_CR_PATH + "\"",
+                "",
+                "IAR_PATH = \"" + IAR_PATH + "\"",
+                ""]
+
+    def private_settings20_conflict(self, toolchains):
+        """
+        return True if the private settings of the toolchains cant be in one private_settings.py
+        file because they set the same variable to different values e.g. ARM and uARM2
+        """
+        values = {}
+        for toolchain in toolchains:
+            for line in self.private_settings20(toolchain):
+                if " = " in line:
+                    (name, value) = line.split(" = ", 1)
+                    if values.setdefault(name, value) != value:
+                        return True
+        return False
+
+    def make_private_settings20(self, args, toolchains=None):
+        """
+        write workspace_tools/private_settings.py for building with args.toolchain, or
+        with each of toolchains (see private_settings20_conflict())
+        """
         dbg(sys._getframe().f_code.co_name + ":entered.") 
+        if toolchains is None:
+            toolchains = [args.toolchain]
+
+        lines = []
+        for toolchain in toolchains:
+            for line in self.private_settings20(toolchain):
+                if line not in lines:
+                    lines.append(line)
+        if len(lines) == 0:
+            # nothing needed for the toolchain(s) e.g. IAR
+            return MBED_SUCCESS
+
         if args.jenkins is True: 
-            if args.toolchain == "GCC_ARM": 
-                with open("./workspace_tools/private_settings.py", "w+") as text_file:
-                    text_file.write("GCC_ARM_PATH = \"" + GCC_ARM_PATH + "\"")
-                    
-            if args.toolchain == "ARM": 
-                with open("./workspace_tools/private_settings.py", "w+") as text_file:
-                    text_file.write("from os.path import join\n")
-                    text_file.write("\n")
-                    text_file.write("ARM_PATH = \"" + ARM_PATH + "\"\n")
-                    text_file.write("ARM_BIN = join(ARM_PATH, \"bin\")\n")
-                    text_file.write("ARM_INC = join(ARM_PATH, \"include\")\n")
-                    text_file.write("ARM_LIB = join(ARM_PATH, \"lib\")\n")
-                    text_file.write("ARM_CPPLIB = join(ARM_LIB, \"cpplib\")\n")
-                    text_file.write("\n")
-                    
-            if args.toolchain == "uARM": 
-                with open("./workspace_tools/private_settings.py", "w+") as text_file:
-                    text_file.write("from os.path import join\n")
-                    text_file.write("\n")
-                    text_file.write("ARM_PATH = \"" + ARM_PATH + "\"\n")
-                    text_file.write("ARM_BIN = join(ARM_PATH, \"bin\")\n")
-                    text_file.write("ARM_INC = join(ARM_PATH, \"include\")\n")
-                    text_file.write("ARM_LIB = join(ARM_PATH, \"lib\")\n")
-                    text_file.write("ARM_CLIB = join(ARM_PATH, \"lib\", \"microlib\")\n")
-                    text_file.write("\n")
-                   
-            if args.toolchain == "uARM2": 
-                with open("./workspace_tools/private_settings.py", "w+") as text_file:
-                    text_file.write("from os.path import join\n")
-                    text_file.write("\n")
-                    text_file.write("ARM_PATH = \"" + ARM_PATH_2 + "\"\n")
-                    text_file.write("ARM_BIN = join(ARM_PATH, \"bin\")\n")
-                    text_file.write("ARM_INC = join(ARM_PATH, \"include\")\n")
-                    text_file.write("ARM_LIB = join(ARM_PATH, \"lib\")\n")
-                    text_file.write("ARM_CLIB = join(ARM_PATH, \"lib\", \"microlib\")\n")
-                    text_file.write("\n")
-                   
+            repo_dir = "./"
         else:
             # cmdline
-            if args.toolchain == "GCC_ARM": 
-                with open(args.project + "/workspace_tools/private_settings.py", "w+") as text_file:
-                    text_file.write("GCC_ARM_PATH = \"" + GCC_ARM_PATH + "\"")
-
-            if args.toolchain == "ARM": 
-                with open(args.project + "./workspace_tools/private_settings.py", "w+") as text_file:
-                    text_file.write("from os.path import join\n")
-                    text_file.write("\n")
-                    text_file.write("ARM_PATH = \"" + ARM_PATH + "\"\n")
-                    text_file.write("ARM_BIN = join(ARM_PATH, \"bin\")\n")
-                    text_file.write("ARM_INC = join(ARM_PATH, \"include\")\n")
-                    text_file.write("ARM_LIB = join(ARM_PATH, \"lib\")\n")
-                    text_file.write("ARM_CPPLIB = join(ARM_LIB, \"cpplib\")\n")
-                    text_file.write("\n")
-
-            if args.toolchain == "uARM": 
-                with open(args.project + "./workspace_tools/private_settings.py", "w+") as text_file:
-                    text_file.write("from os.path import join\n")
-                    text_file.write("\n")
-                    text_file.write("ARM_PATH = \"" + ARM_PATH + "\"\n")
-                    text_file.write("ARM_BIN = join(ARM_PATH, \"bin\")\n")
-                    text_file.write("ARM_INC = join(ARM_PATH, \"include\")\n")
-                    text_file.write("ARM_LIB = join(ARM_PATH, \"lib\")\n")
-                    text_file.write("ARM_CLIB = join(ARM_PATH, \"lib\", \"microlib\")\n")
-                    text_file.write("\n")
-
-            if args.toolchain == "uARM2": 
-                with open(args.project + "./workspace_tools/private_settings.py", "w+") as text_file:
-                    text_file.write("from os.path import join\n")
-                    text_file.write("\n")
-                    text_file.write("ARM_PATH = \"" + ARM_PATH_2 + "\"\n")
-                    text_file.write("ARM_BIN = join(ARM_PATH, \"bin\")\n")
-                    text_file.write("ARM_INC = join(ARM_PATH, \"include\")\n")
-                    text_file.write("ARM_LIB = join(ARM_PATH, \"lib\")\n")
-                    text_file.write("ARM_CLIB = join(ARM_PATH, \"lib\", \"microlib\")\n")
-                    text_file.write("\n")
+            repo_dir = args.project + "/"
+        filepath = repo_dir + "workspace_tools/private_settings.py"
+
+        if args.ccache is True:
+            # these follow (so override) the toolchain paths
+            lines += self.ccache_setup20(args, repo_dir, toolchains)
+
+        with open(filepath, "w+") as text_file:
+            text_file.write("\n".join(lines) + "\n")
 
         return MBED_SUCCESS       
 
+    def ccache_setup20(self, args, repo_dir, toolchains):
+        """
+        put ccache in front of the compilers of the toolchains (see CCACHE_TOOLCHAINS).
+        
+        For each toolchain <repo_dir>/ccache_bin/<toolchain> is made with ccache
+        masquerading as the compilers, and links to (or on windows copies of)
+        the other tools of the toolchain. ccache runs the real compilers, found
+        by adding their directories to the PATH. The cache is in args.ccache_dir,
+        which can be shared by the jobs, and is limited to args.ccache_size MB.
+        
+        returns the list of private_settings.py lines pointing the toolchains at the
+        ccache_bin directories, or [] if ccache couldnt be found
+        """
+        dbg(sys._getframe().f_code.co_name + ":entered.") 
+        ccache_exe = distutils.spawn.find_executable(args.ccache_exe)
+        if ccache_exe is None:
+            dbg(sys._getframe().f_code.co_name + ": " + args.ccache_exe + " not found, building without ccache.") 
+            return []
+
+        os.environ["CCACHE_DIR"] = args.ccache_dir
+        # paths under the workspace are hashed relative to it, so jobs in different workspaces share the cache
+        os.environ["CCACHE_BASEDIR"] = os.path.abspath(repo_dir)
+        try:
+            subprocess.check_output([ccache_exe, "--max-size=%dM" % args.ccache_size], stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError) as e:
+            dbg(sys._getframe().f_code.co_name + ": failed to run " + ccache_exe + " (" + str(e) + "), building without ccache.") 
+            return []
+
+        tool_dirs = {"GCC_ARM_PATH" : GCC_ARM_PATH, "ARM_BIN" : ARM_PATH + "/bin"}
+        lines = []
+        for toolchain in toolchains:
+            if toolchain not in CCACHE_TOOLCHAINS:
+                continue
+            (name, compilers) = CCACHE_TOOLCHAINS[toolchain]
+            if name + " = " in "".join(lines):
+                # e.g. ARM and uARM
+                continue
+            tool_dir = tool_dirs[name]
+            if not os.path.isdir(tool_dir):
+                dbg(sys._getframe().f_code.co_name + ": " + tool_dir + " not found, building " + toolchain + " without ccache.") 
+                continue
+
+            ccache_bin = os.path.abspath(repo_dir + "ccache_bin/" + toolchain)
+            if os.path.exists(ccache_bin):
+                shutil.rmtree(ccache_bin)
+            os.makedirs(ccache_bin)
+            for tool in os.listdir(tool_dir):
+                if os.path.splitext(tool)[0] in compilers:
+                    src = ccache_exe
+                else:
+                    src = os.path.join(tool_dir, tool)
+                if hasattr(os, "symlink"):
+                    os.symlink(src, os.path.join(ccache_bin, tool))
+                elif os.path.isfile(src):
+                    shutil.copy2(src, os.path.join(ccache_bin, tool))
+
+            if tool_dir not in os.environ["PATH"].split(os.pathsep):
+                os.environ["PATH"] = tool_dir + os.pathsep + os.environ["PATH"]
+            lines.append(name + " = \"" + ccache_bin.replace("\\", "/") + "\"")
+
+        mbed_jenkins.ccache_exe = ccache_exe
+        return lines
+
+    def ccache_stats20(self):
+        """
+        return the dictionary of ccache statistics e.g. {'cache hit (direct)' : 3, 'cache miss' : 2, 'cache size' : '1.2 GB'}
+        """
+        stats = {}
+        try:
+            output = subprocess.check_output([self.ccache_exe, "-s"], stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            return stats
+        for line in output.splitlines():
+            match = re.match(r"^(\S.*?)\s{2,}(\S.*?)\s*$", line)
+            if match is None:
+                continue
+            value = match.group(2)
+            if value.isdigit():
+                value = int(value)
+            stats[match.group(1)] = value
+        return stats
+
+    def ccache_report20(self, name, before, after):
+        """
+        print the ccache hits and misses between the before and after statistics (see ccache_stats20()).
+        When jobs share the cache these include the compilations of the other jobs.
+        """
+        def count(stat):
+            return sum([after[key] - before.get(key, 0) for key in after if key.startswith(stat) and isinstance(after[key], int)])
+        hits = count("cache hit")
+        misses = count("cache miss")
+        rate = 0
+        if hits + misses > 0:
+            rate = 100 * hits / (hits + misses)
+        dbg("ccache " + name + ": %d hits, %d misses (%d%% hit rate), cache size %s of %s" % (hits, misses, rate,
+            after.get("cache size", "?"), after.get("max cache size", "?")))
+
     def print_test_header(self):
         """ 
         function to print useful test related information e.g.
@@ -275,6 +519,8 @@ class mbed_jenkins:
         Clean the build directory from project directory. Note the singletest.py --clean doesnt work at present
         
         args.project        used for the top level subdirectory
+        args.incremental    keep the build directory, the builds whose sources have changed
+                            are removed when they are built (see mbed_jenkins_workspace)
         """
         ret1 = MBED_FAILURE
         ret2 = MBED_FAILURE
@@ -289,7 +535,7 @@ class mbed_jenkins:
                 filepath = args.project + "/"
         
             filepath += "build"
-            if os.path.exists(filepath):
+            if os.path.exists(filepath) and args.incremental is not True:
                 shutil.rmtree(filepath)
                 
             ret1 = self.mbed20_test_spec_json_del(args)
@@ -311,72 +557,23 @@ class mbed_jenkins:
         self.dbg(sys._getframe().f_code.co_name + ":entered.") 
         
         ret = MBED_FAILURE
-        filepath = ""
-        if args.jenkins is True:
-            filepath = "./workspace_tools/"
-        else:
-            filepath = args.project + "/workspace_tools/"
-    
-        # todo: remove print args.target_id
-
-        print "args.comport=" + args.comport
-        print "args.disk=" + args.disk
-
         if args.target_id != self.TARGET_ID_DEF:
-            name = ""
-            comport = ""
-            disk = ""
-            target_id = 0
-            
             # now make json files:
             ret = self.mbed20_test_spec_json_add(args)
             if ret != MBED_SUCCESS:
                 dbg(sys._getframe().f_code.co_name + ": failed to create test_spec.json.") 
                 return ret
 
-            # use regex to find platform identified with target_is in mbedls output, and parse for comport and disk 
-            mbedls_cmd = "mbedls > " + filepath + "mbedls_output.txt"
-            ret = self.doBashCmd(mbedls_cmd)
-            if ret != MBED_SUCCESS:
-                dbg(sys._getframe().f_code.co_name + ": failed to get mbedls output.") 
-                return ret
-
-            # find the target id in the mbedls output
-            # note: this isnt working as I expected. todo: investigate
-            pattern = re.compile(str(args.target_id))
-            
-            # search the mbedls output to find the line with the target_id, so the comport and disk can
-            # be extracted
-            try:
-                for i, line in enumerate(open(filepath + "mbedls_output.txt")):
-    
-                    for match in re.finditer(pattern, line):
-                        print 'Found on line %s: %s' % (i+1, match.groups())
-                        print line
-                        # s= "| 'TOMATOES_PICKED'                                  |       914 |       1397 |"
-                        # |unknown              |G:                 |COM18              |075002000750051938359374                |                        
-                        pattern = re.compile(r"""\|\s*                 # opening bar and whitespace
-                                                 (?P<name>.*?)       # name
-                                                 \s*\|\s*(?P<disk>.*?)   # whitespace, next bar, n1
-                                                 \s*\|\s*(?P<comport>.*?)      # whitespace, next bar, n2
-                                                 \s*\|\s*(?P<target_id>.*?)      # whitespace, next bar, n2
-                                                 \s*\|""", re.VERBOSE)
-                        match = pattern.match(line)
-                    
-                        name = match.group("name")
-                        comport = match.group("comport")
-                        disk = match.group("disk")
-                        target_id = match.group("target_id")
-                        
-                        if args.target_id == target_id:
-                            # found the target_id 
-                            raise BreakInnerLoop
-    
-                        dbg(sys._getframe().f_code.co_name + ": comport=" + comport) 
-                        dbg(sys._getframe().f_code.co_name + ": disk=" + disk) 
+            # find the comport and disk of the platform identified with target_id
+            device = self.get_device_inventory().find(target_id=args.target_id)
+            if device is None:
+                dbg(sys._getframe().f_code.co_name + ": failed to find target_id " + args.target_id + " in the mbedls devices.") 
+                return MBED_FAILURE
 
-            except BreakInnerLoop:
-                pass
+            comport = device.get('serial_port') or ""
+            disk = device.get('mount_point') or ""
+            dbg(sys._getframe().f_code.co_name + ": comport=" + comport) 
+            dbg(sys._getframe().f_code.co_name + ": disk=" + disk) 
            
             if comport == "":
                 dbg(sys._getframe().f_code.co_name + ": failed to find valid values for comport.") 
@@ -433,7 +630,6 @@ class mbed_jenkins:
         filepath = ""
         comport = ""
         disk = ""
-        cmd = "python "
         if args.test is True:
         
             if args.jenkins is True:
@@ -442,13 +638,8 @@ class mbed_jenkins:
                 # cmdline
                 filepath = args.project + "/workspace_tools/"
                 
-            cmd += filepath + "singletest.py "
-            #cmd += "-f " + args.target + " --tc=" + args.toolchain + " -j 8 -v --report-junit " + args.target + "_junit_report.xml" + " --report-html " + args.target + "_html_report.html -c cp "
-            # windows prefers copy
-            cmd += "-f " + args.target + " --tc=" + args.toolchain + " -j 8 -v --report-junit " + args.target + "_junit_report.xml" + " --report-html " + args.target + "_html_report.html -c copy --global-loops 5 -W "
-            
             if args.target_id != self.TARGET_ID_DEF:
-                cmd += "-i " + filepath + "test_spec.json -M  " + filepath + "muts_all.json "
+                cmd = self.singletest_cmd(args, args.target, filepath + "test_spec.json", filepath + "muts_all.json")
                 
                 # now make json files:
                 ret = self.mbed20_generate_json_test_spec_files(args)
@@ -456,7 +647,7 @@ class mbed_jenkins:
                     dbg(sys._getframe().f_code.co_name + ": failed to create test_spec.json and muts_all.json files.") 
                     return ret
             elif args.comport != "" and args.disk != "":
-                cmd += "-i " + filepath + "test_spec.json -M  " + filepath + "muts_all.json "
+                cmd = self.singletest_cmd(args, args.target, filepath + "test_spec.json", filepath + "muts_all.json")
                 
                 # now make json files:
                 ret = self.mbed20_generate_json_test_spec_files(args)
@@ -465,7 +656,7 @@ class mbed_jenkins:
                     return ret
             
             else:
-                cmd += "--auto "
+                cmd = self.singletest_cmd(args, args.target)
             
 
             dbg(sys._getframe().f_code.co_name + ": running:" + cmd) 
@@ -473,6 +664,33 @@ class mbed_jenkins:
 
         return ret    
 
+    def singletest_cmd(self, args, report_name, test_spec_pathname="", muts_all_pathname=""):
+        """
+        return the command line running singletest.py for args.target and args.toolchain
+        
+        report_name         the junit and html reports are written to <report_name>_junit_report.xml
+                            and <report_name>_html_report.html
+        test_spec_pathname  test_spec.json and muts_all.json files describing the target to test,
+        muts_all_pathname   if not specified the target is found with --auto
+        """
+        if args.jenkins is True:
+            filepath = "./workspace_tools/"
+        else:
+            # cmdline
+            filepath = args.project + "/workspace_tools/"
+
+        cmd = "python " + filepath + "singletest.py "
+        #cmd += "-f " + args.target + " --tc=" + args.toolchain + " -j 8 -v --report-junit " + args.target + "_junit_report.xml" + " --report-html " + args.target + "_html_report.html -c cp "
+        # windows prefers copy
+        cmd += "-f " + args.target + " --tc=" + args.toolchain + " -j 8 -v --report-junit " + report_name + "_junit_report.xml" + " --report-html " + report_name + "_html_report.html -c copy --global-loops 5 -W "
+
+        if test_spec_pathname != "":
+            cmd += "-i " + test_spec_pathname + " -M  " + muts_all_pathname + " "
+        else:
+            cmd += "--auto "
+
+        return cmd
+
     def singletest_working_version(self, toolchain, target):
         """
         Supported target list is stated in workspace_tools/targets.py and as of 20150410 the list is as follows:
@@ -522,38 +740,13 @@ class mbed_jenkins:
                     dbg(sys._getframe().f_code.co_name + ": failed to create test_spec.json.") 
                     return ret
 
-                # doesnt work: python rc
-                mbedls_cmd = "mbedls > " + filepath + "mbedls_output.txt"
-                dbg(sys._getframe().f_code.co_name + ": mbedls_cmd=" + mbedls_cmd) 
-                #print comport_cmd
-
-                ret = self.doBashCmd(mbedls_cmd)
-                if ret != MBED_SUCCESS:
-                    dbg(sys._getframe().f_code.co_name + ": failed to get mbedls output.") 
-                    return ret
+                device = self.get_device_inventory().find(target_id=args.target_id)
+                if device is not None:
+                    comport = device.get('serial_port') or ""
+                    disk = device.get('mount_point') or ""
 
-                pattern = re.compile(args.target_id)
-                
-                for i, line in enumerate(open(filepath + "mbedls_output.txt")):
-
-                    for match in re.finditer(pattern, line):
-                        print 'Found on line %s: %s' % (i+1, match.groups())
-                        print line
-                        # s= "| 'TOMATOES_PICKED'                                  |       914 |       1397 |"
-                        # |unknown              |G:                 |COM18              |075002000750051938359374                |                        
-                        pattern = re.compile(r"""\|\s*                 # opening bar and whitespace
-                                                 (?P<name>.*?)       # name
-                                                 \s*\|\s*(?P<disk>.*?)   # whitespace, next bar, n1
-                                                 \s*\|\s*(?P<comport>.*?)      # whitespace, next bar, n2
-                                                 \s*\|\s*(?P<target_id>.*?)      # whitespace, next bar, n2
-                                                 \s*\|""", re.VERBOSE)
-                        match = pattern.match(line)
-                    
-                        comport = match.group("comport")
-                        disk = match.group("disk")
-
-                        dbg(sys._getframe().f_code.co_name + ": comport=" + comport) 
-                        dbg(sys._getframe().f_code.co_name + ": disk=" + disk) 
+                    dbg(sys._getframe().f_code.co_name + ": comport=" + comport) 
+                    dbg(sys._getframe().f_code.co_name + ": disk=" + disk) 
                 
                 ret = self.mbed20_muts_all_json_add(args, comport, disk)
                 if ret != MBED_SUCCESS:
@@ -589,6 +782,10 @@ class mbed_jenkins:
             ret = self.mbed20_build_release(args)
             return ret 
 
+        if len(args.matrix) > 0:
+            ret = self.mbed20_matrix(args)
+            return ret 
+
         if args.clean is True:
             ret = self.mbed20_clean(args)
             if ret != MBED_SUCCESS:
@@ -713,8 +910,23 @@ class mbed_jenkins:
                 dbg(sys._getframe().f_code.co_name + ": failed to clone repository.") 
                 return ret;
 
+        # every build made by build_release.py uses the whole private_settings.py,
+        # so its lines are part of the fingerprint of each build
+        private_settings = self.private_settings20_release()
+        toolchain_versions = {}
+        def fingerprint(target, toolchain):
+            if toolchain not in toolchain_versions:
+                toolchain_versions[toolchain] = self.toolchain_version20(toolchain)
+            return workspace.fingerprint(target, toolchain, private_settings, toolchain_versions[toolchain])
+
         # clean if flag set by removing the build dir in workspace as clean.py doesnt work
-        if args.clean is True:
+        workspace = self.get_workspace(args)
+        if args.clean is True and workspace is not None:
+            # only remove the builds whose sources or settings have changed
+            for (target, toolchain) in workspace.build_cells():
+                if workspace.is_up_to_date(target, toolchain, fingerprint(target, toolchain)) is not True:
+                    workspace.invalidate(target, toolchain)
+        elif args.clean is True:
             if os.path.exists("./build"):
                 shutil.rmtree('./build')
 
@@ -729,22 +941,8 @@ class mbed_jenkins:
         # todo: can 1 private_settings.py file be used for all files builds? no, uARM is not compatible.
         # the code to qrite private settings needs to be refactored into single function.
         with open(filepath, "w+") as text_file:
-            text_file.write("from os.path import join\n")
-            text_file.write("\n")
-            text_file.write("ARM_PATH = \"" + ARM_PATH + "\"\n")
-            text_file.write("ARM_BIN = join(ARM_PATH, \"bin\")\n")
-            text_file.write("ARM_INC = join(ARM_PATH, \"include\")\n")
-            text_file.write("ARM_LIB = join(ARM_PATH, \"lib\")\n")
-            text_file.write("ARM_CPPLIB = join(ARM_LIB, \"cpplib\")\n")
-            text_file.write("\n")
-            text_file.write("GCC_ARM_PATH = \"" + GCC_ARM_PATH + "\"\n")
-            text_file.write("\n")
-            text_file.write("GCC_CS_PATH = \"" + GCC_CS_PATH + "\"\n")
-            text_file.write("\n")
-            text_file.write("GCC_CR_PATH = \"" + GCC_CR_PATH + "\"\n")
-            text_file.write("\n")
-            text_file.write("IAR_PATH = \"" + IAR_PATH + "\"\n")
-            text_file.write("\n")
+            for line in private_settings:
+                text_file.write(line + "\n")
         
         if args.build_release is True:
             if args.jenkins is True: 
@@ -760,6 +958,9 @@ class mbed_jenkins:
             ret = self.doBashCmd(bashCommand)
             if ret != MBED_SUCCESS:
                 dbg(sys._getframe().f_code.co_name + ": failed to run build_release.py.") 
+            elif workspace is not None:
+                for (target, toolchain) in workspace.build_cells():
+                    workspace.record(target, toolchain, fingerprint(target, toolchain))
 
         # check if just a sync operation is being performed
         if args.sync is True:
@@ -769,7 +970,234 @@ class mbed_jenkins:
        
         return ret
 
-    def mbed20_muts_all_json_add(self, args, comport, disk):
+    def mbed20_matrix(self, args):
+        """
+        Build (and test) each of the target:toolchain cells in args.matrix e.g.
+            mbed_jenkins.py --jenkins --mbed20 --build --test --matrix K64F:GCC_ARM K64F:ARM LPC1768:GCC_ARM
+
+        The builds are run in parallel, args.matrix_jobs (default one per cpu)
+        at a time. The cells of a target share its build/ directories, so are
+        built one after another. As each build completes its tests are run on whichever board
+        of the target is free, so the tests of different targets (or of
+        targets with more than one board) also run in parallel. Cells whose
+        toolchains need conflicting private_settings.py files are run in
+        separate waves. The output of each cell is written to
+        matrix_<target>_<toolchain>_<build|test>.log, and the results are
+        printed at the end and written to matrix_report.json.
+        
+        args.matrix         list of target:toolchain strings
+        args.matrix_jobs    number of builds to run at once, 0 for one per cpu
+        """
+        dbg(sys._getframe().f_code.co_name + ":entered.")
+        ret = MBED_FAILURE
+
+        cells = []
+        for cell in args.matrix:
+            (target, sep, toolchain) = cell.partition(':')
+            if target == "" or toolchain == "":
+                dbg(sys._getframe().f_code.co_name + ": invalid matrix cell " + cell + ", expected target:toolchain.") 
+                return MBED_FAILURE
+            if (target, toolchain) not in cells:
+                cells.append((target, toolchain))
+
+        if args.clean is True:
+            ret = self.mbed20_clean(args)
+            if ret != MBED_SUCCESS:
+                dbg(sys._getframe().f_code.co_name + ": failed to clean local workspace.") 
+                return ret;
+
+        if args.clone is True:
+            ret = self.clone20()
+            if ret != MBED_SUCCESS:
+                dbg(sys._getframe().f_code.co_name + ": failed to clone repository.") 
+                return ret;
+
+        jobs = args.matrix_jobs
+        if jobs <= 0:
+            jobs = multiprocessing.cpu_count()
+
+        board_pool = None
+        if args.test is True:
+            board_pool = mbed_jenkins_board_pool(self.get_hub_controller(), "mbed_jenkins matrix %d" % os.getpid())
+
+        # (target, toolchain) -> result dictionary
+        results = {}
+        for wave in self.mbed20_matrix_waves(cells):
+            self.make_private_settings20(args, sorted(set([cell[1] for cell in wave])))
+            self.mbed20_matrix_run_wave(args, wave, jobs, board_pool, results)
+
+        return self.mbed20_matrix_report(cells, results)
+
+    def mbed20_matrix_waves(self, cells):
+        """
+        split the cells into waves which can each be built with one private_settings.py file
+        """
+        waves = []
+        for (target, toolchain) in cells:
+            for wave in waves:
+                if not self.private_settings20_conflict([t for (m, t) in wave] + [toolchain]):
+                    wave.append((target, toolchain))
+                    break
+            else:
+                waves.append([(target, toolchain)])
+        return waves
+
+    def mbed20_matrix_run_wave(self, args, wave, jobs, board_pool, results):
+        """
+        build the cells of a wave using jobs threads each running a build.py
+        process, starting the test of each cell as soon as its build succeeds.
+        a cell isnt started while another cell of its target is being built.
+        """
+        # cells waiting to be built, and the targets being built
+        pending = list(wave)
+        building = set()
+        condition = threading.Condition()
+        test_threads = []
+        test_threads_lock = threading.Lock()
+
+        def next_cell():
+            with condition:
+                while len(pending) > 0:
+                    for cell in pending:
+                        if cell[0] not in building:
+                            pending.remove(cell)
+                            building.add(cell[0])
+                            return cell
+                    condition.wait()
+            return None
+
+        def build_worker():
+            while True:
+                cell = next_cell()
+                if cell is None:
+                    return
+                try:
+                    result = self.mbed20_matrix_build_cell(args, cell)
+                except Exception as e:
+                    # an unexpected error mustnt stop the other cells or the report
+                    dbg(sys._getframe().f_code.co_name + ": failed to build " + cell[0] + ":" + cell[1] + " (" + str(e) + ")")
+                    result = self.mbed20_matrix_result(cell, MBED_FAILURE)
+                finally:
+                    with condition:
+                        building.discard(cell[0])
+                        condition.notify_all()
+                results[cell] = result
+                if args.test is True and result['build'] == MBED_SUCCESS:
+                    thread = threading.Thread(target=self.mbed20_matrix_test_cell, args=(args, cell, board_pool, result))
+                    thread.start()
+                    with test_threads_lock:
+                        test_threads.append(thread)
+
+        workers = [threading.Thread(target=build_worker) for i in range(0, min(jobs, len(wave)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        # all the test threads have been started once the builds are complete
+        for thread in test_threads:
+            thread.join()
+
+    def mbed20_matrix_result(self, cell, build=MBED_SUCCESS):
+        """
+        return the result dictionary of a target:toolchain cell which hasnt been tested
+        """
+        (target, toolchain) = cell
+        return {'target' : target, 'toolchain' : toolchain, 'build' : build, 'build_time' : 0.0,
+                'board' : '', 'test' : None, 'test_time' : 0.0}
+
+    def mbed20_matrix_build_cell(self, args, cell):
+        """
+        build a target:toolchain cell, returning its result dictionary
+        """
+        (target, toolchain) = cell
+        result = self.mbed20_matrix_result(cell)
+        if args.build is True:
+            dbg(sys._getframe().f_code.co_name + ": building " + target + ":" + toolchain) 
+            start = time.time()
+            with open("matrix_" + target + "_" + toolchain + "_build.log", "w") as log_file:
+                result['build'] = self.build20(toolchain, target, log_file)
+            result['build_time'] = time.time() - start
+        return result
+
+    def mbed20_matrix_test_cell(self, args, cell, board_pool, result):
+        """
+        test a built target:toolchain cell on a free board, recording the outcome in result
+        """
+        (target, toolchain) = cell
+        # failed unless the test runs to completion
+        result['test'] = MBED_FAILURE
+        if not board_pool.has_board(target):
+            dbg(sys._getframe().f_code.co_name + ": no board for " + target) 
+            return
+
+        board = board_pool.acquire(target)
+        board_name = board['platform_name_unique']
+        dbg(sys._getframe().f_code.co_name + ": testing " + target + ":" + toolchain + " on " + board_name) 
+        start = time.time()
+        cell_args = copy.copy(args)
+        cell_args.target = target
+        cell_args.toolchain = toolchain
+        try:
+            result['board'] = board_name
+            if args.target_pwr_restart is True:
+                self.target_pwr_restart(cell_args, board_name)
+
+            if args.jenkins is True:
+                filepath = "./workspace_tools/"
+            else:
+                # cmdline
+                filepath = args.project + "/workspace_tools/"
+            report_name = target + "_" + toolchain
+            test_spec_pathname = filepath + "test_spec_" + report_name + ".json"
+            muts_all_pathname = filepath + "muts_all_" + report_name + ".json"
+            self.mbed20_test_spec_json_add(cell_args, test_spec_pathname)
+            self.mbed20_muts_all_json_add(cell_args, board['serial_port'], board['mount_point'], muts_all_pathname)
+
+            cmd = self.singletest_cmd(cell_args, report_name, test_spec_pathname, muts_all_pathname)
+            with open("matrix_" + report_name + "_test.log", "w") as log_file:
+                ret = self.doBashCmd(cmd, log_file)
+
+            if ret == MBED_SUCCESS:
+                ts, tr = xunitparser.parse(open(report_name + "_junit_report.xml"))
+                if tr.errors:
+                    ret = MBED_FAILURE
+            result['test'] = ret
+        finally:
+            if args.target_pwr_restart is True:
+                self.target_pwr_off(cell_args, board_name)
+            board_pool.release(board)
+            result['test_time'] = time.time() - start
+
+    def mbed20_matrix_report(self, cells, results):
+        """
+        print the results of the matrix cells and write them to matrix_report.json
+        
+        returns MBED_SUCCESS if all the cells were built (and tested) successfully.
+        a cell without a result is reported as a failed build, and any non zero
+        exit code (e.g. 2, or negative if killed by a signal) as a failure.
+        """
+        ret = MBED_SUCCESS
+        def outcome(code):
+            if code is None:
+                return '-'
+            return 'pass' if code == MBED_SUCCESS else 'FAIL'
+        report = []
+        print "%-24s %-10s %-6s %8s %-24s %-6s %8s" % ('target', 'toolchain', 'build', 'build_s', 'board', 'test', 'test_s')
+        for cell in cells:
+            result = results.get(cell, None)
+            if result is None:
+                result = self.mbed20_matrix_result(cell, MBED_FAILURE)
+            print "%-24s %-10s %-6s %8.1f %-24s %-6s %8.1f" % (result['target'], result['toolchain'], outcome(result['build']), result['build_time'],
+                                                               result['board'], outcome(result['test']), result['test_time'])
+            if result['build'] != MBED_SUCCESS or result['test'] not in [MBED_SUCCESS, None]:
+                ret = MBED_FAILURE
+            report.append(result)
+
+        with open("matrix_report.json", "w") as data_file:
+            json.dump(report, data_file, indent=4, sort_keys=True)
+        return ret
+
+    def mbed20_muts_all_json_add(self, args, comport, disk, filepath=None):
         """
         write <src_root>/workspace_tools/muts_all.json with the following contents
             {
@@ -791,13 +1219,17 @@ class mbed_jenkins:
                   },
             
             }        
+
+        or to filepath if specified.
         """
         self.dbg(sys._getframe().f_code.co_name + ":entered.") 
         ret = MBED_FAILURE
         
         if args.target != "" and args.toolchain != "":
 
-            if args.jenkins is True:
+            if filepath is not None:
+                pass
+            elif args.jenkins is True:
                 filepath = "./workspace_tools/muts_all.json"
             else:
                 # bash command line
@@ -907,7 +1339,7 @@ class mbed_jenkins:
         ret = self.mbed20_generate_json_test_spec_files(args)
         return ret 
 
-    def mbed20_test_spec_json_add(self, args):
+    def mbed20_test_spec_json_add(self, args, filepath=None):
         """
         write <src_root>/workspace_tools/test_spec.json with the following contents
             {
@@ -915,13 +1347,17 @@ class mbed_jenkins:
                 "LPC1768" : ["GCC_ARM"]
                 }
             }
+
+        or to filepath if specified.
         """
         dbg(sys._getframe().f_code.co_name + ":entered.") 
         ret = MBED_FAILURE
         
         if args.target != "" and args.toolchain != "":
 
-            if args.jenkins is True:
+            if filepath is not None:
+                pass
+            elif args.jenkins is True:
                 # todo: delete filepath = "./workspace_tools/test_spec.json"
                 filepath = "./" + TEST_SPC_JSN_PATHNAME
                 
@@ -1172,76 +1608,645 @@ class mbed_jenkins:
         dbg(sys._getframe().f_code.co_name + ":ret=" + str(ret))
         return ret
     
-    def target_pwr_restart(self, args):
-        """ use mbed_usb.py to turn off args.target[0] 
+    def get_hub_controller(self):
+        """ return the mbed_usb hub controller, creating it on first use
+
+        the controller is held for the life of the job so the hub connections
+        and config are reused by all the power operations.
+        """
+        if self.hub_controller is None:
+            # only imported by jobs controlling the hubs
+            import mbed_usb_daemon
+            self.hub_controller = mbed_usb_daemon.MbedHubController()
+        return self.hub_controller
+
+    def get_device_inventory(self):
+        """ return the inventory of the devices detected by mbed_lstools, creating it on first use
+        """
+        with self.build_cache_lock:
+            if mbed_jenkins.device_inventory is None:
+                mbed_jenkins.device_inventory = mbed_jenkins_device_inventory()
+            return mbed_jenkins.device_inventory
+
+    def target_pwr_restart(self, args, board=None):
+        """ use mbed_usb.py to power cycle args.target[0], or the board
+        specified by its platform_name_unique e.g. K64F[1]
         """
         
         # - power off target just in case the job was interrupted and 
         #   it was left powered on.
-        # - wait
+        # - wait for it to go away (upto 3s)
         # - power on target
-        # - wait for board to come up (MAXWSNENV takes 10s to come up)
-        # this can be done with the following:
-        #   mbed_usb.py --platform_name_unique <args.target>[0] -s off -f 3
-        #   mbed_usb.py --platform_name_unique <args.target>[0] -s on -n 10
-        
+        # - wait for board to come up, for upto the time the board has
+        #   previously taken to boot (MAXWSNENV takes 10s to come up)
+        # the board not coming up isnt treated as an error here as the test
+        # run will report it.
+        if board is None:
+            board = '%s[0]' % args.target
         ret = MBED_SUCCESS 
-        ret = self.target_pwr_off(args)
-        #bashCommand = "python + mbed_usb.py --platform_name_unique " + args.target + "[0] -s on -n 10"
-        #bashCommand = """c:\\mbed_tools\\scripts\\mbed_usb.py --platform_name_unique """ + args.target + """\[0\] -s on -n 10"""
-        #print "bashCommand=%s" % bashCommand
-        #ret = self.doBashCmd(bashCommand)
-        
-        app = mbed_usb.MbedUsbTheApp()
-        app.imported=True
-        app.imported_arg_list = []
-        app.imported_arg_list.append('dummy')
-        app.imported_arg_list.append('--platform_name_unique')
-        app.imported_arg_list.append('%s[0]' % args.target)
-        app.imported_arg_list.append('-s')
-        app.imported_arg_list.append('on')
-        app.imported_arg_list.append('-n')
-        app.imported_arg_list.append('10')
-        app.mbed_usb_main()
+        ret = self.target_pwr_off(args, board)
+        self.get_hub_controller().power(board, 'on', wait=True, timeout=None)
         
         return ret    
         
 
-    def target_pwr_off(self, args):
-        """ use mbed_usb.py to turn off args.target[0] 
+    def target_pwr_off(self, args, board=None):
+        """ use mbed_usb.py to turn off args.target[0], or the board
+        specified by its platform_name_unique e.g. K64F[1]
         """
+        if board is None:
+            board = '%s[0]' % args.target
         ret = MBED_SUCCESS 
         
         # - power off target  
-        # - wait
-        #   mbed_usb.py --platform_name_unique <args.target>[0] -s off -f 3
-
-        #bashCommand = "python mbed_usb.py --platform_name_unique " + args.target + "[0] -s off -f 3"
-        #bashCommand = r"""c:\\mbed_tools\\scripts\\mbed_usb.py --platform_name_unique """ + args.target + """\[0\] -s off -f 3"""
-        bashCommand = """mbed_usb.py -h"""
-        #bashCommand = """mbed_usb.py --platform_name_unique """ + args.target + """[0] -s off -f 3"""
-        print "target_pwr_off:bashCommand=%s" % bashCommand
-        #ret = self.doBashCmd(bashCommand)
-        
-        
-        app = mbed_usb.MbedUsbTheApp()
-        app.imported=True
-        app.imported_arg_list = []
-        app.imported_arg_list.append('dummy')
-        app.imported_arg_list.append('--platform_name_unique')
-        app.imported_arg_list.append('%s[0]' % args.target)
-        app.imported_arg_list.append('-s')
-        app.imported_arg_list.append('off')
-        app.imported_arg_list.append('-f')
-        app.imported_arg_list.append('3')
-        
-        print app.imported_arg_list
-        #app.opts.platform_name_unique_list = True
-        app.mbed_usb_main()
+        # - wait for it to go away (upto 3s)
+        self.get_hub_controller().power(board, 'off', wait=True, timeout=3)
         
         return ret    
         
 
+##############################################################################
+# cache of build results
+##############################################################################
+class mbed_jenkins_build_cache:
+    """
+    Cache of the libraries built by workspace_tools/build.py, so rebuilding a
+    target with a toolchain from the same sources restores the previous
+    build rather than compiling it again e.g. in the nightly rerun of a
+    commit which hasnt changed.
+    
+    Each build is stored in <cache_dir>/<key>.tar, the key being a hash of
+    the repository HEAD, the toolchain and its version, the target and the
+    private settings of the toolchain. Builds of working copies with local
+    changes arent cached. index.json records the size and time of last use
+    of the builds, and the least recently used builds are removed to keep
+    the cache under its size limit. The cache can be shared by jobs: the
+    index is only read and updated holding the lock file index.json.lock.
+    """
+    INDEX_FILENAME = "index.json"
+    # time allowed to take the lock file (s), and the age after which a lock
+    # file is taken to have been left behind by a job which died (s)
+    LOCK_TIMEOUT = 30.0
+    LOCK_STALE = 120.0
+    LOCK_POLL_INTERVAL = 0.1
+
+    def __init__(self, cache_dir, size_limit):
+        """
+        cache_dir       directory the builds are stored in
+        size_limit      maximum size of the stored builds (bytes)
+        """
+        self.cache_dir = cache_dir
+        self.size_limit = size_limit
+        self.lock = threading.Lock()
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def key(self, repo_dir, toolchain, toolchain_version, target, private_settings):
+        """
+        return the key of the build of target with toolchain from the sources in repo_dir,
+        or None if the build cant be cached because the sources arent a clean git checkout
+        
+        private_settings    list of the workspace_tools/private_settings.py lines of the toolchain
+        """
+        try:
+            head = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=repo_dir).strip()
+            changes = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo_dir).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        if changes != "":
+            dbg(sys._getframe().f_code.co_name + ": local changes in " + repo_dir + ", not caching build.")
+            return None
+        return hashlib.sha1(json.dumps([head, toolchain, toolchain_version, target, private_settings])).hexdigest()
+
+    def get_pathname(self, key):
+        return os.path.join(self.cache_dir, key + ".tar")
+
+    def load_index(self):
+        index_pathname = os.path.join(self.cache_dir, self.INDEX_FILENAME)
+        if not os.path.exists(index_pathname):
+            return {}
+        try:
+            with open(index_pathname, "r") as data_file:
+                return json.load(data_file)
+        except ValueError:
+            # corrupt, the builds will be recached
+            return {}
+
+    def save_index(self, index):
+        # write then rename so other jobs never see a partial index
+        index_pathname = os.path.join(self.cache_dir, self.INDEX_FILENAME)
+        tmp_pathname = index_pathname + ".%d.tmp" % os.getpid()
+        with open(tmp_pathname, "w") as data_file:
+            json.dump(index, data_file, indent=4, sort_keys=True)
+        if os.name == 'nt' and os.path.exists(index_pathname):
+            # windows doesnt replace an existing file on rename
+            os.remove(index_pathname)
+        os.rename(tmp_pathname, index_pathname)
+
+    def lock_file(self):
+        """
+        take the lock file serialising the updates of the cache between jobs
+        
+        returns True if the lock was taken, False if it couldnt be within LOCK_TIMEOUT
+        """
+        lock_pathname = os.path.join(self.cache_dir, self.INDEX_FILENAME + ".lock")
+        deadline = time.time() + self.LOCK_TIMEOUT
+        while True:
+            try:
+                fd = os.open(lock_pathname, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, str(os.getpid()))
+                os.close(fd)
+                return True
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    dbg(sys._getframe().f_code.co_name + ": failed to create lock file " + lock_pathname + ": " + str(e))
+                    return False
+            try:
+                if time.time() - os.path.getmtime(lock_pathname) > self.LOCK_STALE:
+                    dbg(sys._getframe().f_code.co_name + ": removing stale lock file " + lock_pathname)
+                    os.remove(lock_pathname)
+                    continue
+            except OSError:
+                # released since the attempt to create it
+                continue
+            if time.time() > deadline:
+                dbg(sys._getframe().f_code.co_name + ": timed out waiting for lock file " + lock_pathname)
+                return False
+            time.sleep(self.LOCK_POLL_INTERVAL)
+
+    def unlock_file(self):
+        """
+        release the lock file taken by lock_file()
+        """
+        try:
+            os.remove(os.path.join(self.cache_dir, self.INDEX_FILENAME + ".lock"))
+        except OSError:
+            pass
+
+    def is_build_file(self, relpath, toolchain, target):
+        """
+        return True if the file (relative to the build directory) is part of the build of
+        target with toolchain i.e. is in the TARGET_<target> and TOOLCHAIN_<toolchain>
+        directories, or is common to all targets e.g. build/mbed/mbed.h
+        """
+        parts = relpath.replace("\\", "/").split("/")
+        if parts[0] == "test":
+            # built by singletest.py rather than build.py
+            return False
+        targets = [part for part in parts if part.startswith("TARGET_")]
+        toolchains = [part for part in parts if part.startswith("TOOLCHAIN_")]
+        if len(targets) > 0 and "TARGET_" + target not in targets:
+            return False
+        if len(toolchains) > 0 and "TOOLCHAIN_" + toolchain not in toolchains:
+            return False
+        return True
+
+    def restore(self, key, build_dir):
+        """
+        extract the cached build into build_dir
+        
+        returns True if the build was in the cache
+        """
+        pathname = self.get_pathname(key)
+        with self.lock:
+            if not self.lock_file():
+                return False
+            try:
+                index = self.load_index()
+                if key not in index or not os.path.exists(pathname):
+                    return False
+                index[key]['last_used'] = time.time()
+                self.save_index(index)
+            finally:
+                self.unlock_file()
+        try:
+            with tarfile.open(pathname, "r") as tar:
+                tar.extractall(build_dir)
+        except (IOError, tarfile.TarError) as e:
+            # removed by another job, or corrupt
+            dbg(sys._getframe().f_code.co_name + ": failed to restore " + key + ": " + str(e))
+            return False
+        return True
+
+    def store(self, key, build_dir, toolchain, target):
+        """
+        add the build of target with toolchain in build_dir to the cache, removing the
+        least recently used builds if the cache is then over its size limit
+        """
+        pathname = self.get_pathname(key)
+        tmp_pathname = pathname + ".%d.%d.tmp" % (os.getpid(), threading.current_thread().ident)
+        with tarfile.open(tmp_pathname, "w") as tar:
+            for root, dirs, files in os.walk(build_dir):
+                for name in files:
+                    relpath = os.path.relpath(os.path.join(root, name), build_dir)
+                    if self.is_build_file(relpath, toolchain, target):
+                        tar.add(os.path.join(root, name), relpath)
+
+        # the build is only added holding the lock, so another job evicting
+        # builds which arent in the index doesnt remove it
+        with self.lock:
+            if not self.lock_file():
+                os.remove(tmp_pathname)
+                return
+            try:
+                if os.name == 'nt' and os.path.exists(pathname):
+                    os.remove(pathname)
+                os.rename(tmp_pathname, pathname)
+                index = self.load_index()
+                index[key] = {'target' : target, 'toolchain' : toolchain, 'size' : os.path.getsize(pathname), 'last_used' : time.time()}
+                self.evict(index)
+                self.save_index(index)
+            finally:
+                self.unlock_file()
+
+    def evict(self, index):
+        """
+        remove the least recently used builds from the cache (and index) until it is under its size limit.
+        builds which arent in the index e.g. left by a job which died are removed.
+        called holding the lock file.
+        """
+        for key in index.keys():
+            if not os.path.exists(self.get_pathname(key)):
+                del index[key]
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".tar") and name[:-len(".tar")] not in index:
+                dbg(sys._getframe().f_code.co_name + ": removing unindexed build " + name)
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+        size = sum([index[key]['size'] for key in index])
+        for key in sorted(index, key=lambda key: index[key]['last_used']):
+            if size <= self.size_limit:
+                break
+            dbg(sys._getframe().f_code.co_name + ": evicting " + index[key]['target'] + ":" + index[key]['toolchain'] + " build " + key)
+            size -= index[key]['size']
+            del index[key]
+            try:
+                os.remove(self.get_pathname(key))
+            except OSError:
+                pass
+
+
+##############################################################################
+# incremental workspace
+##############################################################################
+class mbed_jenkins_workspace:
+    """
+    Fingerprints of the sources and settings of the builds in the build
+    directory, so a workspace can be rebuilt without first removing all of
+    build/. Each target:toolchain build (the TARGET_<target>/TOOLCHAIN_<toolchain>
+    subdirectories of build/) has a fingerprint of the libraries/ and
+    workspace_tools/ files compiled for it, the private settings and the
+    compiler version. Only the builds whose fingerprint has changed are
+    removed and rebuilt.
+    
+    The fingerprints are kept in build/.mbed_jenkins_fingerprints.json,
+    with the hashes of the source files so only files whose modification
+    time or size has changed are read again.
+    """
+    FINGERPRINTS_FILENAME = ".mbed_jenkins_fingerprints.json"
+    SOURCE_DIRS = ["libraries", "workspace_tools"]
+
+    def __init__(self, repo_dir):
+        """
+        repo_dir    top level directory of the mbed 2.0 repository
+        """
+        self.repo_dir = repo_dir
+        self.build_dir = os.path.join(repo_dir, "build")
+        self.lock = threading.Lock()
+        # target -> list of target labels, or None if they couldnt be found
+        self.labels = {}
+        # relpath -> [mtime, size, sha1] of the source files, see get_file_hashes()
+        self.file_hashes = None
+        self.fingerprints = self.load()
+
+    def load(self):
+        pathname = os.path.join(self.build_dir, self.FINGERPRINTS_FILENAME)
+        if os.path.exists(pathname):
+            try:
+                with open(pathname, "r") as data_file:
+                    return json.load(data_file)
+            except ValueError:
+                pass
+        # no or corrupt fingerprints, so no builds are up to date
+        return {'files' : {}, 'builds' : {}}
+
+    def save(self):
+        if not os.path.exists(self.build_dir):
+            os.makedirs(self.build_dir)
+        pathname = os.path.join(self.build_dir, self.FINGERPRINTS_FILENAME)
+        with open(pathname, "w") as data_file:
+            json.dump(self.fingerprints, data_file, indent=4, sort_keys=True)
+
+    def is_source_file(self, relpath):
+        name = os.path.basename(relpath)
+        if name.endswith(".pyc") or name == "private_settings.py":
+            return False
+        # written by the jobs
+        if name.startswith("test_spec") or name.startswith("muts_all"):
+            return False
+        return True
+
+    def get_file_hashes(self):
+        """
+        return the dictionary of relpath -> [mtime, size, sha1] of the source files,
+        hashing the files which have changed since the fingerprints were saved
+        """
+        with self.lock:
+            if self.file_hashes is not None:
+                return self.file_hashes
+            previous = self.fingerprints['files']
+            file_hashes = {}
+            for source_dir in self.SOURCE_DIRS:
+                for root, dirs, files in os.walk(os.path.join(self.repo_dir, source_dir)):
+                    for name in files:
+                        pathname = os.path.join(root, name)
+                        relpath = os.path.relpath(pathname, self.repo_dir).replace("\\", "/")
+                        if not self.is_source_file(relpath):
+                            continue
+                        stat = os.stat(pathname)
+                        if relpath in previous and previous[relpath][0:2] == [stat.st_mtime, stat.st_size]:
+                            file_hashes[relpath] = previous[relpath]
+                            continue
+                        with open(pathname, "rb") as source_file:
+                            file_hashes[relpath] = [stat.st_mtime, stat.st_size, hashlib.sha1(source_file.read()).hexdigest()]
+            self.file_hashes = file_hashes
+            return self.file_hashes
+
+    def get_target_labels(self, target):
+        """
+        return the labels of the TARGET_<label> directories built for target e.g.
+        K64F, M4, Freescale, KPSDK_MCUS, or None if workspace_tools/targets.py couldnt tell
+        """
+        with self.lock:
+            if target not in self.labels:
+                cmd = [sys.executable, "-c", "import sys; sys.path.insert(0, sys.argv[1]); from workspace_tools.targets import TARGET_MAP; print ' '.join(TARGET_MAP[sys.argv[2]].get_labels())",
+                       os.path.abspath(self.repo_dir), target]
+                try:
+                    self.labels[target] = subprocess.check_output(cmd, stderr=subprocess.STDOUT).split()
+                except (OSError, subprocess.CalledProcessError):
+                    dbg(sys._getframe().f_code.co_name + ": failed to get labels of " + target + ", all target sources are fingerprinted.")
+                    self.labels[target] = None
+            return self.labels[target]
+
+    def is_target_file(self, relpath, target_labels, toolchain_labels):
+        """
+        return True if the file is built for the target and toolchain labels (None for any)
+        """
+        for part in relpath.split("/"):
+            if part.startswith("TARGET_") and target_labels is not None and part[len("TARGET_"):] not in target_labels:
+                return False
+            if part.startswith("TOOLCHAIN_") and toolchain_labels is not None and part[len("TOOLCHAIN_"):] not in toolchain_labels:
+                return False
+        return True
+
+    def fingerprint(self, target, toolchain, private_settings, toolchain_version):
+        """
+        return the fingerprint of the build of target with toolchain
+        
+        private_settings    list of the workspace_tools/private_settings.py lines of the toolchain
+        toolchain_version   version reported by the toolchain compiler
+        """
+        file_hashes = self.get_file_hashes()
+        target_labels = self.get_target_labels(target)
+        toolchain_labels = TOOLCHAIN_LABELS.get(toolchain, None)
+        sha1 = hashlib.sha1(json.dumps([target, toolchain, private_settings, toolchain_version]))
+        for relpath in sorted(file_hashes):
+            if self.is_target_file(relpath, target_labels, toolchain_labels):
+                sha1.update(relpath + file_hashes[relpath][2])
+        return sha1.hexdigest()
+
+    def get_build_dirs(self, target, toolchain):
+        """
+        return the list of the TOOLCHAIN_<toolchain> build subdirectories of target
+        e.g. build/mbed/TARGET_K64F/TOOLCHAIN_GCC_ARM, build/rtos/TARGET_K64F/TOOLCHAIN_GCC_ARM
+        """
+        build_dirs = []
+        for root, dirs, files in os.walk(self.build_dir):
+            if "TOOLCHAIN_" + toolchain in dirs and "TARGET_" + target in os.path.relpath(root, self.build_dir).replace("\\", "/").split("/"):
+                build_dirs.append(os.path.join(root, "TOOLCHAIN_" + toolchain))
+        return build_dirs
+
+    def build_cells(self):
+        """
+        return the list of (target, toolchain) builds in the build directory
+        """
+        cells = set()
+        for root, dirs, files in os.walk(self.build_dir):
+            parent = os.path.basename(root)
+            if parent.startswith("TARGET_"):
+                for name in dirs:
+                    if name.startswith("TOOLCHAIN_"):
+                        cells.add((parent[len("TARGET_"):], name[len("TOOLCHAIN_"):]))
+        return sorted(cells)
+
+    def is_up_to_date(self, target, toolchain, fingerprint):
+        """
+        return True if the build of target with toolchain has the fingerprint
+        """
+        if self.fingerprints['builds'].get(target + ":" + toolchain, None) != fingerprint:
+            return False
+        return len(self.get_build_dirs(target, toolchain)) > 0
+
+    def invalidate(self, target, toolchain):
+        """
+        remove the build of target with toolchain
+        """
+        for build_dir in self.get_build_dirs(target, toolchain):
+            dbg(sys._getframe().f_code.co_name + ": removing " + build_dir)
+            shutil.rmtree(build_dir)
+        with self.lock:
+            if self.fingerprints['builds'].pop(target + ":" + toolchain, None) is not None:
+                self.save()
+
+    def record(self, target, toolchain, fingerprint):
+        """
+        record the fingerprint of a completed build of target with toolchain
+        """
+        file_hashes = self.get_file_hashes()
+        with self.lock:
+            self.fingerprints['files'] = file_hashes
+            self.fingerprints['builds'][target + ":" + toolchain] = fingerprint
+            self.save()
+
+
+##############################################################################
+# inventory of the detected devices
+##############################################################################
+class mbed_jenkins_device_inventory:
+    """
+    The devices detected by mbed_lstools, indexed by target_id, platform_name
+    and mount point, so looking up the serial port and mount point of a
+    device doesnt run and parse mbedls each time.
+    
+    The devices are listed again when the inventory is older than MAX_AGE,
+    or when a device which isnt in the inventory is looked up (at most every
+    MIN_REFRESH_INTERVAL). Only the devices which have been added, removed or
+    have changed are updated in the indexes.
+    """
+    # time the listed devices are used for before listing them again (s)
+    MAX_AGE = 30.0
+    # minimum time between listing the devices to look for a device not in the inventory (s)
+    MIN_REFRESH_INTERVAL = 1.0
+
+    def __init__(self):
+        self.mbeds = None
+        self.lock = threading.Lock()
+        # target_id -> mbed_lstools device data e.g. {'platform_name' : 'K64F', 'mount_point' : 'E:', 'serial_port' : 'COM35', 'target_id' : '0240...'}
+        self.devices = {}
+        # platform_name -> list of target_ids
+        self.by_platform_name = {}
+        # lower case mount_point -> target_id
+        self.by_mount_point = {}
+        # time the devices were last listed, 0 if never
+        self.refresh_time = 0
+
+    def add(self, device):
+        target_id = device['target_id']
+        self.devices[target_id] = device
+        self.by_platform_name.setdefault(device.get('platform_name'), []).append(target_id)
+        if device.get('mount_point'):
+            self.by_mount_point[device['mount_point'].lower()] = target_id
+
+    def remove(self, target_id):
+        device = self.devices.pop(target_id)
+        target_ids = self.by_platform_name[device.get('platform_name')]
+        target_ids.remove(target_id)
+        if len(target_ids) == 0:
+            del self.by_platform_name[device.get('platform_name')]
+        if device.get('mount_point') and self.by_mount_point.get(device['mount_point'].lower()) == target_id:
+            del self.by_mount_point[device['mount_point'].lower()]
+
+    def refresh(self):
+        """
+        list the devices with mbed_lstools and update the inventory with the changes
+        
+        returns the number of devices added, removed or changed
+        """
+        if self.mbeds is None:
+            # only imported by jobs looking up devices
+            import mbed_lstools
+            self.mbeds = mbed_lstools.create()
+
+        listed = {}
+        for device in self.mbeds.list_mbeds():
+            if device.get('target_id'):
+                listed[device['target_id']] = device
+
+        with self.lock:
+            changes = 0
+            for target_id in self.devices.keys():
+                if target_id not in listed:
+                    self.remove(target_id)
+                    changes += 1
+                elif listed[target_id] != self.devices[target_id]:
+                    # readded (and counted) below
+                    self.remove(target_id)
+            for target_id in listed:
+                if target_id not in self.devices:
+                    self.add(listed[target_id])
+                    changes += 1
+            self.refresh_time = time.time()
+        dbg(sys._getframe().f_code.co_name + ": %d devices, %d changed" % (len(listed), changes))
+        return changes
+
+    def find(self, target_id='', platform_name='', mount_point=''):
+        """
+        find a device by any of its identifiers, listing the devices again if it isnt in the inventory
+        
+        returns the mbed_lstools device data, or None if not found
+        """
+        if time.time() - self.refresh_time > self.MAX_AGE:
+            self.refresh()
+        device = self.lookup(target_id, platform_name, mount_point)
+        if device is None and time.time() - self.refresh_time > self.MIN_REFRESH_INTERVAL:
+            self.refresh()
+            device = self.lookup(target_id, platform_name, mount_point)
+        return device
+
+    def lookup(self, target_id='', platform_name='', mount_point=''):
+        """
+        find a device in the inventory, returning None if not found
+        """
+        with self.lock:
+            if target_id and target_id in self.devices:
+                return self.devices[target_id]
+            if platform_name and platform_name in self.by_platform_name:
+                return self.devices[self.by_platform_name[platform_name][0]]
+            if mount_point and mount_point.lower() in self.by_mount_point:
+                return self.devices[self.by_mount_point[mount_point.lower()]]
+        return None
+
+    def find_all(self, platform_name):
+        """
+        return the list of the devices of a platform e.g. K64F
+        """
+        if time.time() - self.refresh_time > self.MAX_AGE:
+            self.refresh()
+        with self.lock:
+            return [self.devices[target_id] for target_id in self.by_platform_name.get(platform_name, [])]
+
+
+##############################################################################
+# pool of the boards on the hubs which tests are run on
+##############################################################################
+class mbed_jenkins_board_pool:
+    """
+    The boards in the mbed_usb hub config, handed out to one test at a time.
+    A board is leased from the hub controller while in use, so boards being
+    used by other jobs (sharing the mbed_usb daemon) are skipped.
+    """
+    # time between attempts to lease a board leased by another job (s)
+    LEASE_RETRY_INTERVAL = 10
+    # time a board is leased for, which needs to be longer than a test run (s)
+    LEASE_DURATION = 4 * 3600
+
+    def __init__(self, hub_controller, owner):
+        """
+        hub_controller  mbed_usb_daemon.MbedHubController
+        owner           string identifying the leases of this job
+        """
+        self.hub_controller = hub_controller
+        self.owner = owner
+        self.condition = threading.Condition()
+        # platform_name_unique of the boards in use
+        self.busy = set()
+        # platform_name e.g. K64F -> list of card config entries of the boards
+        self.boards = {}
+        for subrack_id in hub_controller.rack.get_subrack_ids():
+            topology = hub_controller.rack.subracks[subrack_id].topology
+            for platform_name_unique in topology.platform_name_unique_list():
+                (hub_id, hub_port_id) = topology.find(platform_name_unique=platform_name_unique)
+                board = topology.get_hub_port_data(hub_id, hub_port_id)
+                self.boards.setdefault(board.get('platform_name', ''), []).append(board)
+
+    def has_board(self, platform_name):
+        return len(self.boards.get(platform_name, [])) > 0
+
+    def acquire(self, platform_name):
+        """
+        wait for a board of the platform to be free, and lease it
+        
+        returns the card config entry of the board e.g. with the serial_port and mount_point
+        """
+        with self.condition:
+            while True:
+                for board in self.boards.get(platform_name, []):
+                    if board['platform_name_unique'] in self.busy:
+                        continue
+                    if self.hub_controller.lease(board['platform_name_unique'], self.owner, self.LEASE_DURATION) == MBED_SUCCESS:
+                        self.busy.add(board['platform_name_unique'])
+                        return board
+                self.condition.wait(self.LEASE_RETRY_INTERVAL)
+
+    def release(self, board):
+        with self.condition:
+            self.hub_controller.release(board['platform_name_unique'])
+            self.busy.discard(board['platform_name_unique'])
+            self.condition.notify_all()
+
+
 ##############################################################################
 # Unit test code
 ##############################################################################
@@ -1465,10 +2470,18 @@ if __name__ == "__main__":
     # jenkins options
     parser.add_argument('--build', action='store_true', help='perform the build step')
     parser.add_argument('--build-release', action='store_true', help='perform the build step')
+    parser.add_argument('--build-cache', action='store_true', help='restore builds of unchanged sources from the build cache, and add new builds to it')
+    parser.add_argument('--build-cache-dir', default=BUILD_CACHE_PATH, help='directory of the build cache (default %s)' % BUILD_CACHE_PATH)
+    parser.add_argument('--build-cache-size', type=int, default=BUILD_CACHE_SIZE_MB, help='size limit of the build cache in MB, the least recently used builds are removed when over it (default %d)' % BUILD_CACHE_SIZE_MB)
+    parser.add_argument('--ccache', action='store_true', help='compile GCC_ARM and ARM builds through ccache, printing the cache hits and misses after each build')
+    parser.add_argument('--ccache-dir', default=CCACHE_DIR_PATH, help='ccache cache directory, which can be shared by the jobs (default %s)' % CCACHE_DIR_PATH)
+    parser.add_argument('--ccache-exe', default=CCACHE_EXE, help='ccache executable (default %s, found on the PATH)' % CCACHE_EXE)
+    parser.add_argument('--ccache-size', type=int, default=CCACHE_SIZE_MB, help='size limit of the ccache cache in MB (default %d)' % CCACHE_SIZE_MB)
     parser.add_argument('--clean', action='store_true', help='perform clean before other steps e.g. the build step')
     parser.add_argument('--clone', action='store_true', help='get a copy of the relevant git repository')
     parser.add_argument('--comport', default='', help='generate test_spec.json and muts_all.json and use this comport value (e.g. --comport COM35). Must also specify --disk option.')
     parser.add_argument('--disk', default='', help='generate test_spec.json and muts_all.json and use this disk value (e.g. --disk M:). Must also specify --disk option.')
+    parser.add_argument('--incremental', action='store_true', help='used with --clean to keep the build directory, only removing and rebuilding the target:toolchain builds whose sources or settings have changed')
     parser.add_argument('--jenkins', action='store_true', help='switch to indicate running as part of jenkins')
     parser.add_argument('--mbed20', action='store_true', help='perform mbed 2.0 build steps')
     parser.add_argument('--mbed30', action='store_true', help='perform mbed 3.0 build steps')
@@ -1481,6 +2494,8 @@ if __name__ == "__main__":
     parser.add_argument('--toolchain', default='GCC_ARM', help='specify toolchain (GCC_ARM, ARM_CC)')
     parser.add_argument('--target', default='K64F', help='mcu (K64F etc')
     parser.add_argument('--target-pwr-restart', default = True, action='store_true', help='at start of test turn target off then on; at end of test turn target off')
+    parser.add_argument('--matrix', nargs='+', default=[], help='build (and test) each of the target:toolchain cells e.g. --matrix K64F:GCC_ARM K64F:ARM, in parallel, testing on whichever boards are free')
+    parser.add_argument('--matrix-jobs', type=int, default=0, help='number of matrix builds to run at once (default 0 i.e. one per cpu)')
     parser.add_argument('--unit-test', default=mbed_jenkins_unit_test.NO_UNIT_TEST, help='perform unit tests')
     args = parser.parse_args()
 
@@ -1613,3 +2628,19 @@ if __name__ == "__main__":
 # mbedmicro/workspace_tools/singletest.py -i test_spec.json -M muts_all.json -f NUCLEO_F091RC --tc=ARM -j 8 -v --report-junit NUCLEO_F091RC_junit_report.xml --report-html NUCLEO_F091RC_html_report.html -c cp
 
 # mbedmicro/workspace_tools/singletest.py -f NUCLEO_F091RC --tc=GCC_ARM -j 8 -v --report-junit NUCLEO_F091RC_junit_report.xml --report-html NUCLEO_F091RC_html_report.html -c cp -i mbedmicro/workspace_tools/test_spec.json -M muts_all.json
+
+# build 3 target:toolchain cells in parallel (one build per cpu), testing each on a free board as soon as it is built:
+# python mbed_jenkins.py --jenkins --mbed20 --build --test --target-pwr-restart --matrix K64F:GCC_ARM K64F:ARM LPC1768:GCC_ARM
+# python mbed_jenkins.py --jenkins --mbed20 --build --matrix K64F:GCC_ARM K64F:ARM LPC1768:GCC_ARM --matrix-jobs 2
+
+# clean build restoring the libraries from the build cache if the commit has been built before:
+# python mbed_jenkins.py --jenkins --mbed20 --clean --build --build-cache --target K64F --toolchain GCC_ARM
+# python mbed_jenkins.py --jenkins --mbed20 --clean --build --build-cache --build-cache-dir c:/mbed_tools/build_cache --build-cache-size 1024 --target K64F --toolchain GCC_ARM
+
+# rebuild only the target:toolchain builds whose sources or settings have changed since the last build:
+# python mbed_jenkins.py --jenkins --mbed20 --clean --incremental --build --target K64F --toolchain GCC_ARM
+# python mbed_jenkins.py --jenkins --mbed20 --project mbedmicro --clean --incremental --build-release
+
+# build through ccache with the cache shared by the jobs:
+# python mbed_jenkins.py --jenkins --mbed20 --clean --build --ccache --target K64F --toolchain GCC_ARM
+# python mbed_jenkins.py --jenkins --mbed20 --build --ccache --ccache-dir c:/mbed_tools/ccache --ccache-size 10240 --matrix K64F:GCC_ARM K64F:ARM
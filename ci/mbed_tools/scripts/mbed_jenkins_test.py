@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+#############################################################################
+# mbed_jenkins_test.py
+#  Regression tests of the build/test matrix executor in mbed_jenkins.py.
+#  The builds and tests are replaced by stand ins, so no toolchains,
+#  repository or boards are needed e.g. for CI:
+#       python mbed_jenkins_test.py
+#
+#############################################################################
+# version 0.0.1     matrix waves, wave scheduling and report
+# version 0.0.2     build cache shared by jobs
+
+
+"""
+mbed jenkins tests
+Copyright (c) 2011-2015 ARM Limited
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import unittest
+
+try:
+    import mbed_jenkins
+except ImportError:
+    # e.g. xunitparser isnt installed
+    mbed_jenkins = None
+
+
+class mbed_jenkins_matrix_stub(object):
+    """ stand in for the builds of the matrix cells
+
+    Each build takes build_time seconds, and raises for the cells in fail_cells.
+    """
+
+    def __init__(self, build_time=0.1, fail_cells=()):
+        self.build_time = build_time
+        self.fail_cells = fail_cells
+        self.lock = threading.Lock()
+        # (target, toolchain, start, end) of each build
+        self.builds = []
+
+    def build_cell(self, jenkins, args, cell):
+        start = time.time()
+        time.sleep(self.build_time)
+        with self.lock:
+            self.builds.append((cell[0], cell[1], start, time.time()))
+        if cell in self.fail_cells:
+            raise OSError("build.py not found")
+        return jenkins.mbed20_matrix_result(cell)
+
+
+@unittest.skipIf(mbed_jenkins is None, 'mbed_jenkins.py dependencies (xunitparser) not installed')
+class mbed_jenkins_matrix_test(unittest.TestCase):
+    """ tests of mbed_jenkins.mbed20_matrix() and the functions it uses"""
+
+    def setUp(self):
+        self.jenkins = mbed_jenkins.mbed_jenkins()
+        self.args = argparse.Namespace(test=False, build=True)
+
+        # the report is written to the current directory
+        self.dir_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir_path)
+        cwd = os.getcwd()
+        os.chdir(self.dir_path)
+        self.addCleanup(os.chdir, cwd)
+
+    def run_wave(self, wave, jobs, stub):
+        self.jenkins.mbed20_matrix_build_cell = lambda args, cell: stub.build_cell(self.jenkins, args, cell)
+        results = {}
+        self.jenkins.mbed20_matrix_run_wave(self.args, wave, jobs, None, results)
+        return results
+
+    def test_waves(self):
+        cells = [('K64F', 'GCC_ARM'), ('K64F', 'ARM'), ('LPC1768', 'uARM'), ('LPC1768', 'ARM')]
+        self.assertEqual(self.jenkins.mbed20_matrix_waves(cells), [cells])
+
+        # toolchains setting ARM_PATH to different compilers need separate private_settings.py files
+        private_settings20 = self.jenkins.private_settings20
+        def private_settings20_conflicting(toolchain):
+            if toolchain == 'uARM':
+                return ['ARM_PATH = "c:/mbed_tools/ARMCompiler_5.05"']
+            return private_settings20(toolchain)
+        self.jenkins.private_settings20 = private_settings20_conflicting
+        waves = self.jenkins.mbed20_matrix_waves(cells)
+        self.assertEqual(waves, [[('K64F', 'GCC_ARM'), ('K64F', 'ARM'), ('LPC1768', 'ARM')], [('LPC1768', 'uARM')]])
+
+    def test_run_wave_builds_targets_one_cell_at_a_time(self):
+        wave = [('K64F', 'GCC_ARM'), ('K64F', 'ARM'), ('K64F', 'uARM'), ('LPC1768', 'GCC_ARM'), ('NUCLEO_F401RE', 'GCC_ARM')]
+        stub = mbed_jenkins_matrix_stub()
+        results = self.run_wave(wave, 4, stub)
+        self.assertEqual(sorted(results), sorted(wave))
+
+        # the builds of a target never overlap
+        for (target, toolchain, start, end) in stub.builds:
+            for (other_target, other_toolchain, other_start, other_end) in stub.builds:
+                if target == other_target and toolchain != other_toolchain:
+                    self.assertTrue(end <= other_start or other_end <= start, '%s:%s overlaps %s:%s' % (target, toolchain, target, other_toolchain))
+
+        # while the builds of different targets run in parallel
+        elapsed = max([end for (t, c, s, end) in stub.builds]) - min([start for (t, c, start, e) in stub.builds])
+        self.assertLess(elapsed, stub.build_time * len(wave))
+
+    def test_run_wave_build_exception(self):
+        wave = [('K64F', 'GCC_ARM'), ('K64F', 'ARM'), ('LPC1768', 'GCC_ARM')]
+        stub = mbed_jenkins_matrix_stub(build_time=0.0, fail_cells=[('K64F', 'GCC_ARM')])
+        results = self.run_wave(wave, 2, stub)
+        self.assertEqual(results[('K64F', 'GCC_ARM')]['build'], mbed_jenkins.MBED_FAILURE)
+        self.assertEqual(results[('K64F', 'ARM')]['build'], mbed_jenkins.MBED_SUCCESS)
+        self.assertEqual(results[('LPC1768', 'GCC_ARM')]['build'], mbed_jenkins.MBED_SUCCESS)
+
+    def test_report(self):
+        cells = [('K64F', 'GCC_ARM'), ('K64F', 'ARM'), ('LPC1768', 'GCC_ARM')]
+        results = {}
+        results[cells[0]] = self.jenkins.mbed20_matrix_result(cells[0])
+        # e.g. singletest.py exiting with 2
+        results[cells[1]] = self.jenkins.mbed20_matrix_result(cells[1])
+        results[cells[1]]['test'] = 2
+        # LPC1768:GCC_ARM has no result
+
+        self.assertEqual(self.jenkins.mbed20_matrix_report(cells, results), mbed_jenkins.MBED_FAILURE)
+        with open("matrix_report.json", "r") as data_file:
+            report = json.load(data_file)
+        self.assertEqual([[result['target'], result['toolchain']] for result in report], [list(cell) for cell in cells])
+        self.assertEqual([(result['build'], result['test']) for result in report],
+                         [(mbed_jenkins.MBED_SUCCESS, None), (mbed_jenkins.MBED_SUCCESS, 2), (mbed_jenkins.MBED_FAILURE, None)])
+
+        del results[cells[1]]
+        self.assertEqual(self.jenkins.mbed20_matrix_report(cells[:1], results), mbed_jenkins.MBED_SUCCESS)
+
+
+@unittest.skipIf(mbed_jenkins is None, 'mbed_jenkins.py dependencies (xunitparser) not installed')
+class mbed_jenkins_build_cache_test(unittest.TestCase):
+    """ tests of mbed_jenkins.mbed_jenkins_build_cache shared by jobs"""
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir_path)
+        self.cache_dir = os.path.join(self.dir_path, "build_cache")
+        self.build_dir = os.path.join(self.dir_path, "build")
+        target_dir = os.path.join(self.build_dir, "mbed", "TARGET_K64F", "TOOLCHAIN_GCC_ARM")
+        os.makedirs(target_dir)
+        with open(os.path.join(target_dir, "libmbed.a"), "w") as lib_file:
+            lib_file.write("lib" * 100)
+
+    def test_concurrent_jobs_keep_all_entries(self):
+        # each job has its own cache instance, so only the lock file serialises them
+        caches = [mbed_jenkins.mbed_jenkins_build_cache(self.cache_dir, 1024 * 1024) for job in range(0, 4)]
+        def store(job):
+            for num in range(0, 5):
+                caches[job].store("job%d_%d" % (job, num), self.build_dir, "GCC_ARM", "K64F")
+        threads = [threading.Thread(target=store, args=(job,)) for job in range(0, len(caches))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(caches[0].load_index()), 20)
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, "index.json.lock")))
+
+    def test_evict_removes_unindexed_builds(self):
+        cache = mbed_jenkins.mbed_jenkins_build_cache(self.cache_dir, 1024 * 1024)
+        # e.g. stored by a job which died before updating the index
+        with open(cache.get_pathname("orphan"), "w") as tar_file:
+            tar_file.write("x" * 2 * 1024 * 1024)
+        cache.store("build", self.build_dir, "GCC_ARM", "K64F")
+        self.assertFalse(os.path.exists(cache.get_pathname("orphan")))
+        self.assertEqual(sorted(cache.load_index()), ["build"])
+        self.assertTrue(cache.restore("build", os.path.join(self.dir_path, "restored")))
+
+    def test_stale_lock_file_removed(self):
+        cache = mbed_jenkins.mbed_jenkins_build_cache(self.cache_dir, 1024 * 1024)
+        lock_pathname = os.path.join(self.cache_dir, "index.json.lock")
+        with open(lock_pathname, "w") as lock_file:
+            lock_file.write("0")
+        stale = time.time() - cache.LOCK_STALE - 1
+        os.utime(lock_pathname, (stale, stale))
+        cache.store("build", self.build_dir, "GCC_ARM", "K64F")
+        self.assertEqual(sorted(cache.load_index()), ["build"])
+
+
+if __name__=='__main__':
+
+    unittest.main()
@@ -47,16 +47,30 @@ limitations under the License.
 # some boards are faster than others
 # some pcs are faster than others
 
+# serial and mbed_lstools are slow to import and are imported by the
+# functions using them, so commands only reading the config files (e.g.
+# --platform_name_unique_list) start quickly. Run such commands with
+# mbed_usb_cli.py to also avoid compiling this script, and see
+# mbed_usb_bench.py --startup for the startup time.
+#
+# The daemon and its clients (mbed_usb_daemon.py), telemetry
+# (mbed_usb_telemetry.py) and commissioning (mbed_usb_commission.py) are in
+# their own modules, which import the classes here and are imported by the
+# MbedUsbTheApp functions using them.
 import os
 import sys
 import optparse
-import serial
 import time
-import mbed_lstools
 import json
-from pprint import pprint
 import re
 import os.path
+import socket
+import threading
+import collections
+import select
+import math
+import errno
+import atexit
 
 
 # map for E102501
@@ -103,7 +117,36 @@ import os.path
 #data["om_points"]
 
 
-   
+class MbedCambrionixPortState(collections.namedtuple('MbedCambrionixPortState',
+        ['port_num', 'current_ma', 'flags', 'profile_id', 'time_charging', 'time_charged', 'energy'])):
+    """ state of a hub port as reported by the state command, port_num enumerating from 0"""
+    __slots__ = ()
+
+    @classmethod
+    def from_port_data(cls, port_data):
+        """! create a record from a MbedCambrionix.cmd_state() dictionary
+
+        @return MbedCambrionixPortState instance. ValueError is raised if the data is malformed.
+        """
+        def to_int(value):
+            # time_charged is reported as 'x' if the device hasnt finished charging
+            if value.isdigit():
+                return int(value)
+            return 0
+
+        return cls(port_num=int(port_data['port_num'])-1,
+                   current_ma=int(port_data['current_ma']),
+                   flags=tuple(port_data['flags'].split()),
+                   profile_id=to_int(port_data['profile_id']),
+                   time_charging=to_int(port_data['time_charging']),
+                   time_charged=to_int(port_data['time_charged']),
+                   energy=float(port_data['energy']))
+
+    def is_on(self):
+        """! return True if the port is powered i.e. the SYNC flag is set"""
+        return 'S' in self.flags
+
+
 class MbedUsbHub:
     """ Base class for usb hub with capability to turn power on/off to each port"""
 
@@ -247,12 +290,25 @@ class MbedUsbHub:
 class MbedCambrionix(MbedUsbHub):
     """class for managing the Cambrionix USB Hub"""
     
-    MAX_HUBS = 2
     MAX_PORTS = 12
     
     
     # identification string of hub
     description = "cambrionix U12S 12 Port USB Charge+Sync"
+
+    # prompt output by the hub when it has finished responding to a command
+    PROMPT = '>>'
+
+    # default time allowed for the hub to finish responding to a command (s)
+    RECV_TIMEOUT = 2.0
+
+    # maximum number of commands written to the hub before waiting for the
+    # first of them to be acknowledged
+    PIPELINE_DEPTH = 6
+
+    # command written by resync() to find the end of the responses to the
+    # commands in flight
+    RESYNC_COMMAND = 'system'
     
     def __init__(self):
         """ Constuctor"""
@@ -261,6 +317,9 @@ class MbedCambrionix(MbedUsbHub):
         self.port = ''
         # config read from json file describing port mapping
         self.config = {}
+        # data read from the hub but not yet consumed by recv() e.g. the start
+        # of the response to the next command
+        self.rx_buf = ''
         return    
 
     # implementation of parent interface
@@ -282,6 +341,8 @@ class MbedCambrionix(MbedUsbHub):
     def open(self, port = ""):
         """ open a connection to the hub with the cambrionix default values for serial communication"""
     
+        import serial
+
         self.port = port
         self.handle = serial.Serial(
             port=port,
@@ -293,11 +354,16 @@ class MbedCambrionix(MbedUsbHub):
 
         # todo: check that we have a valid handle 
         self.handle.timeout = 0.1
+        self.rx_buf = ''
         self.handle.write('\x03\r')
-        
+
+        # discard whatever the hub output in response to the break, so the
+        # next recv() starts with the response to the next command
+        self.drain()
+
         # check we have a valid system
         sys_data =  self.cmd_system()
-        if sys_data['description'] != self.description:
+        if sys_data.get('description', '') != self.description:
         
             self.close()
         
@@ -312,25 +378,114 @@ class MbedCambrionix(MbedUsbHub):
     
         self.handle.write( str(command) + '\r')
 
-    def recv(self, last_command=''):
+    def drain(self):
         '''
-        reads upto 500 bytes from the serial port
-        
-        last_command 	last command to remove from recv string.	
+        reads and discards data from the serial port until the hub goes quiet
+        i.e. nothing has been received for the serial read timeout.
         '''
-    
-        # for the "state 12" command for example, read command returns string of the form  
+
+        while self.handle.read(size=1):
+            self.handle.read(size=self.handle.inWaiting())
+        self.rx_buf = ''
+
+    def resync(self, timeout=None):
+        '''
+        abandons the line the hub is reading and discards the responses to
+        any commands already written to the hub, so the next recv() starts
+        with the response to the next command.
+
+        timeout         time allowed for the hub to catch up (s). defaults to
+                        RECV_TIMEOUT for each command which may be in flight.
+
+        returns True if the hub caught up within the timeout.
+        '''
+
+        # the responses still to come are skipped up to the prompt following
+        # the echo of RESYNC_COMMAND, which is only written here
+        if timeout is None:
+            timeout = self.RECV_TIMEOUT * (self.PIPELINE_DEPTH + 1)
+        deadline = time.time() + timeout
+
+        self.handle.write('\x03\r' + self.RESYNC_COMMAND + '\r')
+        while time.time() < deadline:
+            index = self.rx_buf.find(self.RESYNC_COMMAND)
+            if index != -1:
+                index = self.rx_buf.find(self.PROMPT, index)
+                if index != -1:
+                    self.rx_buf = self.rx_buf[index+len(self.PROMPT):].lstrip(' ')
+                    return True
+            data = self.handle.read(size=1)
+            if data:
+                data += self.handle.read(size=self.handle.inWaiting())
+                self.rx_buf += data
+
+        self.err("failed to resynchronise with hub on %s" % self.port)
+        self.rx_buf = ''
+        return False
+
+    def recv(self, last_command='', timeout=None):
+        '''
+        reads the response to a command from the serial port, returning as soon
+        as the hub prompt has been received.
+
+        last_command    last command to remove from recv string.
+        timeout         time allowed for the hub to finish responding (s).
+                        defaults to RECV_TIMEOUT.
+
+        returns the command output string, or None if the prompt wasnt
+        received within the timeout.
+        '''
+
+        # for the "state 12" command for example, read command returns string of the form
         #===================================
         #  state 12
-		#  12, 0000, R D O, 0, 0, x, 0.00
-		#
-		#  >>	
+        #  12, 0000, R D O, 0, 0, x, 0.00
+        #
+        #  >>
         #===================================
-        # - to remove the command echo use [len(last_command):]
-        # - to remove the \r\n\r\n>> at the end >> use [:-4]
-        read_val = self.handle.read(size=500).decode('utf-8')[len(last_command):-4]
-        
-        return read_val
+        # - data is read incrementally until the >> prompt arrives, so there
+        #   is no limit on the length of the response and no waiting for the
+        #   serial read timeout to expire once the hub has answered.
+        # - anything received after the prompt (e.g. the response to a
+        #   following command) is kept in rx_buf for the next recv().
+        # - the command echo and the prompt are removed from the returned string.
+        if timeout is None:
+            timeout = self.RECV_TIMEOUT
+        deadline = time.time() + timeout
+
+        index = self.rx_buf.find(self.PROMPT)
+        while index == -1:
+            if time.time() > deadline:
+                # a partial response cant be told apart from a complete one,
+                # so it is discarded and the caller told there was no response
+                self.err("timeout waiting for response to '%s' from hub on %s" % (last_command, self.port))
+                self.rx_buf = ''
+                return None
+
+            # block for upto the serial read timeout for the first byte, then
+            # take whatever else has already arrived
+            data = self.handle.read(size=1)
+            if data:
+                data += self.handle.read(size=self.handle.inWaiting())
+                self.rx_buf += data
+                index = self.rx_buf.find(self.PROMPT)
+
+        read_val = self.rx_buf[:index]
+        self.rx_buf = self.rx_buf[index+len(self.PROMPT):].lstrip(' ')
+
+        return self.parse_response(read_val, last_command)
+
+    @staticmethod
+    def parse_response(read_val, last_command=''):
+        """! remove the command echo from the data received before a prompt and decode it
+
+        @return the command output string
+        """
+        read_val = read_val.lstrip()
+        if last_command and read_val.startswith(last_command):
+            read_val = read_val[len(last_command):]
+
+        return read_val.decode('utf-8', 'replace').strip()
 
     # class methods
 
@@ -344,49 +499,89 @@ class MbedCambrionix(MbedUsbHub):
         
         self.debug(__name__, "cmd_state:port_num=%s" % port_num)
         
-        
-        result = []
-        columns = ['port_num', 'current_ma', 'flags', 'profile_id', 'time_charging', 'time_charged', 'energy']
-        
         if port_num == self.MAX_PORTS:
-            # get all the port data
-        
-            self.send('state')
-            recv_data = self.recv()
-    
-            for line in recv_data.splitlines():
-                line.strip()
-                if not line:
-                    continue
-                
-                num = 0
-                port_data = {}
-                for item in line.split(","):
-                    print item
-                    port_data[columns[num]] = item;
-                    num = num + 1;
-    
-                result.append(port_data)                    
-                
+            # get all the port data with a single state command
+            recv_data = self.do_cmd('state')
         else:
             # get the data for the specific port
-            cmd = "state " + str(port_num+1)
-            line = self.do_cmd(cmd)
+            recv_data = self.do_cmd("state " + str(port_num+1))
 
-            num = 0
-            port_data = {}
-            line.strip()
-            if not line:
-                return result
-                
-            for item in line.split(","):
-                port_data[columns[num]] = item.strip();
-                num = num + 1;
+        if recv_data is None:
+            # the hub didnt respond
+            return []
+        return self.parse_state(recv_data)
+
+    @staticmethod
+    def parse_state(recv_data):
+        """! parse the output of the state command
 
-            result.append(port_data)                    
+        @return list of port data dictionaries as for cmd_state()
+        """
+        result = []
+        columns = MbedCambrionixPortState._fields
+
+        for line in recv_data.splitlines():
+            items = [item.strip() for item in line.split(",")]
+            if len(items) != len(columns) or not items[0].isdigit():
+                # blank line or something other than port data
+                continue
+
+            result.append(dict(zip(columns, items)))
         
         return result
 
+    def port_state_snapshot(self):
+        """! Get the state of all the ports on the hub using a single state command
+
+        @return dictionary of MbedCambrionixPortState records keyed by port number (enumerating from 0)
+        """
+
+        return self.parse_snapshot(self.cmd_state(self.MAX_PORTS))
+
+    def parse_snapshot(self, port_data_list):
+        """! convert a list of cmd_state() port data dictionaries to a port_state_snapshot() dictionary"""
+        snapshot = {}
+        for port_data in port_data_list:
+            try:
+                record = MbedCambrionixPortState.from_port_data(port_data)
+            except ValueError:
+                self.err("failed to parse port data %s" % port_data)
+                continue
+            snapshot[record.port_num] = record
+
+        return snapshot
+
+    @staticmethod
+    def port_state_snapshot_hubs(hubs, hub_locks=None):
+        """! Get the state of all the ports on many hubs, querying the hubs concurrently
+
+        @param hubs         dictionary of open MbedCambrionix instances keyed by hub_id
+        @param hub_locks    optional dictionary of locks keyed by hub_id, held while
+                            the hub is being queried
+        @return dictionary keyed by hub_id of port_state_snapshot() dictionaries
+        """
+
+        result = {}
+
+        def snapshot_hub(hub_id):
+            if hub_locks is not None:
+                with hub_locks[hub_id]:
+                    result[hub_id] = hubs[hub_id].port_state_snapshot()
+            else:
+                result[hub_id] = hubs[hub_id].port_state_snapshot()
+
+        # one thread per hub, so the total time is that of the slowest hub
+        # rather than the sum of all hubs
+        threads = []
+        for hub_id in hubs:
+            thread = threading.Thread(target=snapshot_hub, args=(hub_id,))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        return result
+
     def cmd_system(self):
         """! Execute the system command on the hub
         
@@ -399,9 +594,10 @@ class MbedCambrionix(MbedUsbHub):
         result = {}
         
         self.send('system')
-        recv_data = self.recv()
-        
-        # todo: check returned data is ok
+        recv_data = self.recv('system')
+        if recv_data is None:
+            # the hub didnt respond
+            return result
         
         for line in recv_data.splitlines():
             line.strip()
@@ -475,6 +671,7 @@ class MbedCambrionix(MbedUsbHub):
         @details   ports are enumerated starting at 0.
         @param     num      number of port for which to set the state
         @param     state    state to set the port to i.e. on/off
+        @return    the hub response, or None if the hub didnt respond
         """
 
         ret = ""
@@ -483,14 +680,91 @@ class MbedCambrionix(MbedUsbHub):
             cmd = "mode " + mode_char[state] + ' ' + str(num+1)
             ret = self.do_cmd(cmd)
         elif num == self.MAX_PORTS and state < self.PORT_STATE_MAX:
-            for i in range(0, 12):
-                print i
-                cmd = "mode " + mode_char[state] + ' ' + str(i+1)
-                print cmd
-                ret = self.do_cmd(cmd)
+            acks = self.port_state_set_batch([(i, state) for i in range(0, self.MAX_PORTS)])
+            ret = acks[-1]
 
         return ret        
 
+    def port_state_set_batch(self, ops):
+        """! set the state of many ports, pipelining the mode commands down the serial link
+
+        @details   ports are enumerated starting at 0. Upto PIPELINE_DEPTH commands
+                   are written to the hub before waiting for the first
+                   acknowledgement, so the hub round trip is paid once per
+                   batch rather than once per port. If the hub doesnt
+                   acknowledge a command no more commands are written, and the
+                   link is resynchronised so the responses to the commands
+                   already in flight cant be taken for those of later commands.
+        @param     ops      list of (port_num, state) tuples
+        @return    list of the hub responses, one per op, in the order of ops.
+                   the response is None for the op which timed out and all
+                   the ops after it, which may or may not have been applied.
+        """
+
+        cmds = [self.mode_command(num, state) for (num, state) in ops]
+
+        acks = []
+        sent = 0
+        while len(acks) < len(cmds):
+            # top up the pipeline with as many commands as allowed in one write
+            window = cmds[sent:len(acks)+self.PIPELINE_DEPTH]
+            if window:
+                self.handle.write(''.join([cmd + '\r' for cmd in window]))
+                sent += len(window)
+            ack = self.recv(cmds[len(acks)])
+            if ack is None:
+                self.resync()
+                acks.extend([None] * (len(cmds) - len(acks)))
+                break
+            acks.append(ack)
+
+        return acks
+
+    @staticmethod
+    def mode_command(num, state):
+        """! return the mode command setting port num (enumerating from 0) to state
+
+        @details ValueError is raised if the port number or state is invalid.
+        """
+        if not 0 <= num < MbedCambrionix.MAX_PORTS or not 0 <= state < MbedUsbHub.PORT_STATE_MAX:
+            raise ValueError("invalid port state op (%s, %s)" % (num, state))
+        return "mode " + ['o', 's'][state] + ' ' + str(num+1)
+
+    @staticmethod
+    def port_state_set_hubs(hubs, ops, hub_locks=None):
+        """! set the state of ports on many hubs, driving the hubs concurrently
+
+        @param hubs         dictionary of open MbedCambrionix instances keyed by hub_id
+        @param ops          list of (hub_id, port_num, state) tuples
+        @param hub_locks    optional dictionary of locks keyed by hub_id, held while
+                            the hub is being updated
+        @return dictionary keyed by hub_id of port_state_set_batch() results
+        """
+
+        hub_ops = {}
+        for (hub_id, num, state) in ops:
+            hub_ops.setdefault(hub_id, []).append((num, state))
+
+        result = {}
+
+        def set_hub(hub_id):
+            if hub_locks is not None:
+                with hub_locks[hub_id]:
+                    result[hub_id] = hubs[hub_id].port_state_set_batch(hub_ops[hub_id])
+            else:
+                result[hub_id] = hubs[hub_id].port_state_set_batch(hub_ops[hub_id])
+
+        # one thread per hub, each pipelining the commands for its own hub
+        threads = []
+        for hub_id in hub_ops:
+            thread = threading.Thread(target=set_hub, args=(hub_id,))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        return result
+
     def is_port_num_in_range(self, port_num):
         if port_num >= 0 and port_num < MbedCambrionix.MAX_PORTS:
             return True
@@ -524,16 +798,1525 @@ class MbedCambrionix(MbedUsbHub):
                 
         
 
-class MbedSubrack():
-    """ class for managing multiple cards """
-    
+class MbedCommandFuture():
+    """ the pending response to a command submitted to an MbedHubIoLoop"""
+
+    def __init__(self, command, timeout):
+        """ Constuctor
+
+        @param command  command string sent to the hub
+        @param timeout  time allowed for the response once the command has been sent (s)
+        """
+        self.command = command
+        self.timeout = timeout
+        # time by which the response must have been received, set when the command is written
+        self.deadline = None
+        self.response = None
+        self.error = None
+        self.event = threading.Event()
+
+    def set_result(self, response):
+        """! complete the future with the hub response"""
+        self.response = response
+        self.event.set()
+
+    def set_error(self, error):
+        """! complete the future with an error string"""
+        self.error = error
+        self.event.set()
+
+    def done(self):
+        """! return True if the response (or an error) has been received"""
+        return self.event.is_set()
+
+    def result(self, timeout=None):
+        """! wait for and return the command output
+
+        @details IOError is raised if the command failed, or timeout expired.
+        """
+        if not self.event.wait(timeout):
+            raise IOError("timeout waiting for response to '%s'" % self.command)
+        if self.error is not None:
+            raise IOError(self.error)
+        return self.response
+
+
+class MbedHubIoLoop():
+    """ single thread driving the serial links of many hubs with select(), see is_supported().
+    The caller holds the hub lock from submitting commands until release()."""
+
+    POLL_INTERVAL = 0.5
+
     def __init__(self):
         """ Constuctor"""
+        self.DEBUG_FLAG = False     # Used to enable debug code / prints
+
+        # id(hub) -> dictionary describing the hub serial link
+        self.channels = {}
+        self.lock = threading.Lock()
+        # pipe used to wake the loop when a command is submitted, created by
+        # start() and closed by stop()
+        self.wake_r = None
+        self.wake_w = None
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def debug(self, name, text):
+        """! Prints debug messages
+
+        @param name Called function name
+        @param text Text to be included in debug message
+        """
+        if self.DEBUG_FLAG is True:
+            print 'debug @%s.%s: %s'% (self.__class__.__name__, name, text)
+
+    @staticmethod
+    def is_supported(hub):
+        """! return True if the hub serial port can be driven by the loop"""
+        return os.name == 'posix' and hub.handle is not None and hasattr(hub.handle, 'fileno')
+
+    def start(self):
+        """! start the loop thread. The loop may be restarted after stop()"""
+        if self.thread is not None:
+            return
+        with self.lock:
+            (self.wake_r, self.wake_w) = os.pipe()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """! stop the loop thread, failing any outstanding commands. Does nothing if the loop isnt running"""
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.wake()
+        self.thread.join()
+        self.thread = None
+        with self.lock:
+            for channel in self.channels.values():
+                self.fail_channel(channel, 'io loop stopped')
+            self.channels = {}
+            os.close(self.wake_r)
+            os.close(self.wake_w)
+            self.wake_r = None
+            self.wake_w = None
+
+    def wake(self):
+        """! wake the loop thread, if it is running"""
+        # the pipe is only closed with the lock held, so it cant be closed
+        # (and its descriptor reused) between the check and the write
+        with self.lock:
+            if self.wake_w is not None:
+                os.write(self.wake_w, 'x')
+
+    def submit(self, hub, command, timeout=MbedCambrionix.RECV_TIMEOUT):
+        """! queue a command to be sent to a hub
+
+        @param hub      open MbedCambrionix instance
+        @param command  command string e.g. 'state'
+        @param timeout  time allowed for the response once the command has been sent (s)
+        @return MbedCommandFuture completed with the command output
+        """
+        future = MbedCommandFuture(command, timeout)
+        with self.lock:
+            channel = self.channels.get(id(hub), None)
+            if channel is None:
+                # take over any data already received by the hub instance
+                channel = { 'hub' : hub, 'fd' : hub.handle.fileno(), 'rx_buf' : hub.rx_buf, 'queued' : [], 'in_flight' : [] }
+                hub.rx_buf = ''
+                self.channels[id(hub)] = channel
+            channel['queued'].append(future)
+        self.wake()
+        return future
+
+    def release(self, hub):
+        """! hand the hub serial port back once all its commands have completed"""
+        with self.lock:
+            channel = self.channels.pop(id(hub), None)
+            if channel is not None:
+                self.fail_channel(channel, 'hub released with commands outstanding')
+                hub.rx_buf = channel['rx_buf']
+
+    @staticmethod
+    def fail_channel(channel, error):
+        """! fail all the commands outstanding on a channel. Called with self.lock held"""
+        for future in channel['in_flight'] + channel['queued']:
+            future.set_error(error)
+        channel['in_flight'] = []
+        channel['queued'] = []
+
+    def drop_channel(self, channel, error):
+        """! fail all the commands outstanding on a channel which can no longer be read, and stop driving it. Called with self.lock held"""
+        self.fail_channel(channel, error)
+        self.channels.pop(id(channel['hub']), None)
+
+    def run(self):
+        """! the loop, run by the loop thread until stop() is called"""
+        while not self.stop_event.is_set():
+            now = time.time()
+            read_fds = [self.wake_r]
+            timeout = self.POLL_INTERVAL
+            with self.lock:
+                for channel in self.channels.values():
+                    # top up the pipeline
+                    window = channel['queued'][:channel['hub'].PIPELINE_DEPTH - len(channel['in_flight'])]
+                    if window:
+                        channel['queued'] = channel['queued'][len(window):]
+                        for future in window:
+                            future.deadline = now + future.timeout
+                        channel['in_flight'].extend(window)
+                        try:
+                            channel['hub'].handle.write(''.join([future.command + '\r' for future in window]))
+                        except Exception as e:
+                            self.fail_channel(channel, 'write to hub on %s failed (%s)' % (channel['hub'].port, e))
+                    if channel['in_flight']:
+                        read_fds.append(channel['fd'])
+                        timeout = min(timeout, max(channel['in_flight'][0].deadline - now, 0))
+
+            (readable, writable, exceptional) = select.select(read_fds, [], [], timeout)
+
+            if self.wake_r in readable:
+                os.read(self.wake_r, 4096)
+
+            with self.lock:
+                for channel in self.channels.values():
+                    if channel['fd'] in readable:
+                        self.read_channel(channel)
+                    if channel['in_flight'] and time.time() > channel['in_flight'][0].deadline:
+                        # the responses can no longer be matched to the commands
+                        # so fail them all and discard anything received
+                        self.debug(__name__, "timeout on %s" % channel['hub'].port)
+                        self.fail_channel(channel, "timeout waiting for response to '%s' from hub on %s" % (channel['in_flight'][0].command, channel['hub'].port))
+                        channel['rx_buf'] = ''
+
+    def read_channel(self, channel):
+        """! read the data available from a hub and complete the commands whose responses have arrived"""
+        try:
+            data = os.read(channel['fd'], 4096)
+        except OSError as e:
+            self.drop_channel(channel, 'read from hub on %s failed (%s)' % (channel['hub'].port, e))
+            return
+        if not data:
+            # end of file i.e. the serial port has gone away. The fd would
+            # stay readable forever, so stop selecting on it
+            self.drop_channel(channel, 'hub on %s closed the serial port' % channel['hub'].port)
+            return
+
+        channel['rx_buf'] += data
+        prompt = channel['hub'].PROMPT
+        index = channel['rx_buf'].find(prompt)
+        while index != -1 and channel['in_flight']:
+            future = channel['in_flight'].pop(0)
+            read_val = channel['rx_buf'][:index]
+            channel['rx_buf'] = channel['rx_buf'][index+len(prompt):].lstrip(' ')
+            future.set_result(MbedCambrionix.parse_response(read_val, future.command))
+            index = channel['rx_buf'].find(prompt)
+
+    def acquire_hubs(self, hubs, hub_locks):
+        """! acquire the locks of the hubs, in a fixed order so callers cant deadlock"""
+        if hub_locks is not None:
+            for key in sorted(hubs):
+                hub_locks[key].acquire()
+
+    def release_hubs(self, hubs, hub_locks):
+        """! hand back the hubs and release their locks"""
+        for key in sorted(hubs):
+            self.release(hubs[key])
+            if hub_locks is not None:
+                hub_locks[key].release()
+
+    def port_state_snapshot_hubs(self, hubs, hub_locks=None):
+        """! as MbedCambrionix.port_state_snapshot_hubs(), driving the hubs from the loop thread"""
+        result = {}
+        self.acquire_hubs(hubs, hub_locks)
+        try:
+            futures = dict([(key, self.submit(hubs[key], 'state')) for key in hubs])
+            for key in futures:
+                try:
+                    result[key] = hubs[key].parse_snapshot(MbedCambrionix.parse_state(futures[key].result()))
+                except IOError as e:
+                    hubs[key].err(str(e))
+                    result[key] = {}
+        finally:
+            self.release_hubs(hubs, hub_locks)
+        return result
+
+    def port_state_set_hubs(self, hubs, ops, hub_locks=None):
+        """! as MbedCambrionix.port_state_set_hubs(), driving the hubs from the loop thread"""
+        hub_ops = {}
+        for (key, num, state) in ops:
+            hub_ops.setdefault(key, []).append(MbedCambrionix.mode_command(num, state))
+
+        result = {}
+        used_hubs = dict([(key, hubs[key]) for key in hub_ops])
+        self.acquire_hubs(used_hubs, hub_locks)
+        try:
+            futures = dict([(key, [self.submit(hubs[key], cmd) for cmd in hub_ops[key]]) for key in hub_ops])
+            for key in futures:
+                result[key] = []
+                for future in futures[key]:
+                    try:
+                        result[key].append(future.result())
+                    except IOError as e:
+                        hubs[key].err(str(e))
+                        result[key].append(None)
+        finally:
+            self.release_hubs(used_hubs, hub_locks)
+        return result
+
+
+class MbedUsbTopology():
+    """ index of the subrack and card config files, re-read when they change. Use MbedUsbTopology.get()"""
+
+    # minimum time between checks of the config file modification times (s)
+    CHECK_INTERVAL = 1.0
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, dir_path, subrack_config_filename):
+        """ Constuctor"""
+        self.dir_path = dir_path
+        self.subrack_config_filename = subrack_config_filename
+        self.lock = threading.Lock()
+        self.last_check = 0
+
+        # config file pathname -> modification time when last read
+        self.file_mtimes = {}
+
+        # subrack config read from mbed_usb_hubs.json
+        self.subrack_hubs_config = {}
+        # hub_id -> card config read from the card config file
+        self.subrack_card_config = {}
+
+        # indexes mapping a key to the tuple (hub_id, hub_port_id)
+        self.by_platform_name_unique = {}
+        self.by_target_id = {}
+        self.by_serial_port = {}
+        self.by_mount_point = {}
+        # (hub_id, hub_port_id) -> card config entry for the target
+        self.hub_port_data = {}
+        # hub serial port -> hub_id
+        self.hub_id_by_hub_serial_port = {}
+
+        self.load()
+
+    @classmethod
+    def get(cls):
+        """! get the process wide topology index, creating it on first use"""
+        with cls._instance_lock:
+            instance = cls._instance
+            if instance is None or instance.dir_path != MbedUsbTheApp.DIR_PATH or instance.subrack_config_filename != MbedUsbTheApp.SUBRACK_CONFIG_FILENAME:
+                instance = cls(MbedUsbTheApp.DIR_PATH, MbedUsbTheApp.SUBRACK_CONFIG_FILENAME)
+                cls._instance = instance
+        instance.reload_if_changed()
+        return instance
+
+    @staticmethod
+    def get_mtime(pathname):
+        """! return the modification time of a file, or None if it doesnt exist"""
+        try:
+            return os.stat(pathname).st_mtime
+        except OSError:
+            return None
+
+    def load(self):
+        """! read the subrack and card config files and rebuild the indexes"""
+        file_mtimes = {}
+        subrack_hubs_config = {}
+        subrack_card_config = {}
+
+        subrack_config_pathname = self.dir_path + self.subrack_config_filename
+        file_mtimes[subrack_config_pathname] = self.get_mtime(subrack_config_pathname)
+        if os.path.isfile(subrack_config_pathname):
+            subrack_hubs_config = MbedCambrionix.get_config(subrack_config_pathname)
+
+        for hub_id in subrack_hubs_config:
+            config_file_pathname = self.dir_path + subrack_hubs_config[hub_id]['config_file']
+            file_mtimes[config_file_pathname] = self.get_mtime(config_file_pathname)
+            if os.path.isfile(config_file_pathname):
+                subrack_card_config[hub_id] = MbedCambrionix.get_config(config_file_pathname)
+            else:
+                subrack_card_config[hub_id] = {}
+
+        by_platform_name_unique = {}
+        by_target_id = {}
+        by_serial_port = {}
+        by_mount_point = {}
+        hub_port_data = {}
+        hub_id_by_hub_serial_port = {}
+        for hub_id in subrack_hubs_config:
+            hub_id_by_hub_serial_port[subrack_hubs_config[hub_id]['serial_port'].lower()] = hub_id
+            card_config = subrack_card_config[hub_id]
+            for key in card_config:
+                entry = card_config[key]
+                hub_port = (hub_id, int(entry['hub_port_id']))
+                hub_port_data[hub_port] = entry
+                by_platform_name_unique[entry['platform_name_unique']] = hub_port
+                for target_id_key in ['target_id', 'target_id_usb_id', 'target_id_mbed_htm']:
+                    if entry.get(target_id_key):
+                        by_target_id[entry[target_id_key]] = hub_port
+                if entry.get('serial_port'):
+                    by_serial_port[entry['serial_port'].lower()] = hub_port
+                if entry.get('mount_point'):
+                    by_mount_point[entry['mount_point'].lower()] = hub_port
+
+        # swap in the new indexes in one go so readers never see a partial index
+        with self.lock:
+            self.file_mtimes = file_mtimes
+            self.subrack_hubs_config = subrack_hubs_config
+            self.subrack_card_config = subrack_card_config
+            self.by_platform_name_unique = by_platform_name_unique
+            self.by_target_id = by_target_id
+            self.by_serial_port = by_serial_port
+            self.by_mount_point = by_mount_point
+            self.hub_port_data = hub_port_data
+            self.hub_id_by_hub_serial_port = hub_id_by_hub_serial_port
+            self.last_check = time.time()
+
+    def reload_if_changed(self):
+        """! re-read the config if any of the config files have changed
+
+        @return True if the config was re-read, otherwise False
+        """
+        if time.time() - self.last_check < self.CHECK_INTERVAL:
+            return False
+        self.last_check = time.time()
+
+        for pathname in self.file_mtimes:
+            if self.get_mtime(pathname) != self.file_mtimes[pathname]:
+                self.load()
+                return True
+        return False
+
+    def find(self, platform_name_unique='', target_id='', serial_port='', mount_point=''):
+        """! find a target by any of its identifiers
+
+        @return the tuple (hub_id, hub_port_id), or (None, None) if not found
+        """
+        if platform_name_unique and platform_name_unique in self.by_platform_name_unique:
+            return self.by_platform_name_unique[platform_name_unique]
+        if target_id and target_id in self.by_target_id:
+            return self.by_target_id[target_id]
+        if serial_port and serial_port.lower() in self.by_serial_port:
+            return self.by_serial_port[serial_port.lower()]
+        if mount_point and mount_point.lower() in self.by_mount_point:
+            return self.by_mount_point[mount_point.lower()]
+        return (None, None)
+
+    def get_hub_port_data(self, hub_id, hub_port_id):
+        """! return the card config entry for the target on (hub_id, hub_port_id), or {} if none"""
+        return self.hub_port_data.get((hub_id, hub_port_id), {})
+
+    def get_hub_serial_port(self, hub_id):
+        """! return the serial port of the hub, or '' if hub_id isnt known"""
+        if hub_id in self.subrack_hubs_config:
+            return self.subrack_hubs_config[hub_id]['serial_port']
+        return ''
+
+    def get_hub_id_by_hub_serial_port(self, serial_port):
+        """! return the hub_id of the hub accessed over serial_port, or None if not known"""
+        return self.hub_id_by_hub_serial_port.get(serial_port.lower(), None)
+
+    def get_card_config_file_pathname(self, hub_id):
+        """! return the pathname of the hub card config file, or '' if hub_id isnt known"""
+        if hub_id in self.subrack_hubs_config:
+            return self.dir_path + self.subrack_hubs_config[hub_id]['config_file']
+        return ''
+
+    def platform_name_unique_list(self):
+        """! return the list of platform unique names documented in the card config files"""
+        return self.by_platform_name_unique.keys()
+
+
+class MbedPowerScheduler():
+    """ class for powering on the ports of a hub in sequence so the inrush current doesnt brown it out.
+    Overridden per hub by the subrack config keys power_concurrency, power_stagger,
+    power_current_limit_ma and power_settle_timeout."""
+
+    DEFAULT_CONCURRENCY = 4
+    DEFAULT_STAGGER = 0.1
+    # budget for the current drawn by a whole hub (mA), allowing 12 ports at
+    # their steady state draw with headroom for the inrush of the settling ports
+    # while staying below the 12 x 500mA the hub can supply in sync mode
+    DEFAULT_CURRENT_LIMIT_MA = 4000
+    DEFAULT_SETTLE_TIMEOUT = 2.0
+    # assumed inrush current of a target until one has been measured (mA)
+    DEFAULT_INRUSH_MA = 200
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, stagger=DEFAULT_STAGGER, current_limit_ma=DEFAULT_CURRENT_LIMIT_MA, settle_timeout=DEFAULT_SETTLE_TIMEOUT):
+        """ Constuctor
+
+        @param concurrency          maximum number of ports settling at once per hub, 0 to disable the scheduler
+        @param stagger              minimum time between ports being turned on (s)
+        @param current_limit_ma     maximum current to be drawn by a hub (mA), 0 for no limit
+        @param settle_timeout       maximum time a port is treated as settling (s)
+        """
+        self.DEBUG_FLAG = False     # Used to enable debug code / prints
+
+        self.concurrency = concurrency
+        self.stagger = stagger
+        self.current_limit_ma = current_limit_ma
+        self.settle_timeout = settle_timeout
+
+    def debug(self, name, text):
+        """! Prints debug messages
+
+        @param name Called function name
+        @param text Text to be included in debug message
+        """
+        if self.DEBUG_FLAG is True:
+            print 'debug @%s.%s: %s'% (self.__class__.__name__, name, text)
+
+    def get_hub_params(self, hub_config=None):
+        """! return the tuple (concurrency, stagger, current_limit_ma, settle_timeout) for a hub
+
+        @param hub_config   the entry for the hub in the subrack config
+        """
+        if hub_config is None:
+            hub_config = {}
+        return (int(hub_config.get('power_concurrency', self.concurrency)),
+                float(hub_config.get('power_stagger', self.stagger)),
+                int(hub_config.get('power_current_limit_ma', self.current_limit_ma)),
+                float(hub_config.get('power_settle_timeout', self.settle_timeout)))
+
+    def is_enabled(self, hub_config=None):
+        """! return True if ports on the hub are to be powered on by the scheduler"""
+        return self.get_hub_params(hub_config)[0] > 0
+
+    def power_on_hub(self, hub, ports, hub_lock=None, hub_config=None, responses=None):
+        """! power on ports of a hub in sequence
+
+        @param hub          open MbedCambrionix instance
+        @param ports        list of the ports to power on, enumerating from 0
+        @param hub_lock     optional lock held while commands are sent to the hub
+        @param hub_config   the entry for the hub in the subrack config
+        @param responses    optional dictionary which is filled with the hub
+                            response to turning on each port, keyed by port
+        @return dictionary keyed by port of the time taken for the port to settle (s)
+        """
+        (concurrency, stagger, current_limit_ma, settle_timeout) = self.get_hub_params(hub_config)
+        if concurrency <= 0:
+            concurrency = len(ports)
+        if hub_lock is None:
+            hub_lock = threading.Lock()
+
+        pending = list(ports)
+        # port -> time the port was turned on
+        settling = {}
+        settled = {}
+        inrush_ma = self.DEFAULT_INRUSH_MA
+        measured_inrush = False
+        last_start = 0
+
+        while pending or settling:
+            with hub_lock:
+                snapshot = hub.port_state_snapshot()
+            now = time.time()
+
+            for port in settling.keys():
+                port_state = snapshot.get(port, None)
+                if port_state is not None and port_state.current_ma > 0:
+                    # pace on the largest current seen drawn by a settling port
+                    inrush_ma = port_state.current_ma if not measured_inrush else max(inrush_ma, port_state.current_ma)
+                    measured_inrush = True
+                if (port_state is not None and 'A' in port_state.flags) or now - settling[port] >= settle_timeout:
+                    settled[port] = now - settling.pop(port)
+
+            total_ma = sum([state.current_ma for state in snapshot.values()])
+            while pending and len(settling) < concurrency and now - last_start >= stagger:
+                if current_limit_ma > 0 and total_ma + inrush_ma > current_limit_ma and settling:
+                    # wait for the settling ports to draw less current
+                    break
+                port = pending.pop(0)
+                with hub_lock:
+                    response = hub.port_state_set(port, MbedUsbHub.PORT_STATE_ON)
+                if responses is not None:
+                    responses[port] = response
+                self.debug(__name__, "port %d on, settling=%s total_ma=%d inrush_ma=%d" % (port, sorted(settling), total_ma, inrush_ma))
+                settling[port] = now
+                last_start = now
+                total_ma += inrush_ma
+                if stagger > 0:
+                    break
+
+            if pending or settling:
+                time.sleep(self.POLL_INTERVAL)
+
+        return settled
+
+    def power_on_hubs(self, hubs, ops, hub_locks=None, hub_configs=None):
+        """! power on ports of many hubs, scheduling each hub concurrently
+
+        @param hubs         dictionary of open MbedCambrionix instances keyed by hub_id
+        @param ops          list of (hub_id, port_num) tuples
+        @param hub_locks    optional dictionary of locks keyed by hub_id
+        @param hub_configs  optional dictionary of subrack config hub entries keyed by hub_id
+        @return dictionary keyed by hub_id of power_on_hub() results
+        """
+        hub_ports = {}
+        for (hub_id, num) in ops:
+            hub_ports.setdefault(hub_id, []).append(num)
+
+        result = {}
+
+        def power_on(hub_id):
+            hub_lock = None if hub_locks is None else hub_locks[hub_id]
+            hub_config = None if hub_configs is None else hub_configs.get(hub_id, None)
+            result[hub_id] = self.power_on_hub(hubs[hub_id], hub_ports[hub_id], hub_lock, hub_config)
+
+        threads = []
+        for hub_id in hub_ports:
+            thread = threading.Thread(target=power_on, args=(hub_id,))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        return result
+
+
+class MbedPortStateCache():
+    """ cache of the port states of the hubs of a subrack, with change notification (see subscribe())"""
+
+    DEFAULT_TTL = 0.5
+
+    def __init__(self, subrack_id='0', ttl=DEFAULT_TTL):
+        """ Constuctor
+
+        @param subrack_id   identifier of the subrack, reported in the events
+        @param ttl          time a snapshot is used for before the hub is queried again (s)
+        """
+        self.subrack_id = subrack_id
+        self.ttl = ttl
+        # hub_id -> (timestamp, snapshot)
+        self.snapshots = {}
+        # (hub_id, port_num) -> flags last seen. not removed by invalidate() so
+        # changes made by a set are reported by the next snapshot
+        self.last_flags = {}
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def get(self, hub_id, max_age=None):
+        """! return the cached snapshot of a hub
+
+        @param max_age  maximum age of the snapshot (s), defaults to the ttl
+        @return the snapshot, or None if there isnt one recent enough
+        """
+        if max_age is None:
+            max_age = self.ttl
+        with self.lock:
+            entry = self.snapshots.get(hub_id, None)
+        if entry is None or time.time() - entry[0] >= max_age:
+            return None
+        return entry[1]
+
+    def invalidate(self, hub_id):
+        """! discard the cached snapshot of a hub e.g. because one of its ports has been set"""
+        with self.lock:
+            self.snapshots.pop(hub_id, None)
+
+    def update(self, hub_id, snapshot, timestamp=None):
+        """! store a new snapshot of a hub and notify the listeners of the changes
+
+        @return list of the change events
+        """
+        if timestamp is None:
+            timestamp = time.time()
+
+        events = []
+        with self.lock:
+            entry = self.snapshots.get(hub_id, None)
+            if entry is not None and entry[0] > timestamp:
+                # a more recent snapshot has already been stored
+                return events
+            self.snapshots[hub_id] = (timestamp, snapshot)
+            for port_num in sorted(snapshot):
+                flags = snapshot[port_num].flags
+                old_flags = self.last_flags.get((hub_id, port_num), None)
+                self.last_flags[(hub_id, port_num)] = flags
+                if old_flags is None or set(old_flags) == set(flags):
+                    continue
+                added = sorted(set(flags) - set(old_flags))
+                removed = sorted(set(old_flags) - set(flags))
+                event = 'flags'
+                if 'A' in added:
+                    event = 'attach'
+                elif 'D' in added:
+                    event = 'detach'
+                events.append({ 'subrack_id' : self.subrack_id,
+                                'hub_id' : hub_id,
+                                'port_num' : port_num,
+                                'event' : event,
+                                'flags' : list(flags),
+                                'added' : added,
+                                'removed' : removed,
+                                'timestamp' : timestamp })
+            listeners = list(self.listeners)
+
+        # listeners are called without the lock held so they can use the cache
+        for event in events:
+            for listener in listeners:
+                try:
+                    listener(event)
+                except Exception as e:
+                    sys.stderr.write('Warning: port state listener failed (%s)\n' % e)
+        return events
+
+    def subscribe(self, listener):
+        """! call listener(event) for every port state change
+
+        @param listener     function called with event dictionaries of the form
+            {"subrack_id" : "0", "hub_id" : "1", "port_num" : 3,
+             "event" : "attach" | "detach" | "flags",
+             "flags" : ["R", "A", "S"], "added" : ["A"], "removed" : ["D"],
+             "timestamp" : <time of the snapshot>}
+        """
+        with self.lock:
+            self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        """! stop calling a listener"""
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def has_listeners(self):
+        """! return True if any listeners are subscribed"""
+        with self.lock:
+            return len(self.listeners) > 0
+
+
+class MbedSubrack():
+    """ class for managing multiple cards, opening each hub on first use"""
+    
+    def __init__(self, subrack_id='0', topology=None):
+        """ Constuctor
+
+        @param subrack_id   identifier of the subrack within the rack
+        @param topology     MbedUsbTopology index of the subrack config. Defaults
+                            to the process wide index of mbed_usb_hubs.json.
+        """
         #extra flags
         self.DEBUG_FLAG = False     # Used to enable debug code / prints
         self.ERRORLEVEL_FLAG = 0    # Used to return success code to environment
 
-        self.subrack_hubs_config = {}
+        self.subrack_id = subrack_id
+        self.topology = topology
+        if self.topology is None:
+            self.topology = MbedUsbTopology.get()
+
+        # hub_id -> open MbedCambrionix instance
+        self.hubs = {}
+        # hub_id -> lock serialising commands sent down the hub serial link
+        self.hub_locks = {}
+        # lock protecting self.hubs and self.hub_locks
+        self.lock = threading.Lock()
+        # MbedPowerScheduler used when all the ports of a hub are powered on, or None
+        self.power_scheduler = None
+        self.state_cache = MbedPortStateCache(subrack_id)
+
+    def debug(self, name, text):
+        """! Prints debug messages
+
+        @param name Called function name
+        @param text Text to be included in debug message
+        """
+        if self.DEBUG_FLAG is True:
+            print 'debug @%s.%s: %s'% (self.__class__.__name__, name, text)
+
+    def get_hub_ids(self):
+        """! return the list of hub_ids in the subrack config"""
+        self.topology.reload_if_changed()
+        return sorted(self.topology.subrack_hubs_config, key=MbedUsbTheApp.mbed_usb_natural_sort_key)
+
+    def get_hub(self, hub_id):
+        """! get the hub, opening it if this is the first time its been used
+
+        @return the open MbedCambrionix instance, or None if the hub couldnt be opened
+        """
+        with self.lock:
+            if hub_id in self.hubs:
+                return self.hubs[hub_id]
+
+            serial_port = self.topology.get_hub_serial_port(hub_id)
+            if serial_port == '':
+                return None
+
+            hub = MbedCambrionix()
+            hub.DEBUG_FLAG = self.DEBUG_FLAG
+            try:
+                hub.open(serial_port)
+            except Exception as e:
+                sys.stderr.write('Warning: failed to open hub %s on %s (%s)\n' % (hub_id, serial_port, e))
+                return None
+            if hub.handle is None:
+                sys.stderr.write('Warning: hub %s on %s is not a %s\n' % (hub_id, serial_port, hub.description))
+                return None
+
+            hub.config = self.topology.subrack_card_config.get(hub_id, {})
+            self.hubs[hub_id] = hub
+            self.hub_locks[hub_id] = threading.Lock()
+            self.debug(__name__, "opened subrack_id=%s hub_id=%s serial_port=%s" % (self.subrack_id, hub_id, serial_port))
+            return hub
+
+    def get_hub_lock(self, hub_id):
+        """! return the lock serialising access to an open hub"""
+        with self.lock:
+            return self.hub_locks[hub_id]
+
+    def open_all(self):
+        """! open all the hubs in the subrack config
+
+        @return number of hubs open
+        """
+        for hub_id in self.get_hub_ids():
+            self.get_hub(hub_id)
+        return len(self.hubs)
+
+    def close(self):
+        """! close all the open hubs"""
+        with self.lock:
+            for hub_id in self.hubs:
+                with self.hub_locks[hub_id]:
+                    self.hubs[hub_id].close()
+            self.hubs = {}
+            self.hub_locks = {}
+
+    def find(self, platform_name_unique='', target_id='', serial_port='', mount_point=''):
+        """! find a target by any of its identifiers
+
+        @return the tuple (hub_id, hub_port_id), or (None, None) if not found
+        """
+        self.topology.reload_if_changed()
+        return self.topology.find(platform_name_unique, target_id, serial_port, mount_point)
+
+    def find_hub_id_by_hub_serial_port(self, serial_port):
+        """! return the hub_id of the hub accessed over serial_port, or None if not in this subrack"""
+        return self.topology.get_hub_id_by_hub_serial_port(serial_port)
+
+    def port_state_snapshot(self, hub_id, max_age=None):
+        """! get the state of all the ports of a hub, from the cache if recent enough
+
+        @param max_age  maximum age of a cached snapshot (s), defaults to the cache ttl
+        @return dictionary of MbedCambrionixPortState records keyed by port number,
+                or None if the hub couldnt be opened
+        """
+        snapshot = self.state_cache.get(hub_id, max_age)
+        if snapshot is not None:
+            return snapshot
+
+        hub = self.get_hub(hub_id)
+        if hub is None:
+            return None
+        with self.get_hub_lock(hub_id):
+            timestamp = time.time()
+            snapshot = hub.port_state_snapshot()
+        self.state_cache.update(hub_id, snapshot, timestamp)
+        return snapshot
+
+    def port_state_get(self, hub_id, hub_port_id):
+        """! get the state of a port (MbedUsbHub.PORT_STATE_ON/OFF/MAX)"""
+        snapshot = self.port_state_snapshot(hub_id)
+        if snapshot is None or hub_port_id not in snapshot:
+            return MbedUsbHub.PORT_STATE_MAX
+
+        # as MbedCambrionix.port_state_get()
+        if 'S' in snapshot[hub_port_id].flags:
+            return MbedUsbHub.PORT_STATE_ON
+        elif 'O' in snapshot[hub_port_id].flags:
+            return MbedUsbHub.PORT_STATE_OFF
+        return MbedUsbHub.PORT_STATE_MAX
+
+    def port_state_set(self, hub_id, hub_port_id, state):
+        """! set the state of a port (or all ports if hub_port_id is MAX_PORTS)
+
+        @return the hub response, or None if the hub couldnt be opened or didnt respond
+        """
+        hub = self.get_hub(hub_id)
+        if hub is None:
+            return None
+        hub_config = self.topology.subrack_hubs_config.get(hub_id, {})
+        try:
+            if hub_port_id == MbedCambrionix.MAX_PORTS and state == MbedUsbHub.PORT_STATE_ON and \
+                    self.power_scheduler is not None and self.power_scheduler.is_enabled(hub_config):
+                # as MbedCambrionix.port_state_set(), the response to the last
+                # port, or None if any of the ports didnt respond
+                responses = {}
+                self.power_scheduler.power_on_hub(hub, range(0, MbedCambrionix.MAX_PORTS), self.get_hub_lock(hub_id), hub_config, responses)
+                if None in responses.values():
+                    return None
+                return responses[MbedCambrionix.MAX_PORTS - 1]
+            with self.get_hub_lock(hub_id):
+                return hub.port_state_set(hub_port_id, state)
+        finally:
+            self.state_cache.invalidate(hub_id)
+
+    def port_state_get_by_platform_name_unique(self, platform_name_unique):
+        """! get the state of the port the target is connected to"""
+        (hub_id, hub_port_id) = self.find(platform_name_unique=platform_name_unique)
+        if hub_id is None:
+            return MbedUsbHub.PORT_STATE_MAX
+        return self.port_state_get(hub_id, hub_port_id)
+
+    def port_state_set_by_platform_name_unique(self, platform_name_unique, state):
+        """! set the state of the port the target is connected to
+
+        @return the hub response, or None if the target or hub wasnt found
+        """
+        (hub_id, hub_port_id) = self.find(platform_name_unique=platform_name_unique)
+        if hub_id is None:
+            return None
+        return self.port_state_set(hub_id, hub_port_id, state)
+
+
+class MbedRack():
+    """ class for managing multiple subracks, one per subrack config file"""
+
+    def __init__(self, subrack_config_filenames=None, config_dir=None):
+        """ Constuctor
+
+        @param subrack_config_filenames     list of subrack config file names.
+                                            Defaults to [MbedUsbTheApp.SUBRACK_CONFIG_FILENAME]
+        @param config_dir                   directory of the config files. Defaults to MbedUsbTheApp.DIR_PATH
+        """
+        self.DEBUG_FLAG = False     # Used to enable debug code / prints
+
+        if not subrack_config_filenames:
+            subrack_config_filenames = [MbedUsbTheApp.SUBRACK_CONFIG_FILENAME]
+        # the config file pathnames are made by appending the filename
+        dir_path = MbedUsbTheApp.DIR_PATH if config_dir is None else os.path.join(config_dir, '')
+
+        self.subracks = {}
+        for index in range(0, len(subrack_config_filenames)):
+            if subrack_config_filenames[index] == MbedUsbTheApp.SUBRACK_CONFIG_FILENAME and dir_path == MbedUsbTheApp.DIR_PATH:
+                topology = MbedUsbTopology.get()
+            else:
+                topology = MbedUsbTopology(dir_path, subrack_config_filenames[index])
+            self.subracks[str(index)] = MbedSubrack(str(index), topology)
+        self.set_power_scheduler(MbedPowerScheduler())
+
+        self.watch_thread = None
+        self.watch_stop_event = threading.Event()
+        # MbedHubIoLoop driving rack wide operations, created when first needed
+        self.io_loop = None
+        self.io_loop_lock = threading.Lock()
+
+    def set_power_scheduler(self, power_scheduler):
+        """! set the MbedPowerScheduler used to power on many ports, or None to power them on all at once"""
+        self.power_scheduler = power_scheduler
+        for subrack_id in self.subracks:
+            self.subracks[subrack_id].power_scheduler = power_scheduler
+
+    def set_state_ttl(self, ttl):
+        """! set the time the port states of the hubs are cached for (s)"""
+        for subrack_id in self.subracks:
+            self.subracks[subrack_id].state_cache.ttl = ttl
+
+    def subscribe(self, listener):
+        """! call listener(event) for every port state change in the rack (see MbedPortStateCache)
+
+        @details changes are only seen when the hubs are queried, so call
+        start_watch() to have the hubs polled.
+        """
+        for subrack_id in self.subracks:
+            self.subracks[subrack_id].state_cache.subscribe(listener)
+
+    def unsubscribe(self, listener):
+        """! stop calling a listener"""
+        for subrack_id in self.subracks:
+            self.subracks[subrack_id].state_cache.unsubscribe(listener)
+
+    def start_watch(self, interval=1.0):
+        """! poll the hubs every interval seconds for changes while there are listeners
+
+        @details a hub isnt queried if its cached snapshot is less than interval
+        seconds old e.g. because it has just been queried by the telemetry sampler.
+        """
+        if self.watch_thread is not None:
+            return
+        self.watch_stop_event.clear()
+        self.watch_thread = threading.Thread(target=self.run_watch, args=(interval,))
+        self.watch_thread.daemon = True
+        self.watch_thread.start()
+
+    def stop_watch(self):
+        """! stop polling the hubs"""
+        self.watch_stop_event.set()
+        if self.watch_thread is not None:
+            self.watch_thread.join()
+            self.watch_thread = None
+
+    def run_watch(self, interval):
+        """! poll the hubs until stop_watch() is called"""
+        while not self.watch_stop_event.is_set():
+            for subrack_id in self.get_subrack_ids():
+                subrack = self.subracks[subrack_id]
+                if not subrack.state_cache.has_listeners():
+                    continue
+                for hub_id in subrack.get_hub_ids():
+                    subrack.port_state_snapshot(hub_id, interval)
+            self.watch_stop_event.wait(interval)
+
+    def set_debug(self, debug_flag):
+        """! set the debug flag of the rack and its subracks"""
+        self.DEBUG_FLAG = debug_flag
+        for subrack_id in self.subracks:
+            self.subracks[subrack_id].DEBUG_FLAG = debug_flag
+        if self.power_scheduler is not None:
+            self.power_scheduler.DEBUG_FLAG = debug_flag
+
+    def get_subrack_ids(self):
+        """! return the list of subrack_ids"""
+        return sorted(self.subracks, key=MbedUsbTheApp.mbed_usb_natural_sort_key)
+
+    def open_all(self):
+        """! open all the hubs in all the subracks
+
+        @return number of hubs open
+        """
+        return sum([self.subracks[subrack_id].open_all() for subrack_id in self.subracks])
+
+    def close(self):
+        """! close all the open hubs"""
+        self.stop_watch()
+        if self.io_loop is not None:
+            self.io_loop.stop()
+            self.io_loop = None
+        for subrack_id in self.subracks:
+            self.subracks[subrack_id].close()
+
+    def get_io_loop(self, hubs):
+        """! return the MbedHubIoLoop to drive the hubs with, or None if the hubs must each be driven by a thread"""
+        for key in hubs:
+            if not MbedHubIoLoop.is_supported(hubs[key]):
+                return None
+        with self.io_loop_lock:
+            if self.io_loop is None:
+                self.io_loop = MbedHubIoLoop()
+                self.io_loop.DEBUG_FLAG = self.DEBUG_FLAG
+                self.io_loop.start()
+            return self.io_loop
+
+    def find(self, platform_name_unique='', target_id='', serial_port='', mount_point=''):
+        """! find a target by any of its identifiers
+
+        @return the tuple (subrack, hub_id, hub_port_id), or (None, None, None) if not found
+        """
+        for subrack_id in self.get_subrack_ids():
+            subrack = self.subracks[subrack_id]
+            (hub_id, hub_port_id) = subrack.find(platform_name_unique, target_id, serial_port, mount_point)
+            if hub_id is not None:
+                return (subrack, hub_id, hub_port_id)
+        return (None, None, None)
+
+    def find_hub(self, hub_id=None, usb_hub_com_port='', subrack_id='0'):
+        """! find a hub by hub_id (within subrack subrack_id) or by its serial port
+
+        @return the tuple (subrack, hub_id), or (None, None) if not found
+        """
+        if hub_id is not None:
+            subrack = self.subracks.get(subrack_id, None)
+            if subrack is None or hub_id not in subrack.get_hub_ids():
+                return (None, None)
+            return (subrack, hub_id)
+
+        for subrack_id in self.get_subrack_ids():
+            subrack = self.subracks[subrack_id]
+            hub_id = subrack.find_hub_id_by_hub_serial_port(usb_hub_com_port)
+            if hub_id is not None:
+                return (subrack, hub_id)
+        return (None, None)
+
+    def get_hubs(self):
+        """! open all the hubs and return them with their locks
+
+        @return the tuple (hubs, hub_locks) of dictionaries keyed by (subrack_id, hub_id)
+        """
+        hubs = {}
+        hub_locks = {}
+        for subrack_id in self.subracks:
+            subrack = self.subracks[subrack_id]
+            for hub_id in subrack.get_hub_ids():
+                hub = subrack.get_hub(hub_id)
+                if hub is not None:
+                    hubs[(subrack_id, hub_id)] = hub
+                    hub_locks[(subrack_id, hub_id)] = subrack.get_hub_lock(hub_id)
+        return (hubs, hub_locks)
+
+    def port_state_snapshot(self):
+        """! get the state of all the ports on all the hubs, querying the hubs concurrently
+
+        @return dictionary keyed by (subrack_id, hub_id) of MbedCambrionix.port_state_snapshot() dictionaries
+        """
+        (hubs, hub_locks) = self.get_hubs()
+        timestamp = time.time()
+        io_loop = self.get_io_loop(hubs)
+        if io_loop is not None:
+            snapshots = io_loop.port_state_snapshot_hubs(hubs, hub_locks)
+        else:
+            snapshots = MbedCambrionix.port_state_snapshot_hubs(hubs, hub_locks)
+        for (subrack_id, hub_id) in snapshots:
+            self.subracks[subrack_id].state_cache.update(hub_id, snapshots[(subrack_id, hub_id)], timestamp)
+        return snapshots
+
+    def port_state_set_batch(self, ops):
+        """! set the state of many ports, driving the hubs concurrently
+
+        @param ops  list of (subrack, hub_id, hub_port_id, state) tuples. hub_port_id
+                    may be MAX_PORTS to set all the ports on the hub.
+        @return number of ports set
+        """
+        hubs = {}
+        hub_locks = {}
+        hub_configs = {}
+        hub_ops = []
+        for (subrack, hub_id, hub_port_id, state) in ops:
+            key = (subrack.subrack_id, hub_id)
+            if key not in hubs:
+                hub = subrack.get_hub(hub_id)
+                if hub is None:
+                    continue
+                hubs[key] = hub
+                hub_locks[key] = subrack.get_hub_lock(hub_id)
+                hub_configs[key] = subrack.topology.subrack_hubs_config.get(hub_id, {})
+            if hub_port_id == MbedCambrionix.MAX_PORTS:
+                hub_ops.extend([(key, num, state) for num in range(0, MbedCambrionix.MAX_PORTS)])
+            else:
+                hub_ops.append((key, hub_port_id, state))
+
+        # ports being turned on are sequenced by the power scheduler (if enabled
+        # for the hub) after the other ports have been set
+        immediate_ops = []
+        scheduled_ops = []
+        for (key, num, state) in hub_ops:
+            if state == MbedUsbHub.PORT_STATE_ON and self.power_scheduler is not None and self.power_scheduler.is_enabled(hub_configs[key]):
+                scheduled_ops.append((key, num))
+            else:
+                immediate_ops.append((key, num, state))
+        try:
+            io_loop = self.get_io_loop(hubs)
+            if io_loop is not None:
+                io_loop.port_state_set_hubs(hubs, immediate_ops, hub_locks)
+            else:
+                MbedCambrionix.port_state_set_hubs(hubs, immediate_ops, hub_locks)
+            if scheduled_ops:
+                self.power_scheduler.power_on_hubs(hubs, scheduled_ops, hub_locks, hub_configs)
+        finally:
+            for (subrack_id, hub_id) in hubs:
+                self.subracks[subrack_id].state_cache.invalidate(hub_id)
+        return len(hub_ops)
+
+    def port_state_set_all(self, state):
+        """! set the state of all the ports on all the hubs
+
+        @return number of ports set
+        """
+        ops = []
+        for subrack_id in self.subracks:
+            subrack = self.subracks[subrack_id]
+            for hub_id in subrack.get_hub_ids():
+                ops.append((subrack, hub_id, MbedCambrionix.MAX_PORTS, state))
+        return self.port_state_set_batch(ops)
+
+
+class MbedBootTimes():
+    """ persistent histograms of the time taken by targets to enumerate after power on. Use MbedBootTimes.get()"""
+
+    BOOT_TIMES_FILENAME = 'mbed_usb_boot_times.json'
+
+    # upper bounds of the histogram buckets (s). The last bucket counts times above BUCKET_BOUNDS[-1]
+    BUCKET_BOUNDS = [0.25, 0.5, 0.75, 1, 1.5, 2, 2.5, 3, 4, 5, 6, 8, 10, 12, 15, 20, 25, 30, 45, 60]
+
+    # number of samples needed before a histogram is used to derive a wait
+    MIN_SAMPLES = 5
+    DEFAULT_PERCENTILE = 99
+    # the derived wait is the percentile multiplied by WAIT_MARGIN, and no less than MIN_WAIT (s)
+    WAIT_MARGIN = 1.5
+    MIN_WAIT = 1.0
+
+    # number of pending samples, or time since the last flush (s), causing a flush
+    FLUSH_SAMPLES = 20
+    FLUSH_INTERVAL = 60.0
+    # time allowed to take the lock file (s), and the age after which a lock
+    # file is taken to have been left behind by a process which died (s)
+    LOCK_TIMEOUT = 5.0
+    LOCK_STALE = 30.0
+    LOCK_POLL_INTERVAL = 0.05
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, pathname):
+        """ Constuctor
+
+        @param pathname     pathname of the json file holding the histograms
+        """
+        self.DEBUG_FLAG = False     # Used to enable debug code / prints
+
+        self.pathname = pathname
+        self.lock = threading.Lock()
+        # held while merging the pending samples into the file
+        self.flush_lock = threading.Lock()
+        self.histograms = self.load()
+        # list of (kind, key, elapsed) samples not yet written to the file
+        self.pending = []
+        self.last_flush = time.time()
+
+    @classmethod
+    def get(cls, dir_path=None):
+        """! get the process wide boot time histograms, creating them on first use
+
+        @param dir_path     directory of the boot times file, by default MbedUsbTheApp.DIR_PATH
+        """
+        with cls._instance_lock:
+            pathname = (dir_path or MbedUsbTheApp.DIR_PATH) + cls.BOOT_TIMES_FILENAME
+            if cls._instance is None or cls._instance.pathname != pathname:
+                if cls._instance is None:
+                    atexit.register(cls.flush_instance)
+                else:
+                    cls._instance.flush()
+                cls._instance = cls(pathname)
+            return cls._instance
+
+    @classmethod
+    def flush_instance(cls):
+        """! write the samples pending in the process wide instance, if there is one"""
+        instance = cls._instance
+        if instance is not None:
+            instance.flush()
+
+    def debug(self, name, text):
+        """! Prints debug messages
+
+        @param name Called function name
+        @param text Text to be included in debug message
+        """
+        if self.DEBUG_FLAG is True:
+            print 'debug @%s.%s: %s'% (self.__class__.__name__, name, text)
+
+    def load(self):
+        """! read the histograms from the file
+
+        @return dictionary {'platforms' : {platform_name : histogram}, 'ports' : {port_key : histogram}}
+                where histogram is {'counts' : [...], 'max' : t}
+        """
+        histograms = {'platforms' : {}, 'ports' : {}}
+        try:
+            with open(self.pathname, 'r') as data_file:
+                data = json.load(data_file)
+            for kind in histograms:
+                for (key, histogram) in data.get(kind, {}).items():
+                    if len(histogram.get('counts', [])) == len(self.BUCKET_BOUNDS) + 1:
+                        histograms[kind][key] = histogram
+        except IOError:
+            pass
+        except ValueError:
+            sys.stderr.write('Warning: ignoring corrupt boot times file %s\n' % self.pathname)
+        return histograms
+
+    def save(self, histograms):
+        """! write the histograms to the file, replacing it in one step so readers never see a partial file"""
+        tmp_pathname = '%s.%d.tmp' % (self.pathname, os.getpid())
+        try:
+            with open(tmp_pathname, 'w') as data_file:
+                json.dump(histograms, data_file, indent=4, sort_keys=True)
+            if os.name != 'posix' and os.path.exists(self.pathname):
+                # rename doesnt replace an existing file on windows
+                os.remove(self.pathname)
+            os.rename(tmp_pathname, self.pathname)
+        except (IOError, OSError) as e:
+            sys.stderr.write('Warning: failed to write boot times file %s (%s)\n' % (self.pathname, e))
+
+    @staticmethod
+    def get_port_key(hub_serial_port, hub_port_id):
+        """! return the key of the histogram of a hub port e.g. COM51:3"""
+        return '%s:%s' % (hub_serial_port, hub_port_id)
+
+    def lock_file(self):
+        """! take the lock file serialising updates of the file between processes
+
+        @return True if the lock was taken, False if it couldnt be within LOCK_TIMEOUT
+        """
+        lock_pathname = self.pathname + '.lock'
+        deadline = time.time() + self.LOCK_TIMEOUT
+        while True:
+            try:
+                fd = os.open(lock_pathname, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, str(os.getpid()))
+                os.close(fd)
+                return True
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    sys.stderr.write('Warning: failed to create lock file %s (%s)\n' % (lock_pathname, e))
+                    return False
+            try:
+                if time.time() - os.path.getmtime(lock_pathname) > self.LOCK_STALE:
+                    self.debug(__name__, "removing stale lock file %s" % lock_pathname)
+                    os.remove(lock_pathname)
+                    continue
+            except OSError:
+                # released since the attempt to create it
+                continue
+            if time.time() > deadline:
+                return False
+            time.sleep(self.LOCK_POLL_INTERVAL)
+
+    def unlock_file(self):
+        """! release the lock file taken by lock_file()"""
+        try:
+            os.remove(self.pathname + '.lock')
+        except OSError:
+            pass
+
+    def flush(self):
+        """! merge the pending samples into the file
+
+        @details the file is re-read holding the lock file, so the samples
+        recorded by other processes since it was last read arent lost, and the
+        in memory histograms are replaced by the merged ones. If the lock file
+        cant be taken the samples are kept for the next flush.
+        """
+        with self.flush_lock:
+            with self.lock:
+                pending = self.pending
+                self.pending = []
+                self.last_flush = time.time()
+            if not pending:
+                return
+
+            if not self.lock_file():
+                sys.stderr.write('Warning: failed to lock boot times file %s, will retry\n' % self.pathname)
+                with self.lock:
+                    self.pending = pending + self.pending
+                return
+            try:
+                histograms = self.load()
+                for (kind, key, elapsed) in pending:
+                    self.add(histograms, kind, key, elapsed)
+                self.save(histograms)
+            finally:
+                self.unlock_file()
+
+            with self.lock:
+                # include the samples recorded during the flush
+                for (kind, key, elapsed) in self.pending:
+                    self.add(histograms, kind, key, elapsed)
+                self.histograms = histograms
+
+    def add(self, histograms, kind, key, elapsed):
+        """! add a sample to a histogram of histograms"""
+        histogram = histograms[kind].setdefault(key, {'counts' : [0] * (len(self.BUCKET_BOUNDS) + 1), 'max' : 0.0})
+        bucket = len(self.BUCKET_BOUNDS)
+        for index in range(0, len(self.BUCKET_BOUNDS)):
+            if elapsed <= self.BUCKET_BOUNDS[index]:
+                bucket = index
+                break
+        histogram['counts'][bucket] += 1
+        histogram['max'] = max(histogram['max'], elapsed)
+
+    def record(self, platform_name, port_key, elapsed):
+        """! record the time a target took to enumerate after power on
+
+        @param platform_name    platform_name of the target e.g. K64F, or '' if not known
+        @param port_key         key of the hub port (see get_port_key()), or '' if not known
+        @param elapsed          time from power on to the target being usable (s)
+        """
+        self.debug(__name__, "%s %s %.2fs" % (platform_name, port_key, elapsed))
+        with self.lock:
+            for (kind, key) in [('platforms', platform_name), ('ports', port_key)]:
+                if key:
+                    self.add(self.histograms, kind, key, elapsed)
+                    self.pending.append((kind, key, elapsed))
+            due = len(self.pending) >= self.FLUSH_SAMPLES or time.time() - self.last_flush >= self.FLUSH_INTERVAL
+        if due:
+            self.flush()
+
+    @classmethod
+    def get_count(cls, histogram):
+        """! return the number of samples in a histogram"""
+        return sum(histogram['counts'])
+
+    @classmethod
+    def percentile(cls, histogram, percent):
+        """! return the upper bound of the bucket holding the nearest rank percentile of a histogram (s)"""
+        rank = max(int(math.ceil(percent / 100.0 * cls.get_count(histogram))), 1)
+        total = 0
+        for index in range(0, len(histogram['counts'])):
+            total += histogram['counts'][index]
+            if total >= rank:
+                if index < len(cls.BUCKET_BOUNDS):
+                    return min(cls.BUCKET_BOUNDS[index], histogram['max'])
+                return histogram['max']
+        return histogram['max']
+
+    def get_histogram(self, platform_name, port_key):
+        """! return the histogram for a target, preferring the hub port over the platform
+
+        @return the histogram, or None if neither has MIN_SAMPLES samples
+        """
+        with self.lock:
+            for (kind, key) in [('ports', port_key), ('platforms', platform_name)]:
+                histogram = self.histograms[kind].get(key, None)
+                if histogram is not None and self.get_count(histogram) >= self.MIN_SAMPLES:
+                    return histogram
+        return None
+
+    def get_wait(self, platform_name, port_key, default, percent=DEFAULT_PERCENTILE):
+        """! return the time to allow for a target to enumerate after power on
+
+        @param default  time returned if there are too few samples for the target (s)
+        @param percent  percentile of the boot times the wait is derived from
+        @return the wait (s)
+        """
+        histogram = self.get_histogram(platform_name, port_key)
+        if histogram is None:
+            return default
+        return max(self.percentile(histogram, percent) * self.WAIT_MARGIN, self.MIN_WAIT)
+
+    def get_wait_port(self, topology, hub_id, hub_port_id, default, percent=DEFAULT_PERCENTILE):
+        """! as get_wait(), for the target on a hub port"""
+        hub_port_data = topology.get_hub_port_data(hub_id, hub_port_id)
+        port_key = self.get_port_key(topology.get_hub_serial_port(hub_id), hub_port_id)
+        return self.get_wait(hub_port_data.get('platform_name', ''), port_key, default, percent)
+
+    def record_port(self, topology, hub_id, hub_port_id, elapsed):
+        """! as record(), for the target on a hub port"""
+        hub_port_data = topology.get_hub_port_data(hub_id, hub_port_id)
+        port_key = self.get_port_key(topology.get_hub_serial_port(hub_id), hub_port_id)
+        self.record(hub_port_data.get('platform_name', ''), port_key, elapsed)
+
+    def report(self):
+        """! print a table of the boot time percentiles"""
+        print "%-32s %8s %8s %8s %8s %8s" % ('platform/port', 'samples', 'p50_s', 'p99_s', 'max_s', 'wait_s')
+        for kind in ['platforms', 'ports']:
+            for key in sorted(self.histograms[kind], key=MbedUsbTheApp.mbed_usb_natural_sort_key):
+                histogram = self.histograms[kind][key]
+                wait = max(self.percentile(histogram, self.DEFAULT_PERCENTILE) * self.WAIT_MARGIN, self.MIN_WAIT)
+                print "%-32s %8d %8.2f %8.2f %8.2f %8.2f" % (key, self.get_count(histogram), self.percentile(histogram, 50),
+                                                             self.percentile(histogram, self.DEFAULT_PERCENTILE), histogram['max'], wait)
+
+
+class MbedTargetReadiness():
+    """ class for waiting for a target to enumerate after power on, or to go away after power off"""
+
+    # time between checks for the target (s)
+    POLL_INTERVAL = 0.2
+
+    # time to wait for a target without recorded boot times (s)
+    DEFAULT_TIMEOUT = 30
+
+    SERIAL_BY_ID_DIR = '/dev/serial/by-id'
+
+    def __init__(self, hub_port_data):
+        """ Constuctor
+
+        @param hub_port_data    card config entry for the target
+        """
+        self.target_ids = []
+        for key in ['target_id', 'target_id_usb_id']:
+            if hub_port_data.get(key):
+                self.target_ids.append(hub_port_data[key])
+        self.mbeds = None
+
+    def serial_node_present(self):
+        """! check for the target usb serial device node
+
+        @return True/False if the device node is present/absent, or None if it
+                cant be determined on this host
+        """
+        if not os.path.isdir(self.SERIAL_BY_ID_DIR):
+            return None
+
+        for name in os.listdir(self.SERIAL_BY_ID_DIR):
+            for target_id in self.target_ids:
+                if target_id.lower() in name.lower():
+                    return True
+        return False
+
+    def mbedls_present(self):
+        """! check mbed_lstools for the target with both serial port and mount point
+
+        @return True if the target is present and usable, otherwise False
+        """
+        if self.mbeds is None:
+            import mbed_lstools
+            self.mbeds = mbed_lstools.create()
+
+        for mbed in self.mbeds.list_mbeds():
+            if mbed.get('target_id') in self.target_ids or mbed.get('target_id_usb_id') in self.target_ids:
+                if mbed.get('serial_port') and mbed.get('mount_point'):
+                    return True
+        return False
+
+    def is_ready(self, state):
+        """! check if the target is in the state expected after setting the port to state"""
+        node_present = self.serial_node_present()
+        if state == MbedUsbHub.PORT_STATE_ON:
+            if node_present is False:
+                return False
+            return self.mbedls_present()
+
+        if node_present is True:
+            return False
+        return not self.mbedls_present()
+
+    def wait(self, state, timeout):
+        """! wait for the target to reach the state expected after setting the port to state
+
+        @param state    MbedUsbHub.PORT_STATE_ON or MbedUsbHub.PORT_STATE_OFF
+        @param timeout  maximum time to wait (s)
+        @return the tuple (ready, elapsed) where ready is True if the target
+                reached the state before the timeout, and elapsed is the time waited (s).
+        """
+        start = time.time()
+        while True:
+            if self.is_ready(state):
+                return (True, time.time() - start)
+            if time.time() - start >= timeout:
+                return (False, time.time() - start)
+            time.sleep(self.POLL_INTERVAL)
+
+    @staticmethod
+    def wait_port(topology, hub_id, hub_port_id, state, timeout):
+        """! wait for the target on a hub port to reach the state expected after setting the port to state
+
+        @details if the target on the port isnt in the card config (or has no
+        target_id) its presence cant be detected, so nothing is waited and the
+        readiness is reported as unknown.
+        The boot times of targets which enumerate are recorded in MbedBootTimes.
+        @param timeout  maximum time to wait (s), or None to derive it from the
+                        boot times of the target (see MbedBootTimes.get_wait())
+        @return the tuple (ready, elapsed) as for wait(), with ready None if the
+                readiness of the target cant be detected
+        """
+        hub_port_data = topology.get_hub_port_data(hub_id, hub_port_id)
+        if not hub_port_data:
+            return (None, 0.0)
+        readiness = MbedTargetReadiness(hub_port_data)
+        if not readiness.target_ids:
+            return (None, 0.0)
+
+        (ready, elapsed) = readiness.wait(state, MbedTargetReadiness.get_timeout(topology, hub_id, hub_port_id, state, timeout))
+        if ready and state == MbedUsbHub.PORT_STATE_ON:
+            MbedBootTimes.get(topology.dir_path).record_port(topology, hub_id, hub_port_id, elapsed)
+        return (ready, elapsed)
+
+    @staticmethod
+    def get_timeout(topology, hub_id, hub_port_id, state, timeout):
+        """! return the time wait_port() waits for the target on a hub port (s)
+
+        @param timeout  maximum time to wait (s), or None to derive it from the boot times of the target
+        """
+        if timeout is not None:
+            return timeout
+        if state == MbedUsbHub.PORT_STATE_ON:
+            return MbedBootTimes.get(topology.dir_path).get_wait_port(topology, hub_id, hub_port_id, MbedTargetReadiness.DEFAULT_TIMEOUT)
+        return MbedTargetReadiness.DEFAULT_TIMEOUT
+
 
 class MbedUsbTheApp():
     """ app class for this application"""
@@ -582,6 +2365,7 @@ class MbedUsbTheApp():
         """
         
         if test_num == 1:
+            import mbed_lstools
             mbeds = mbed_lstools.create()
             #d1 = mbeds.list_mbeds_ext()
             #print d1 
@@ -602,6 +2386,9 @@ class MbedUsbTheApp():
     
         @details Add new command line options here to control 'mbed_usb' command line iterface
         """
+        from mbed_usb_daemon import MbedUsbDaemon, MbedPortLeaseManager
+        from mbed_usb_telemetry import MbedUsbTelemetrySampler
+
         parser = optparse.OptionParser()
     
         parser.add_option('-g', '--get',
@@ -639,14 +2426,49 @@ class MbedUsbTheApp():
                           type ='int',
                           dest='sleep_on',
                           default=0,
-                          help='time to sleep after setting port on (s)(allows time for OS to instantiate port)')
+                          help='maximum time to wait after setting port on for the target serial port and mount point to appear (s)(allows time for OS to instantiate port). Slept in full if the target_id isnt known or with --no_wait_ready')
     
         parser.add_option('-f', '--sleep_off',
                           type ='int',
                           dest='sleep_off',
                           default=0,
-                          help='time to sleep after setting port off (s)(allows time for OS to de-instantiate port')
+                          help='maximum time to wait after setting port off for the target serial port and mount point to disappear (s)(allows time for OS to de-instantiate port). Slept in full if the target_id isnt known or with --no_wait_ready')
     
+        parser.add_option('-w', '--wait_ready',
+                          dest='wait_ready',
+                          default=True,
+                          action="store_true",
+                          help='after setting the port on/off return as soon as the target serial port and mount point have appeared/disappeared (the default)')
+
+        parser.add_option('--no_wait_ready',
+                          dest='wait_ready',
+                          action="store_false",
+                          help='after setting the port on/off sleep for the whole of sleep_on/sleep_off rather than waiting for the target')
+
+        parser.add_option('--wait_timeout',
+                          type ='int',
+                          dest='wait_timeout',
+                          default=None,
+                          help='maximum time to wait for the target (s), by default sleep_on/sleep_off')
+
+        parser.add_option('--adaptive_wait',
+                          dest='adaptive_wait',
+                          default=False,
+                          action="store_true",
+                          help='derive the maximum time to wait (or with --no_wait_ready the time to sleep) after setting a port on from the recorded boot times of the target, rather than using --sleep_on (or --wait_timeout)')
+
+        parser.add_option('--boot_percentile',
+                          type ='int',
+                          dest='boot_percentile',
+                          default=MbedBootTimes.DEFAULT_PERCENTILE,
+                          help='percentile of the recorded boot times used by --adaptive_wait (default %d)' % MbedBootTimes.DEFAULT_PERCENTILE)
+
+        parser.add_option('--boot_times',
+                          dest='boot_times',
+                          default=False,
+                          action="store_true",
+                          help='print the boot times recorded for each platform and hub port when waiting for targets after setting ports on')
+
         parser.add_option('-x', '--sys_up',
                           dest='sys_up',
                           default=False,
@@ -671,12 +2493,175 @@ class MbedUsbTheApp():
                           action="store_true",
                           help='list platform unique names documented in json file')
 
+        parser.add_option('--lookup',
+                          dest ='lookup',
+                          default=False,
+                          action="store_true",
+                          help='print the config of the target specified by --platform_name_unique (hub, port, serial port, mount point) as json')
+
         parser.add_option('--platform_name_unique',
                           type ='string',
                           dest ='platform_name_unique',
                           default="",
                           help='platform unique name')
 
+        parser.add_option('--state',
+                          dest ='state',
+                          default=False,
+                          action="store_true",
+                          help='dump the state of all the hub ports')
+
+        parser.add_option('--all_hubs',
+                          dest ='all_hubs',
+                          default=False,
+                          action="store_true",
+                          help='used with --set to set all the ports on all the hubs documented in json file')
+
+        parser.add_option('--commission',
+                          dest ='commission',
+                          default=False,
+                          action="store_true",
+                          help='discover which port each target is connected to and write the card config json files (all hubs, or the hub specified with --usb_hub_com_port)')
+
+        parser.add_option('--daemon',
+                          dest ='daemon',
+                          default=False,
+                          action="store_true",
+                          help='run as a daemon keeping the hub connections open and serving get/set/state requests over a unix socket')
+
+        parser.add_option('--daemon_socket',
+                          type ='string',
+                          dest ='daemon_socket',
+                          default=MbedUsbDaemon.DEFAULT_SOCKET_PATH,
+                          help='path of the daemon unix socket (default %s)' % MbedUsbDaemon.DEFAULT_SOCKET_PATH)
+
+        parser.add_option('--config_dir',
+                          type ='string',
+                          dest ='config_dir',
+                          default=MbedUsbTheApp.DIR_PATH,
+                          help='directory holding the subrack and card config files and the boot times file (default %s)' % MbedUsbTheApp.DIR_PATH)
+
+        parser.add_option('--subrack_config',
+                          type ='string',
+                          dest ='subrack_config',
+                          default=[],
+                          action="append",
+                          help='subrack config file in --config_dir describing the hubs of a subrack. Repeat for each subrack in the rack (default %s)' % MbedUsbTheApp.SUBRACK_CONFIG_FILENAME)
+
+        parser.add_option('--state_ttl',
+                          type ='float',
+                          dest ='state_ttl',
+                          default=MbedPortStateCache.DEFAULT_TTL,
+                          help='time the daemon caches the port states for in seconds, 0 to always query the hubs (default %s)' % MbedPortStateCache.DEFAULT_TTL)
+
+        parser.add_option('--watch',
+                          dest ='watch',
+                          default=False,
+                          action="store_true",
+                          help='print the port attach/detach and flag changes as they happen, until interrupted')
+
+        parser.add_option('--watch_interval',
+                          type ='float',
+                          dest ='watch_interval',
+                          default=MbedUsbDaemon.WATCH_INTERVAL,
+                          help='time between polls of the hubs for changes in seconds (default %s)' % MbedUsbDaemon.WATCH_INTERVAL)
+
+        parser.add_option('--power_concurrency',
+                          type ='int',
+                          dest ='power_concurrency',
+                          default=MbedPowerScheduler.DEFAULT_CONCURRENCY,
+                          help='when powering on many ports, the maximum number of ports per hub powering up at once. 0 powers them all on at once (default %d)' % MbedPowerScheduler.DEFAULT_CONCURRENCY)
+
+        parser.add_option('--power_stagger',
+                          type ='float',
+                          dest ='power_stagger',
+                          default=MbedPowerScheduler.DEFAULT_STAGGER,
+                          help='when powering on many ports, the minimum time between ports on a hub being turned on in seconds (default %s)' % MbedPowerScheduler.DEFAULT_STAGGER)
+
+        parser.add_option('--power_current_limit',
+                          type ='int',
+                          dest ='power_current_limit',
+                          default=MbedPowerScheduler.DEFAULT_CURRENT_LIMIT_MA,
+                          help='when powering on many ports, the maximum current to be drawn from a hub in mA. 0 for no current limit, so only --power_concurrency and --power_stagger pace the ports (default %d)' % MbedPowerScheduler.DEFAULT_CURRENT_LIMIT_MA)
+
+        parser.add_option('--lease',
+                          type ='string',
+                          dest ='lease',
+                          default="",
+                          help='lease the port of the target for exclusive use by the specified owner (e.g. job name) and print the lease_id. requires the daemon')
+
+        parser.add_option('--lease_duration',
+                          type ='float',
+                          dest ='lease_duration',
+                          default=MbedPortLeaseManager.DEFAULT_DURATION,
+                          help='time before the lease expires in seconds (default %d)' % MbedPortLeaseManager.DEFAULT_DURATION)
+
+        parser.add_option('--lease_wait',
+                          type ='float',
+                          dest ='lease_wait',
+                          default=0,
+                          help='time to wait for the port to be released by another owner in seconds (default 0)')
+
+        parser.add_option('--lease_id',
+                          type ='string',
+                          dest ='lease_id',
+                          default="",
+                          help='lease_id printed by --lease, used with --set to control a leased port (or with --all_hubs to set all the ports while holding the lease), or with --renew or --release')
+
+        parser.add_option('--renew',
+                          dest ='renew',
+                          default=False,
+                          action="store_true",
+                          help='extend the lease specified with --lease_id to expire --lease_duration seconds from now')
+
+        parser.add_option('--release',
+                          dest ='release',
+                          default=False,
+                          action="store_true",
+                          help='release the lease specified with --lease_id')
+
+        parser.add_option('--telemetry',
+                          type ='string',
+                          dest ='telemetry',
+                          default="",
+                          help='sample the current drawn by all the hub ports, appending the samples to the specified time series file. Use with --daemon to sample while serving requests')
+
+        parser.add_option('--telemetry_interval',
+                          type ='float',
+                          dest ='telemetry_interval',
+                          default=MbedUsbTelemetrySampler.DEFAULT_INTERVAL,
+                          help='time between telemetry samples of a hub in seconds (default %s)' % MbedUsbTelemetrySampler.DEFAULT_INTERVAL)
+
+        parser.add_option('--telemetry_duration',
+                          type ='float',
+                          dest ='telemetry_duration',
+                          default=0,
+                          help='time to sample for in seconds (default 0 i.e. until interrupted)')
+
+        parser.add_option('--telemetry_dump',
+                          type ='string',
+                          dest ='telemetry_dump',
+                          default="",
+                          help='print the samples in the specified telemetry time series file')
+
+        parser.add_option('--batch',
+                          type ='string',
+                          dest ='batch',
+                          default="",
+                          help='perform the operations in the specified script file (- for stdin), writing a json line with the result of each (see MbedUsbBatch)')
+
+        parser.add_option('--batch_stop_on_error',
+                          dest ='batch_stop_on_error',
+                          default=False,
+                          action="store_true",
+                          help='stop the --batch script at the first operation which fails')
+
+        parser.add_option('--no_daemon',
+                          dest ='no_daemon',
+                          default=False,
+                          action="store_true",
+                          help='talk to the hub directly even if a daemon is running')
+
         # todo: fix ugly hack:
         if not self.imported:
             (opts, args) = parser.parse_args()
@@ -691,9 +2676,60 @@ class MbedUsbTheApp():
     
         @details Function exits back to command line with ERRORLEVEL
         """
+        from mbed_usb_daemon import MbedUsbDaemonClient
         
         (self.opts, self.args) = self.mbed_usb_cmd_parser_setup()
+        self.DEBUG_FLAG = self.opts.debug
 
+        if self.opts.config_dir != MbedUsbTheApp.DIR_PATH:
+            # the config file pathnames are made by appending the filename
+            MbedUsbTheApp.DIR_PATH = os.path.join(self.opts.config_dir, '')
+
+        # commands only reading the config files, which dont need a hub or the daemon
+        if self.opts.platform_name_unique_list:
+            MbedUsbTheApp.mbed_usb_platform_name_unique_list()
+            return MbedUsbHub.ERROR_SUCCESS
+
+        if self.opts.lookup:
+            return self.mbed_usb_lookup()
+
+        if self.opts.daemon:
+            return self.mbed_usb_daemon_run()
+
+        if self.opts.commission:
+            return self.mbed_usb_commission()
+
+        if self.opts.telemetry_dump != "":
+            return self.mbed_usb_telemetry_dump()
+
+        if self.opts.batch != "":
+            return self.mbed_usb_batch()
+
+        if self.opts.boot_times:
+            MbedBootTimes.get().report()
+            return MbedUsbHub.ERROR_SUCCESS
+
+        if self.opts.telemetry != "":
+            return self.mbed_usb_telemetry()
+
+        if self.opts.watch:
+            return self.mbed_usb_watch()
+
+        if self.opts.set and self.opts.all_hubs:
+            return self.mbed_usb_set_all_hubs()
+
+        if self.opts.lease != "" or self.opts.renew or self.opts.release:
+            # leases are held by the daemon
+            if not MbedUsbDaemonClient.is_running(self.opts.daemon_socket):
+                sys.stderr.write('Error: leases require the daemon to be running (mbed_usb.py --daemon)\n')
+                return MbedUsbHub.ERROR_FAIL
+            return self.mbed_usb_daemon_request()
+
+        # if a daemon owns the hubs then hand the request over to it rather than
+        # opening the hub serial port ourselves
+        if (self.opts.get or self.opts.set or self.opts.state) and not self.opts.no_daemon:
+            if MbedUsbDaemonClient.is_running(self.opts.daemon_socket):
+                return self.mbed_usb_daemon_request()
 
         # read the cached config files (.json) if present
         self.mbed_usb_read_config()
@@ -716,7 +2752,7 @@ class MbedUsbTheApp():
         (hub_id, hub_serial_port, hub_config_file_name) = self.mbed_usb_get_hub_serial_port_from_args()
         
         self.hub.debug(__name__, "hub_id=%s, hub_serial_port=%s, debug=%d, get=%d, port_num=%d" % (hub_id, hub_serial_port, self.opts.debug,self.opts.get,self.opts.port_num))
-        if hub_id == str(MbedCambrionix.MAX_HUBS):
+        if hub_id is None and hub_serial_port == "":
             sys.stderr.write('Error: Failed to find a valid hub id for this target\n')
             sys.exit(self.hub.ERRORLEVEL_FLAG)
         
@@ -727,25 +2763,25 @@ class MbedUsbTheApp():
         self.hub.open(hub_serial_port)
         
         ## populate self.hub.config
-        self.hub.config = self.hub.get_config(hub_config_file_name)                      
+        self.hub.config = MbedUsbTopology.get().subrack_card_config.get(hub_id, {})
         
         ## todo: check range of port number
         
-        if self.opts.platform_name_unique_list:
-            MbedUsbTheApp.mbed_usb_platform_name_unique_list() 
-            sys.exit(self.hub.ERRORLEVEL_FLAG)
-        
         if self.opts.get:
             self.mbed_usb_get()
             
         elif self.opts.set:
             self.mbed_usb_set()
 
+        elif self.opts.state:
+            self.mbed_usb_state_print(hub_id if hub_id is not None else hub_serial_port, self.hub.port_state_snapshot().values())
+
         elif self.opts.test_num > 0:
             self.mbed_usb_test(self.opts.test_num)
             
     	# do mbedls if instructed to do so
         if self.opts.mbedls:
+            import mbed_lstools
             mbeds = mbed_lstools.create()
             print mbeds
     		
@@ -769,19 +2805,7 @@ class MbedUsbTheApp():
         
         @param platform_unique_name     unique name of platform to use.
         """
-        # load in the json config
-
-        hub_config = {}
-        subrack_hubs_config = MbedUsbTheApp.mbed_usb_hubs_get_config()
-        
-        target_list= []
-        for key in subrack_hubs_config:
-            # get port_config
-            MbedUsbTheApp.DIR_PATH
-            config_file_pathname = MbedUsbTheApp.DIR_PATH + subrack_hubs_config[key]['config_file'] 
-            hub_config = MbedCambrionix.get_config(config_file_pathname)
-            for hkey in hub_config:
-                target_list.append(hub_config[hkey]['platform_name_unique'])
+        target_list = MbedUsbTopology.get().platform_name_unique_list()
         
         if len(target_list) > 0:
             target_list.sort(key=MbedUsbTheApp.mbed_usb_natural_sort_key)
@@ -790,6 +2814,20 @@ class MbedUsbTheApp():
 
         return                
         
+    def mbed_usb_lookup(self):
+        """print the card config entry of the target specified by --platform_name_unique
+        as a line of json, including the serial port of the hub the target is on
+        """
+        topology = MbedUsbTopology.get()
+        (hub_id, hub_port_id) = topology.find(platform_name_unique=self.opts.platform_name_unique)
+        if hub_id is None:
+            sys.stderr.write('Error: platform unique name (%s) not recognised\n' % self.opts.platform_name_unique)
+            return MbedUsbHub.ERROR_FAIL
+
+        hub_port_data = dict(topology.get_hub_port_data(hub_id, hub_port_id), hub_serial_port=topology.get_hub_serial_port(hub_id))
+        print json.dumps(hub_port_data, sort_keys=True)
+        return MbedUsbHub.ERROR_SUCCESS
+
     def mbed_usb_get_hub_port_id_from_args(self):
         """
         
@@ -803,17 +2841,11 @@ class MbedUsbTheApp():
         if self.hub.is_port_num_in_range(self.opts.port_num) == True :
             hub_port_id = self.opts.port_num
             
-        else:
+        elif self.opts.platform_name_unique != "":
             # map platform_unique_name to hub_port_id
-            
-            if not self.hub.config:
-                raise AssertionError
-        
-            # search it to find platform unique name
-            for key in self.hub.config:
-                if self.hub.config[key]['platform_name_unique'] == self.opts.platform_name_unique:
-                    # have found entry
-                    hub_port_id = int(self.hub.config[key]['hub_port_id'])
+            (hub_id, port_id) = MbedUsbTopology.get().find(platform_name_unique=self.opts.platform_name_unique)
+            if hub_id is not None:
+                hub_port_id = port_id
              
         return hub_port_id                
         
@@ -824,12 +2856,9 @@ class MbedUsbTheApp():
             - each of the card config files enumerated in subrack config file 
         """
         
-        self.subrack_hubs_config = MbedUsbTheApp.mbed_usb_hubs_get_config()
-        if self.subrack_hubs_config:
-            for key in self.subrack_hubs_config:
-                # get port_config
-                config_file_pathname = MbedUsbTheApp.DIR_PATH + self.subrack_hubs_config[key]['config_file']
-                self.subrack_card_config[key] = MbedCambrionix.get_config(config_file_pathname)
+        topology = MbedUsbTopology.get()
+        self.subrack_hubs_config = topology.subrack_hubs_config
+        self.subrack_card_config = topology.subrack_card_config
 
         return
     
@@ -841,8 +2870,8 @@ class MbedUsbTheApp():
         @returns the tuple (hub_id, hub_serial_port, hub_config_file)
         
         hub_id      
-        the identifier string of the hub, MbedCambrionix.MAX_HUBS is the 
-        value returned if the data is invalid.
+        the identifier string of the hub, None is the value returned if
+        the data is invalid or the hub isnt in the subrack config.
         
         hub_serial_port
         if hub_id is valid then the serial commport is the comport for 
@@ -856,35 +2885,29 @@ class MbedUsbTheApp():
         self.debug(__name__, "mbed_usb_get_hub_serial_port_from_args")
         
         hub_serial_port = ""
-        hub_id = MbedCambrionix.MAX_HUBS
+        hub_id = None
         hub_config_file_name = ""
+        topology = MbedUsbTopology.get()
 
         if self.opts.usb_hub_com_port != "":
             hub_serial_port = self.opts.usb_hub_com_port
+            hub_id = topology.get_hub_id_by_hub_serial_port(hub_serial_port)
+            if hub_id is not None:
+                hub_config_file_name = topology.get_card_config_file_pathname(hub_id)
 
         elif self.opts.platform_name_unique != "":
             # find hub_id from platform_name_unique
-            
-            hubs_config = self.mbed_usb_hubs_get_config()
-            # fix up: have to read the config
-
-            hubs_config = MbedUsbTheApp.mbed_usb_hubs_get_config()
-            
-            for key in hubs_config:
-                # get port_config
-                config_file_pathname = MbedUsbTheApp.DIR_PATH + hubs_config[key]['config_file']
-                hub_config = MbedCambrionix.get_config(config_file_pathname)
-                for hkey in hub_config:
-                    if hub_config[hkey]['platform_name_unique'] == self.opts.platform_name_unique:
-                        hub_serial_port = self.mbed_usb_get_hub_com_port_from_id(key)
-                        hub_id = key
-                        hub_config_file_name = MbedUsbTheApp.DIR_PATH + hubs_config[key]['config_file']
+            (key, hub_port_id) = topology.find(platform_name_unique=self.opts.platform_name_unique)
+            if key is not None:
+                hub_serial_port = topology.get_hub_serial_port(key)
+                hub_id = key
+                hub_config_file_name = topology.get_card_config_file_pathname(key)
             
         elif self.opts.platform_name_unique_list:
             # means we have to discover the hub com ports and generate a composite list
             # for the purposes of this method, its sufficient to return at least 1 serial port
-            for i in range(0, MbedCambrionix.MAX_HUBS-1):
-                hub_serial_port = self.mbed_usb_get_hub_com_port_from_id(str(i))
+            for key in sorted(topology.subrack_hubs_config):
+                hub_serial_port = topology.get_hub_serial_port(key)
                 if hub_serial_port != '':
                     break
         
@@ -923,7 +2946,6 @@ class MbedUsbTheApp():
             sys.exit(self.hub.ERRORLEVEL_FLAG)
 
         on_off_map = { 'off' : MbedUsbHub.PORT_STATE_OFF , 'on' : MbedUsbHub.PORT_STATE_ON  }
-        on_off_sleep_map = { 'off' : self.opts.sleep_off , 'on' : self.opts.sleep_on }
 
         if self.opts.set not in on_off_map.keys():
             sys.stderr.write('Error: invalid set arg. alid args are %s\n' % on_off_map.keys())
@@ -940,25 +2962,374 @@ class MbedUsbTheApp():
         if ret != None:
             print "OK\n"
             
-        # perform sleep
-        time.sleep(on_off_sleep_map[self.opts.set])
+        # perform sleep or wait for the target to be ready
+        self.mbed_usb_set_wait()
         
-        return                
-        
-    # make this a statis member function and then have a factory 
+        return
+
+    def mbed_usb_wait_timeout(self):
+        """return the maximum time to wait for the target after a set operation (s)
+
+        --wait_timeout, or by default --sleep_on or --sleep_off. With --adaptive_wait
+        the time allowed for a target to come up is derived from its recorded
+        boot times (see MbedBootTimes).
+        """
+        on_off_sleep_map = { 'off' : self.opts.sleep_off , 'on' : self.opts.sleep_on }
+        timeout = on_off_sleep_map[self.opts.set]
+        if self.opts.wait_timeout is not None:
+            timeout = self.opts.wait_timeout
+        if self.opts.adaptive_wait and self.opts.set == 'on':
+            topology = MbedUsbTopology.get()
+            (hub_id, hub_port_id) = topology.find(platform_name_unique=self.opts.platform_name_unique)
+            if hub_id is not None:
+                timeout = MbedBootTimes.get().get_wait_port(topology, hub_id, hub_port_id, timeout, self.opts.boot_percentile)
+                self.debug(__name__, "adaptive wait for %s is %.2fs" % (self.opts.platform_name_unique, timeout))
+        return timeout
+
+    def mbed_usb_set_wait(self):
+        """wait after a set operation for the target to come up (on) or go away (off)
+
+        The target's serial port and mount point are polled for (using the
+        target_id from the card config), returning as soon as the target is
+        usable, with mbed_usb_wait_timeout() as the upper limit. With
+        --no_wait_ready (or if the target_id isnt known, with a warning) sleep
+        for the whole of the timeout.
+        """
+        on_off_map = { 'off' : MbedUsbHub.PORT_STATE_OFF , 'on' : MbedUsbHub.PORT_STATE_ON  }
+
+        timeout = self.mbed_usb_wait_timeout()
+        if not self.opts.wait_ready or timeout <= 0:
+            time.sleep(timeout)
+            return
+
+        topology = MbedUsbTopology.get()
+        (hub_id, hub_port_id) = topology.find(platform_name_unique=self.opts.platform_name_unique)
+        (ready, elapsed) = MbedTargetReadiness.wait_port(topology, hub_id, hub_port_id, on_off_map[self.opts.set], timeout)
+        self.debug(__name__, "target %s ready=%s after %.2fs" % (self.opts.platform_name_unique, ready, elapsed))
+        self.mbed_usb_set_wait_report(ready, elapsed, timeout)
+        return
+
+    def mbed_usb_set_wait_report(self, ready, elapsed, timeout):
+        """warn if the target wasnt ready after waiting, sleeping for the timeout if its readiness is unknown
+        """
+        if ready is None:
+            sys.stderr.write('Warning: cant detect if %s is %s, target_id not in the card config\n' % (self.opts.platform_name_unique, {'on' : 'enumerated', 'off' : 'removed'}[self.opts.set]))
+            time.sleep(timeout)
+        elif not ready:
+            sys.stderr.write('Warning: %s not %s after %ds\n' % (self.opts.platform_name_unique, {'on' : 'enumerated', 'off' : 'removed'}[self.opts.set], elapsed))
+
+    def mbed_usb_set_all_hubs(self):
+        """set all the ports on all the hubs to the state specified by --set
+
+        The hubs are driven concurrently, each with pipelined mode commands. The
+        request is performed by the daemon if one is running, otherwise the hubs
+        are opened by this process.
+        """
+        from mbed_usb_daemon import MbedUsbDaemon, MbedUsbDaemonClient
+
+        if self.opts.set not in ['on', 'off']:
+            sys.stderr.write('Error: invalid set arg. valid args are %s\n' % ['on', 'off'])
+            return MbedUsbHub.ERROR_FAIL
+
+        request = {'cmd' : 'set_all', 'state' : self.opts.set}
+        if self.opts.lease_id != "":
+            request['lease_id'] = self.opts.lease_id
+
+        if not self.opts.no_daemon and MbedUsbDaemonClient.is_running(self.opts.daemon_socket):
+            client = MbedUsbDaemonClient(self.opts.daemon_socket)
+            try:
+                response = client.request(request)
+            finally:
+                client.close()
+        else:
+            daemon = MbedUsbDaemon(self.opts.daemon_socket, self.opts.subrack_config)
+            daemon.DEBUG_FLAG = self.opts.debug
+            daemon.rack.set_power_scheduler(self.mbed_usb_power_scheduler())
+            try:
+                # hubs are opened as needed, hubs which fail to open are skipped with a warning
+                response = daemon.do_request(request)
+            finally:
+                daemon.close()
+
+        if response['status'] != 'ok':
+            sys.stderr.write('Error: %s\n' % response['error'])
+            return MbedUsbHub.ERROR_FAIL
+
+        print "OK\n"
+        on_off_sleep_map = { 'off' : self.opts.sleep_off , 'on' : self.opts.sleep_on }
+        time.sleep(on_off_sleep_map[self.opts.set])
+        return MbedUsbHub.ERROR_SUCCESS
+
+    def mbed_usb_batch(self):
+        """perform the operations in the --batch script
+        """
+        from mbed_usb_daemon import MbedHubController, MbedUsbBatch
+
+        if self.opts.batch == '-':
+            infile = sys.stdin
+        else:
+            try:
+                infile = open(self.opts.batch, 'r')
+            except IOError as e:
+                sys.stderr.write('Error: failed to open %s (%s)\n' % (self.opts.batch, e))
+                return MbedUsbHub.ERROR_FAIL
+
+        controller = MbedHubController(self.opts.subrack_config, self.opts.daemon_socket, not self.opts.no_daemon)
+        controller.DEBUG_FLAG = self.opts.debug
+        controller.rack.set_power_scheduler(self.mbed_usb_power_scheduler())
+        batch = MbedUsbBatch(controller)
+        batch.DEBUG_FLAG = self.opts.debug
+        try:
+            failures = batch.run(infile, self.opts.batch_stop_on_error)
+        finally:
+            controller.close()
+            if infile is not sys.stdin:
+                infile.close()
+
+        if failures:
+            return MbedUsbHub.ERROR_FAIL
+        return MbedUsbHub.ERROR_SUCCESS
+
+    def mbed_usb_power_scheduler(self):
+        """create the MbedPowerScheduler configured by the command line options
+        """
+        return MbedPowerScheduler(self.opts.power_concurrency, self.opts.power_stagger, self.opts.power_current_limit)
+
+    def mbed_usb_commission(self):
+        """commission the hubs, writing the card config json files
+        """
+        from mbed_usb_daemon import MbedUsbDaemonClient
+        from mbed_usb_commission import MbedUsbCommissioner
+
+        if MbedUsbDaemonClient.is_running(self.opts.daemon_socket):
+            sys.stderr.write('Error: stop the daemon before commissioning as it owns the hub serial ports\n')
+            return MbedUsbHub.ERROR_FAIL
+
+        topology = MbedUsbTopology.get()
+        if self.opts.usb_hub_com_port != "":
+            hub_id = topology.get_hub_id_by_hub_serial_port(self.opts.usb_hub_com_port)
+            if hub_id is None:
+                sys.stderr.write('Error: hub com port %s not found in %s\n' % (self.opts.usb_hub_com_port, self.SUBRACK_CONFIG_FILENAME))
+                return MbedUsbHub.ERROR_FAIL
+            hub_ids = [hub_id]
+        else:
+            hub_ids = sorted(topology.subrack_hubs_config, key=MbedUsbTheApp.mbed_usb_natural_sort_key)
+
+        hub_targets = {}
+        for hub_id in hub_ids:
+            hub = MbedCambrionix()
+            hub.DEBUG_FLAG = self.opts.debug
+            hub.open(topology.get_hub_serial_port(hub_id))
+            if hub.handle is None:
+                sys.stderr.write('Error: failed to open hub %s\n' % hub_id)
+                return MbedUsbHub.ERROR_FAIL
+
+            print "commissioning hub %s on %s" % (hub_id, hub.port)
+            commissioner = MbedUsbCommissioner(hub, hub_id)
+            commissioner.DEBUG_FLAG = self.opts.debug
+            try:
+                hub_targets[hub_id] = commissioner.commission()
+            finally:
+                hub.close()
+            print "found %d targets on hub %s" % (len(hub_targets[hub_id]), hub_id)
+
+        existing_names = []
+        for hub_id in topology.subrack_card_config:
+            if hub_id not in hub_targets:
+                for key in topology.subrack_card_config[hub_id]:
+                    existing_names.append(topology.subrack_card_config[hub_id][key]['platform_name_unique'])
+
+        card_configs = MbedUsbCommissioner.make_card_config(hub_targets, existing_names)
+        for hub_id in card_configs:
+            config_file_pathname = topology.get_card_config_file_pathname(hub_id)
+            with open(config_file_pathname, 'w') as data_file:
+                json.dump(card_configs[hub_id], data_file, indent=4, sort_keys=True)
+            print "wrote %s" % config_file_pathname
+
+        return MbedUsbHub.ERROR_SUCCESS
+
+    @staticmethod
+    def mbed_usb_state_print(hub_id, records):
+        """print a table of MbedCambrionixPortState records for a hub
+        """
+        print "%-6s %-4s %-10s %-8s %-7s %-8s" % ('hub_id', 'port', 'current_ma', 'flags', 'profile', 'energy')
+        for record in sorted(records):
+            print "%-6s %-4d %-10d %-8s %-7d %-8.2f" % (hub_id, record.port_num, record.current_ma, ' '.join(record.flags), record.profile_id, record.energy)
+
+    def mbed_usb_daemon_run(self):
+        """run the daemon owning all the hubs until interrupted
+        """
+        from mbed_usb_daemon import MbedUsbDaemon
+
+        daemon = MbedUsbDaemon(self.opts.daemon_socket, self.opts.subrack_config)
+        daemon.DEBUG_FLAG = self.opts.debug
+        daemon.rack.set_power_scheduler(self.mbed_usb_power_scheduler())
+        daemon.rack.set_state_ttl(self.opts.state_ttl)
+        num_hubs = daemon.open()
+        if num_hubs == 0:
+            sys.stderr.write('Error: failed to open any hubs\n')
+            return MbedUsbHub.ERROR_FAIL
+
+        print "mbed_usb daemon serving %d hub(s) on %s" % (num_hubs, self.opts.daemon_socket)
+        if self.opts.telemetry != "":
+            daemon.start_telemetry(self.opts.telemetry, self.opts.telemetry_interval)
+        daemon.serve_forever()
+        return MbedUsbHub.ERROR_SUCCESS
+
+    def mbed_usb_telemetry(self):
+        """sample the current drawn by all the hub ports until interrupted or for --telemetry_duration
+        """
+        from mbed_usb_daemon import MbedUsbDaemonClient
+        from mbed_usb_telemetry import MbedUsbTelemetrySampler
+
+        if MbedUsbDaemonClient.is_running(self.opts.daemon_socket):
+            sys.stderr.write('Error: the daemon owns the hub serial ports, use --daemon --telemetry to sample from the daemon\n')
+            return MbedUsbHub.ERROR_FAIL
+
+        rack = MbedRack(self.opts.subrack_config)
+        rack.set_debug(self.opts.debug)
+        sampler = MbedUsbTelemetrySampler(rack, self.opts.telemetry, self.opts.telemetry_interval)
+        sampler.DEBUG_FLAG = self.opts.debug
+        try:
+            if sampler.start() == 0:
+                sys.stderr.write('Error: failed to open any hubs\n')
+                return MbedUsbHub.ERROR_FAIL
+            print "sampling %d hub(s) every %ss to %s" % (len(sampler.threads), self.opts.telemetry_interval, self.opts.telemetry)
+            sampler.run(self.opts.telemetry_duration)
+        finally:
+            rack.close()
+
+        print "skipped %d samples while hubs were busy" % sampler.skipped
+        return MbedUsbHub.ERROR_SUCCESS
+
+    def mbed_usb_watch(self):
+        """print the port state changes until interrupted, from the daemon if running
+        """
+        from mbed_usb_daemon import MbedUsbDaemonClient
+
+        def print_event(event):
+            timestamp_str = time.strftime('%H:%M:%S', time.localtime(event['timestamp']))
+            print "%s subrack=%s hub_id=%s port=%d %-6s flags=%s added=%s removed=%s" % (timestamp_str, event['subrack_id'], event['hub_id'], event['port_num'],
+                                                                                        event['event'], ' '.join(event['flags']), ' '.join(event['added']), ' '.join(event['removed']))
+            sys.stdout.flush()
+
+        try:
+            if not self.opts.no_daemon and MbedUsbDaemonClient.is_running(self.opts.daemon_socket):
+                client = MbedUsbDaemonClient(self.opts.daemon_socket)
+                try:
+                    for event in client.watch(self.opts.watch_interval):
+                        print_event(event)
+                finally:
+                    client.close()
+            else:
+                rack = MbedRack(self.opts.subrack_config)
+                rack.set_debug(self.opts.debug)
+                rack.subscribe(print_event)
+                rack.start_watch(self.opts.watch_interval)
+                try:
+                    while True:
+                        time.sleep(1)
+                finally:
+                    rack.close()
+        except KeyboardInterrupt:
+            pass
+        except socket.error as e:
+            sys.stderr.write('Error: %s\n' % e)
+            return MbedUsbHub.ERROR_FAIL
+
+        return MbedUsbHub.ERROR_SUCCESS
+
+    def mbed_usb_telemetry_dump(self):
+        """print the samples in a telemetry time series file
+        """
+        from mbed_usb_telemetry import MbedUsbTelemetrySampler
+
+        try:
+            samples = MbedUsbTelemetrySampler.read(self.opts.telemetry_dump)
+        except (IOError, ValueError) as e:
+            sys.stderr.write('Error: failed to read %s (%s)\n' % (self.opts.telemetry_dump, e))
+            return MbedUsbHub.ERROR_FAIL
+
+        print "%-26s %-7s %-6s %-4s %-10s %-8s %-8s" % ('time', 'subrack', 'hub_id', 'port', 'current_ma', 'flags', 'energy')
+        for (timestamp, subrack_id, hub_id, port_num, flags, current_ma, energy) in samples:
+            timestamp_str = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)) + ('%.3f' % (timestamp % 1))[1:]
+            print "%-26s %-7s %-6s %-4d %-10d %-8s %-8.2f" % (timestamp_str, subrack_id, hub_id, port_num, current_ma, ' '.join(flags), energy)
+        return MbedUsbHub.ERROR_SUCCESS
+
+    def mbed_usb_daemon_request(self):
+        """perform the get/set operation specified on the command line via the daemon
+        """
+        from mbed_usb_daemon import MbedUsbDaemonClient
+
+        request = { 'platform_name_unique' : self.opts.platform_name_unique,
+                    'usb_hub_com_port' : self.opts.usb_hub_com_port,
+                    'port_num' : self.opts.port_num }
+        if self.opts.state:
+            request['cmd'] = 'state'
+        elif self.opts.lease != "":
+            request['cmd'] = 'lease'
+            request['owner'] = self.opts.lease
+            request['duration'] = self.opts.lease_duration
+            request['wait'] = self.opts.lease_wait
+        elif self.opts.renew:
+            request = {'cmd' : 'renew', 'lease_id' : self.opts.lease_id, 'duration' : self.opts.lease_duration}
+        elif self.opts.release:
+            request = {'cmd' : 'release', 'lease_id' : self.opts.lease_id}
+        elif self.opts.get:
+            request['cmd'] = 'get'
+        else:
+            request['cmd'] = 'set'
+            request['state'] = self.opts.set
+            timeout = self.mbed_usb_wait_timeout()
+            if self.opts.wait_ready and timeout > 0:
+                request['wait'] = timeout
+            if self.opts.lease_id != "":
+                request['lease_id'] = self.opts.lease_id
+
+        client = MbedUsbDaemonClient(self.opts.daemon_socket)
+        try:
+            response = client.request(request)
+        finally:
+            client.close()
+        self.debug(__name__, "response=%s" % response)
+
+        if response['status'] != 'ok':
+            sys.stderr.write('Error: %s\n' % response['error'])
+            return MbedUsbHub.ERROR_FAIL
+
+        if self.opts.state:
+            # hubs are labelled <subrack_id>/<hub_id> when the rack has more than one subrack
+            subracks = response['result']
+            for subrack_id in sorted(subracks, key=MbedUsbTheApp.mbed_usb_natural_sort_key):
+                for hub_id in sorted(subracks[subrack_id], key=MbedUsbTheApp.mbed_usb_natural_sort_key):
+                    records = [MbedCambrionixPortState(**port_data) for port_data in subracks[subrack_id][hub_id]]
+                    label = hub_id if len(subracks) == 1 else '%s/%s' % (subrack_id, hub_id)
+                    self.mbed_usb_state_print(label, records)
+        elif self.opts.lease != "":
+            # printed on its own so scripts can capture it
+            print response['result']['lease_id']
+        elif self.opts.renew or self.opts.release:
+            print "OK\n"
+        elif self.opts.get:
+            print "%s\n" % response['result']
+        elif 'ready' in response:
+            # the daemon has waited for the target
+            print "OK\n"
+            self.mbed_usb_set_wait_report(response['ready'], response['elapsed'], request['wait'])
+        else:
+            print "OK\n"
+            self.mbed_usb_set_wait()
+
+        return MbedUsbHub.ERROR_SUCCESS
+
+    # make this a statis member function and then have a factory
     # to create hub instances, one per enumerated in the hubs.json file.
     #todo: move to MbedUsbHub?, and make static?
     @staticmethod
     def mbed_usb_hubs_get_config():
         """Get the config for the usb hubs from the json file
         """
-        config = {}
-        config_file_pathname = MbedUsbTheApp.DIR_PATH + MbedUsbTheApp.SUBRACK_CONFIG_FILENAME
-        if os.path.isfile(config_file_pathname): 
-            with open(config_file_pathname) as data_file:    
-                config = json.load(data_file)
-
-        return config
+        return MbedUsbTopology.get().subrack_hubs_config
 
     #todo: move to MbedUsbHub?
     
@@ -966,12 +3337,7 @@ class MbedUsbTheApp():
     def mbed_usb_get_hub_com_port_from_id(hub_id='0'):
         """ get the serial port of the hub
         """
-        serial_port = ""
-        config = MbedUsbTheApp.mbed_usb_hubs_get_config()
-        if hub_id in config:
-            serial_port = config[hub_id]['serial_port']
-        
-        return serial_port
+        return MbedUsbTopology.get().get_hub_serial_port(hub_id)
         
 # usage examples
 #
@@ -998,8 +3364,91 @@ class MbedUsbTheApp():
 #
 #  python mbed_usb.py --platform_name_unique_list
 #
+# To (re)commission all the hubs i.e. discover the port each target is on and
+# write the card config json files, or just the hub on com30:
+#
+#  python mbed_usb.py --commission
+#  python mbed_usb.py --commission --usb_hub_com_port com30
+#
+# To run a daemon which keeps the hub connections open (get/set commands
+# are then forwarded to the daemon rather than opening the hub each time):
+#
+#  python mbed_usb.py --daemon
+#
+# To turn on a target and return as soon as its serial port and mount point
+# have appeared (waiting at most 20s), or to always sleep 20s:
+#
+#  python mbed_usb.py --platform_name_unique K64F[0] --set on --sleep_on 20
+#  python mbed_usb.py --platform_name_unique K64F[0] --set on --sleep_on 20 --no_wait_ready
+#
+# The boot times of targets which are waited for are recorded. To give
+# up on K64F[0] once it has taken longer than nearly all previous boots, and
+# to print the recorded boot times:
+#
+#  python mbed_usb.py --platform_name_unique K64F[0] --set on --sleep_on 30 --adaptive_wait
+#  python mbed_usb.py --boot_times
+#
+# To find the hub and port K64F[0] is on, without opening the hub:
+#
+#  python mbed_usb.py --platform_name_unique K64F[0] --lookup
+#
+# To turn off all the ports on all the hubs:
+#
+#  python mbed_usb.py --all_hubs --set off
+#
+# To record the current drawn by all the ports every 0.5s (standalone, or
+# from the daemon so the hubs can still be controlled), and to print the
+# recorded samples:
+#
+#  python mbed_usb.py --telemetry current.dat --telemetry_interval 0.5
+#  python mbed_usb.py --daemon --telemetry current.dat
+#  python mbed_usb.py --telemetry_dump current.dat
+#
+# To lease K64F[0] for a job (waiting upto 10 minutes for another job to
+# release it), power cycle it and release it:
+#
+#  LEASE=`python mbed_usb.py --platform_name_unique K64F[0] --lease job_42 --lease_wait 600`
+#  python mbed_usb.py --platform_name_unique K64F[0] --lease_id $LEASE --set off
+#  python mbed_usb.py --platform_name_unique K64F[0] --lease_id $LEASE --set on --sleep_on 20
+#  python mbed_usb.py --lease_id $LEASE --release
+#
+# A lease expires after --lease_duration (default 1 hour) unless it is
+# renewed, e.g. from a long job every half hour:
+#
+#  python mbed_usb.py --lease_id $LEASE --renew --lease_duration 3600
+#
+# To turn on all the ports on all the hubs, powering up at most 2 targets
+# per hub at a time and keeping each hub below 1.5A:
+#
+#  python mbed_usb.py --all_hubs --set on --power_concurrency 2 --power_current_limit 1500
+#
+# To power cycle two targets and check they came back, with one process,
+# writing a line of json with the result of each operation:
+#
+#  python mbed_usb.py --batch - <<EOF
+#  set K64F[0] off
+#  set NUCLEO_F401RE[0] off
+#  sleep 1
+#  set K64F[0] on auto
+#  set NUCLEO_F401RE[0] on 20
+#  get K64F[0]
+#  state
+#  EOF
+#
+# To print targets being attached/detached and ports changing state:
+#
+#  python mbed_usb.py --watch
+#
+# To run a daemon for a rack of two subracks, each described by its own
+# subrack config file:
+#
+#  python mbed_usb.py --daemon --subrack_config mbed_usb_hubs.json --subrack_config mbed_usb_hubs_subrack_02.json
+#
 if __name__=='__main__':
 
+    # the daemon, telemetry and commissioning modules import their classes
+    # from mbed_usb, so they must get this script rather than a second copy
+    sys.modules['mbed_usb'] = sys.modules[__name__]
     app = MbedUsbTheApp()
     app.mbed_usb_main()
             
\ No newline at end of file
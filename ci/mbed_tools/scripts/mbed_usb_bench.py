@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+
+#############################################################################
+# mbed_usb_bench.py
+#  Script to:
+#   - measure the latency and throughput of the MbedCambrionix hub commands
+#     against real hubs or hubs simulated by mbed_usb_sim.py e.g. to
+#     benchmark 2 simulated hubs taking 5ms to process each command:
+#       python mbed_usb_bench.py --sim 2 --sim_latency 0.005 --json bench.json
+#     or a real hub without changing the state of its ports:
+#       python mbed_usb_bench.py --usb_hub_com_port COM51 --read_only
+#     or the time taken by mbed_usb_cli.py to start up and run commands which
+#     dont use a hub, failing if they take longer than 100ms:
+#       python mbed_usb_bench.py --startup --startup_budget 100
+#
+#############################################################################
+# version 0.0.1     latency percentiles and throughput per command type
+# version 0.0.2     startup time of mbed_usb_cli.py against a budget
+
+
+"""
+mbed USB hub benchmark
+Copyright (c) 2011-2015 ARM Limited
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import sys
+import optparse
+import subprocess
+import time
+import json
+import math
+import platform
+from mbed_usb import MbedCambrionix
+from mbed_usb import MbedUsbHub
+
+
+class MbedUsbBenchmark():
+    """ benchmark of the MbedCambrionix hub commands
+
+    Each case is run a number of times and the latency of every run is
+    recorded. The results are the latency percentiles, and the throughput
+    i.e. the number of port operations performed per second. Cases are named
+    <command>.<scope> where scope is single_port, all_ports or multi_hub.
+    """
+
+    DEFAULT_ITERATIONS = 100
+    PERCENTILES = [50, 95, 99]
+
+    # maximum p50 time for mbed_usb_cli.py to run a command which doesnt use a hub (ms)
+    DEFAULT_STARTUP_BUDGET_MS = 100
+    # command lines timed by run_startup(), keyed by case name. mbed_usb_cli.py
+    # is used as python mbed_usb.py compiles the whole script every time it is run
+    STARTUP_CASES = { 'startup.import' : ['-c', 'import mbed_usb'],
+                      'startup.platform_name_unique_list' : ['mbed_usb_cli.py', '--platform_name_unique_list'],
+                      'startup.lookup' : ['mbed_usb_cli.py', '--platform_name_unique', 'K64F[0]', '--lookup'] }
+
+    def __init__(self, hub_serial_ports, iterations=DEFAULT_ITERATIONS, read_only=False):
+        """ Constuctor
+
+        @param hub_serial_ports     list of the serial ports of the hubs to benchmark
+        @param iterations           number of times each case is run
+        @param read_only            if True the cases changing the port state are skipped
+        """
+        self.DEBUG_FLAG = False     # Used to enable debug code / prints
+
+        self.hub_serial_ports = hub_serial_ports
+        self.iterations = iterations
+        self.read_only = read_only
+        self.hubs = {}
+        # case name -> result dictionary
+        self.results = {}
+
+    def debug(self, name, text):
+        """! Prints debug messages
+
+        @param name Called function name
+        @param text Text to be included in debug message
+        """
+        if self.DEBUG_FLAG is True:
+            print 'debug @%s.%s: %s'% (self.__class__.__name__, name, text)
+
+    @staticmethod
+    def percentile(sorted_values, percent):
+        """! return the nearest rank percentile of a sorted list"""
+        if not sorted_values:
+            return 0.0
+        rank = int(math.ceil(percent / 100.0 * len(sorted_values))) - 1
+        return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+    def measure(self, name, func, ops_per_call=1, iterations=None):
+        """! run a case and record its latency and throughput
+
+        @param name             name of the case
+        @param func             function performing one run of the case, called with the iteration number
+        @param ops_per_call     number of port operations performed by each run, used for the throughput
+        @param iterations       number of runs, defaults to self.iterations
+        @return the result dictionary of the case
+        """
+        if iterations is None:
+            iterations = self.iterations
+
+        latencies = []
+        start = time.time()
+        for i in range(0, iterations):
+            t0 = time.time()
+            func(i)
+            latencies.append(time.time() - t0)
+        total = time.time() - start
+
+        latencies.sort()
+        result = { 'iterations' : iterations,
+                   'ops_per_call' : ops_per_call,
+                   'min_ms' : latencies[0] * 1000.0,
+                   'max_ms' : latencies[-1] * 1000.0,
+                   'mean_ms' : sum(latencies) / len(latencies) * 1000.0,
+                   'ops_per_s' : iterations * ops_per_call / total if total > 0 else 0.0 }
+        for percent in self.PERCENTILES:
+            result['p%d_ms' % percent] = self.percentile(latencies, percent) * 1000.0
+
+        self.results[name] = result
+        self.debug(__name__, "%s %s" % (name, result))
+        return result
+
+    def open_hubs(self):
+        """! open all the hubs
+
+        @return number of hubs opened
+        """
+        for serial_port in self.hub_serial_ports:
+            hub = MbedCambrionix()
+            hub.DEBUG_FLAG = self.DEBUG_FLAG
+            hub.open(serial_port)
+            if hub.handle is None:
+                sys.stderr.write('Error: failed to open hub on %s\n' % serial_port)
+                continue
+            self.hubs[serial_port] = hub
+        return len(self.hubs)
+
+    def close_hubs(self):
+        """! close all the hubs"""
+        for serial_port in self.hubs:
+            self.hubs[serial_port].close()
+        self.hubs = {}
+
+    def run(self):
+        """! run all the cases
+
+        @return dictionary of the results keyed by case name
+        """
+        serial_port = self.hub_serial_ports[0]
+
+        # open includes the serial open, break and system handshake
+        def run_open(i):
+            hub = MbedCambrionix()
+            hub.open(serial_port)
+            hub.close()
+        self.measure('open.single_hub', run_open, iterations=max(self.iterations / 10, 1))
+
+        if self.open_hubs() == 0:
+            return self.results
+        hub = self.hubs[serial_port]
+        ports = hub.MAX_PORTS
+        on_off = [MbedUsbHub.PORT_STATE_OFF, MbedUsbHub.PORT_STATE_ON]
+
+        try:
+            self.measure('cmd_system.single_hub', lambda i: hub.cmd_system())
+            self.measure('cmd_state.single_port', lambda i: hub.cmd_state(i % ports))
+            self.measure('cmd_state.all_ports', lambda i: hub.cmd_state(ports), ops_per_call=ports)
+            self.measure('port_state_get.single_port', lambda i: hub.port_state_get(i % ports))
+            self.measure('port_state_snapshot.all_ports', lambda i: hub.port_state_snapshot(), ops_per_call=ports)
+
+            if not self.read_only:
+                # alternate off/on so every run changes the state of the port(s)
+                self.measure('port_state_set.single_port', lambda i: hub.port_state_set(0, on_off[i % 2]))
+                self.measure('port_state_set.all_ports', lambda i: hub.port_state_set(ports, on_off[i % 2]), ops_per_call=ports)
+                hub.port_state_set(ports, MbedUsbHub.PORT_STATE_ON)
+
+            if len(self.hubs) > 1:
+                self.measure('port_state_snapshot.multi_hub', lambda i: MbedCambrionix.port_state_snapshot_hubs(self.hubs), ops_per_call=ports * len(self.hubs))
+
+                if not self.read_only:
+                    def run_set_hubs(i):
+                        ops = [(key, num, on_off[i % 2]) for key in self.hubs for num in range(0, ports)]
+                        MbedCambrionix.port_state_set_hubs(self.hubs, ops)
+                    self.measure('port_state_set.multi_hub', run_set_hubs, ops_per_call=ports * len(self.hubs))
+                    MbedCambrionix.port_state_set_hubs(self.hubs, [(key, num, MbedUsbHub.PORT_STATE_ON) for key in self.hubs for num in range(0, ports)])
+        finally:
+            self.close_hubs()
+
+        return self.results
+
+    def run_startup(self):
+        """! time new mbed_usb_cli.py processes running commands which dont use a hub
+
+        @details the time includes the python interpreter startup, so is what
+        a script invoking mbed_usb_cli.py per operation pays for each one.
+        @return dictionary of the results keyed by case name
+        """
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        with open(os.devnull, 'w') as devnull:
+            for name in sorted(self.STARTUP_CASES):
+                cmd = [sys.executable] + self.STARTUP_CASES[name]
+                self.measure(name, lambda i: subprocess.call(cmd, cwd=script_dir, stdout=devnull, stderr=devnull), iterations=max(self.iterations / 10, 1))
+        return self.results
+
+    def check_startup_budget(self, budget_ms):
+        """! check the startup cases against a budget
+
+        @return list of the names of the cases whose p50 exceeds budget_ms
+        """
+        return [name for name in sorted(self.results) if name.startswith('startup.') and self.results[name]['p50_ms'] > budget_ms]
+
+    def report(self):
+        """! print a table of the results"""
+        print "%-32s %8s %8s %8s %8s %10s" % ('case', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'ops_per_s')
+        for name in sorted(self.results):
+            result = self.results[name]
+            print "%-32s %8.2f %8.2f %8.2f %8.2f %10.1f" % (name, result['p50_ms'], result['p95_ms'], result['p99_ms'], result['max_ms'], result['ops_per_s'])
+
+
+class MbedUsbBenchTheApp():
+    """ the mbed_usb_bench.py command line application"""
+
+    def __init__(self):
+        """ Constuctor"""
+        self.DEBUG_FLAG = False
+        self.opts = None
+        self.args = None
+
+    def mbed_usb_bench_cmd_parser_setup(self):
+        """! Configure CLI (Command Line OPtions) options
+
+        @return Returns OptionParser's tuple of (options, arguments)
+        """
+        parser = optparse.OptionParser()
+
+        parser.add_option('-d', '--debug',
+                          dest='debug',
+                          default=False,
+                          action="store_true",
+                          help='Outputs extra debug information')
+
+        parser.add_option('-u', '--usb_hub_com_port',
+                          type ='string',
+                          dest ='usb_hub_com_port',
+                          default=[],
+                          action="append",
+                          help='serial port of a hub to benchmark. Repeat for the multi hub cases')
+
+        parser.add_option('--sim',
+                          type ='int',
+                          dest ='sim',
+                          default=0,
+                          help='benchmark the specified number of hubs simulated by mbed_usb_sim.py')
+
+        parser.add_option('--sim_latency',
+                          type ='float',
+                          dest ='sim_latency',
+                          default=0.0,
+                          help='time taken by the simulated hubs to process a command in seconds (default 0)')
+
+        parser.add_option('-i', '--iterations',
+                          type ='int',
+                          dest ='iterations',
+                          default=MbedUsbBenchmark.DEFAULT_ITERATIONS,
+                          help='number of times each case is run (default %d)' % MbedUsbBenchmark.DEFAULT_ITERATIONS)
+
+        parser.add_option('--read_only',
+                          dest ='read_only',
+                          default=False,
+                          action="store_true",
+                          help='skip the cases turning ports on/off e.g. when targets are attached to the hub')
+
+        parser.add_option('--startup',
+                          dest ='startup',
+                          default=False,
+                          action="store_true",
+                          help='benchmark the startup time of mbed_usb_cli.py rather than the hub commands')
+
+        parser.add_option('--startup_budget',
+                          type ='int',
+                          dest ='startup_budget',
+                          default=MbedUsbBenchmark.DEFAULT_STARTUP_BUDGET_MS,
+                          help='fail if the p50 startup time of mbed_usb_cli.py exceeds the specified time in ms (default %d)' % MbedUsbBenchmark.DEFAULT_STARTUP_BUDGET_MS)
+
+        parser.add_option('--json',
+                          type ='string',
+                          dest ='json',
+                          default="",
+                          help='write the results to the specified json file')
+
+        return parser.parse_args()
+
+    def mbed_usb_bench_main(self):
+        """! Function used to drive CLI (command line interface) application
+
+        @return Function exits with successcode
+        """
+        (self.opts, self.args) = self.mbed_usb_bench_cmd_parser_setup()
+        self.DEBUG_FLAG = self.opts.debug
+
+        sims = []
+        hub_serial_ports = list(self.opts.usb_hub_com_port)
+        if self.opts.sim > 0:
+            # only needed for simulated hubs, which require a posix pty
+            from mbed_usb_sim import MbedCambrionixSimulator
+            for hub_id in range(0, self.opts.sim):
+                sim = MbedCambrionixSimulator(latency=self.opts.sim_latency)
+                hub_serial_ports.append(sim.open())
+                sims.append(sim)
+
+        if not hub_serial_ports and not self.opts.startup:
+            sys.stderr.write('Error: specify the hubs with --usb_hub_com_port or --sim\n')
+            return 1
+
+        bench = MbedUsbBenchmark(hub_serial_ports, self.opts.iterations, self.opts.read_only)
+        bench.DEBUG_FLAG = self.opts.debug
+        try:
+            if self.opts.startup:
+                results = bench.run_startup()
+            else:
+                results = bench.run()
+        finally:
+            for sim in sims:
+                sim.close()
+
+        bench.report()
+        if self.opts.json != "":
+            data = { 'timestamp' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     'host' : platform.node(),
+                     'python' : platform.python_version(),
+                     'hubs' : len(hub_serial_ports),
+                     'simulated' : self.opts.sim > 0,
+                     'sim_latency' : self.opts.sim_latency,
+                     'results' : results }
+            with open(self.opts.json, 'w') as data_file:
+                json.dump(data, data_file, indent=4, sort_keys=True)
+            print "wrote %s" % self.opts.json
+
+        over_budget = bench.check_startup_budget(self.opts.startup_budget)
+        if over_budget:
+            sys.stderr.write('Error: %s exceeded the startup budget of %dms\n' % (', '.join(over_budget), self.opts.startup_budget))
+            return 1
+        return 0
+
+
+if __name__=='__main__':
+
+    app = MbedUsbBenchTheApp()
+    sys.exit(app.mbed_usb_bench_main())
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+#############################################################################
+# mbed_usb_cli.py
+#  Script to:
+#   - run mbed_usb.py from its compiled module (mbed_usb.pyc). python
+#     compiles a script run as python mbed_usb.py every time it is run,
+#     which takes longer than the commands which only read the config files
+#     e.g. to list the targets or find the hub port K64F[0] is on:
+#       python mbed_usb_cli.py --platform_name_unique_list
+#       python mbed_usb_cli.py --platform_name_unique K64F[0] --lookup
+#     The options are the same as for mbed_usb.py.
+#
+#############################################################################
+# version 0.0.1     launcher for mbed_usb.py
+
+
+"""
+mbed USB hub command line launcher
+Copyright (c) 2011-2015 ARM Limited
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import sys
+import mbed_usb
+
+
+if __name__=='__main__':
+
+    app = mbed_usb.MbedUsbTheApp()
+    sys.exit(app.mbed_usb_main())
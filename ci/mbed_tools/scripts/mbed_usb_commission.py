@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+#############################################################################
+# mbed_usb_commission.py
+#  Commissioning of the hubs managed by mbed_usb.py: discovers which hub
+#  port each target is connected to and writes the card config files
+#  e.g. python mbed_usb.py --commission
+#
+#############################################################################
+# version 0.0.1     split out of mbed_usb.py
+
+
+"""
+mbed USB commissioning
+Copyright (c) 2011-2015 ARM Limited
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import sys
+import time
+import re
+
+from mbed_usb import MbedUsbHub
+from mbed_usb import MbedBootTimes
+from mbed_usb import MbedUsbTheApp
+
+
+class MbedUsbCommissioner():
+    """ class for discovering the hub port of each target and writing the card config files"""
+
+    # enumeration is considered to have settled once the set of detected
+    # targets has been unchanged for this time (s)
+    SETTLE_TIME = 3.0
+
+    # minimum time to wait after switching ports for targets without
+    # recorded boot times to enumerate (s). The MAXWSNENV takes 10s
+    DEFAULT_BOOT_WAIT = 10.0
+
+    # maximum time to wait for enumeration to settle after switching ports (s)
+    SETTLE_TIMEOUT = 30.0
+
+    # time between mbed_lstools enumerations (s)
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, hub, hub_id, boot_times=None):
+        """ Constuctor
+
+        @param hub          open MbedCambrionix instance to commission
+        @param hub_id       identifier of the hub in the subrack config
+        @param boot_times   MbedBootTimes the wait for targets to enumerate is
+                            derived from, by default MbedBootTimes.get()
+        """
+        self.DEBUG_FLAG = False     # Used to enable debug code / prints
+        self.hub = hub
+        self.hub_id = hub_id
+        self.boot_times = boot_times
+        self.mbeds = None
+
+    def debug(self, name, text):
+        """! Prints debug messages
+
+        @param name Called function name
+        @param text Text to be included in debug message
+        """
+        if self.DEBUG_FLAG is True:
+            print 'debug @%s.%s: %s'% (self.__class__.__name__, name, text)
+
+    def enumerate(self):
+        """! list the detected targets
+
+        @return dictionary of mbed_lstools target data keyed by target_id
+        """
+        if self.mbeds is None:
+            import mbed_lstools
+            self.mbeds = mbed_lstools.create()
+
+        result = {}
+        for mbed in self.mbeds.list_mbeds():
+            if mbed.get('target_id'):
+                result[mbed['target_id']] = mbed
+        return result
+
+    def enumerate_settled(self, min_wait=0.0):
+        """! list the detected targets once the set of targets has stopped changing
+
+        @param min_wait     time to wait before the set of targets can be taken to have settled (s)
+        """
+        start = time.time()
+        timeout = max(self.SETTLE_TIMEOUT, min_wait + self.SETTLE_TIME)
+        last_change = start
+        targets = self.enumerate()
+        while (time.time() - start < min_wait or time.time() - last_change < self.SETTLE_TIME) and time.time() - start < timeout:
+            time.sleep(self.POLL_INTERVAL)
+            current = self.enumerate()
+            if set(current) != set(targets):
+                last_change = time.time()
+            targets = current
+
+        self.debug(__name__, "enumerated %d targets after %.1fs" % (len(targets), time.time() - start))
+        return targets
+
+    def get_boot_wait(self, targets):
+        """! return the time to allow for the slowest of the targets to enumerate after power on (s)
+
+        @param targets  dictionary of mbed_lstools target data keyed by target_id
+        """
+        if self.boot_times is None:
+            self.boot_times = MbedBootTimes.get()
+        boot_wait = 0.0
+        for platform_name in set(mbed.get('platform_name', '') for mbed in targets.values()):
+            boot_wait = max(boot_wait, self.boot_times.get_wait(platform_name, None, self.DEFAULT_BOOT_WAIT))
+        return boot_wait
+
+    @staticmethod
+    def get_parity(code):
+        """! return 1 if code has an odd number of bits set, otherwise 0"""
+        return bin(code).count('1') & 1
+
+    def set_round(self, num_ports, is_on):
+        """! switch on the ports for which is_on(code) is True and the others off"""
+        ops = []
+        for num in range(0, num_ports):
+            if is_on(num+1):
+                ops.append((num, MbedUsbHub.PORT_STATE_ON))
+            else:
+                ops.append((num, MbedUsbHub.PORT_STATE_OFF))
+        self.hub.port_state_set_batch(ops)
+
+    def commission(self):
+        """! discover the hub port of each target attached to the hub
+
+        @details targets whose code doesnt map to a port of the hub, or which
+        fail the check round, are reported on stderr and left out of the result.
+        @return dictionary keyed by target_id of the tuple (hub_port_id, mbed_lstools target data)
+        """
+        num_ports = self.hub.MAX_PORTS
+        # codes 1..num_ports, avoiding 0 (never present) and all ones (always present)
+        num_bits = 1
+        while (1 << num_bits) - 1 <= num_ports:
+            num_bits += 1
+        all_ones = (1 << num_bits) - 1
+
+        # round 0: all ports on, to find all the targets and their details
+        self.hub.port_state_set_batch([(num, MbedUsbHub.PORT_STATE_ON) for num in range(0, num_ports)])
+        baseline = self.enumerate_settled(self.DEFAULT_BOOT_WAIT)
+        codes = dict((target_id, 0) for target_id in baseline)
+        boot_wait = self.get_boot_wait(baseline)
+        self.debug(__name__, "hub_id=%s boot_wait=%.1fs" % (self.hub_id, boot_wait))
+
+        for bit in range(0, num_bits):
+            self.set_round(num_ports, lambda code: code & (1 << bit))
+            present = self.enumerate_settled(boot_wait)
+            for target_id in codes:
+                if target_id in present:
+                    codes[target_id] |= (1 << bit)
+            self.debug(__name__, "hub_id=%s round %d: %d targets present" % (self.hub_id, bit+1, len(present)))
+
+        # check round: a target misread in one round is present when it
+        # should be absent or vice versa
+        self.set_round(num_ports, self.get_parity)
+        present = self.enumerate_settled(boot_wait)
+
+        # leave the hub with all ports on
+        self.hub.port_state_set_batch([(num, MbedUsbHub.PORT_STATE_ON) for num in range(0, num_ports)])
+
+        result = {}
+        for target_id in sorted(codes):
+            code = codes[target_id]
+            if code == all_ones:
+                self.debug(__name__, "hub_id=%s target_id=%s isnt on this hub" % (self.hub_id, target_id))
+            elif not 1 <= code <= num_ports:
+                sys.stderr.write('Warning: hub %s target %s has code %d which isnt a port, it may have been slow to enumerate\n' % (self.hub_id, target_id, code))
+            elif (target_id in present) != bool(self.get_parity(code)):
+                sys.stderr.write('Warning: hub %s target %s failed the check for port %d, it may have been slow to enumerate\n' % (self.hub_id, target_id, code - 1))
+            else:
+                result[target_id] = (code - 1, baseline[target_id])
+        return result
+
+    @staticmethod
+    def make_card_config(hub_targets, existing_names=()):
+        """! make the card config dictionaries from commissioning results
+
+        @param hub_targets      dictionary keyed by hub_id of commission() results
+        @param existing_names   platform_name_unique names already in use on hubs which
+                                arent being commissioned
+        @return dictionary keyed by hub_id of card config dictionaries
+        """
+        # platform_name_unique indices are allocated in (hub_id, hub_port_id)
+        # order, after any index of the same platform already in use
+        next_index = {}
+        for name in existing_names:
+            match = re.match(r'(.*)\[([0-9]+)\]$', name)
+            if match:
+                index = int(match.group(2)) + 1
+                next_index[match.group(1)] = max(next_index.get(match.group(1), 0), index)
+
+        entries = []
+        for hub_id in hub_targets:
+            for target_id in hub_targets[hub_id]:
+                (hub_port_id, mbed) = hub_targets[hub_id][target_id]
+                entries.append((hub_id, hub_port_id, target_id, mbed))
+        entries.sort(key=lambda entry: (MbedUsbTheApp.mbed_usb_natural_sort_key(entry[0]), entry[1]))
+
+        card_configs = dict((hub_id, {}) for hub_id in hub_targets)
+        for (hub_id, hub_port_id, target_id, mbed) in entries:
+            platform_name = mbed.get('platform_name') or 'unknown'
+            index = next_index.get(platform_name, 0)
+            next_index[platform_name] = index + 1
+            card_configs[hub_id][target_id] = {
+                'mount_point' : mbed.get('mount_point'),
+                'platform_name' : platform_name,
+                'platform_name_unique' : '%s[%d]' % (platform_name, index),
+                'serial_port' : mbed.get('serial_port'),
+                'target_id' : target_id,
+                'target_id_mbed_htm' : mbed.get('target_id_mbed_htm'),
+                'target_id_usb_id' : mbed.get('target_id_usb_id', target_id),
+                'hub_id' : hub_id,
+                'hub_port_id' : str(hub_port_id),
+                }
+        return card_configs
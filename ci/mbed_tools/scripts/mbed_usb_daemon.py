@@ -0,0 +1,921 @@
+#!/usr/bin/env python
+
+#############################################################################
+# mbed_usb_daemon.py
+#  Daemon owning the hubs managed by mbed_usb.py, its client, the port
+#  leases and the MbedHubController library interface e.g.
+#       python mbed_usb.py --daemon
+#       python mbed_usb.py --set on --platform_name_unique K64F[0]
+#
+#############################################################################
+# version 0.0.1     split out of mbed_usb.py
+
+
+"""
+mbed USB daemon
+Copyright (c) 2011-2015 ARM Limited
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import sys
+import time
+import json
+import socket
+import SocketServer
+import threading
+import Queue
+
+from mbed_usb import MbedUsbHub
+from mbed_usb import MbedCambrionix
+from mbed_usb import MbedRack
+from mbed_usb import MbedBootTimes
+from mbed_usb import MbedTargetReadiness
+from mbed_usb_telemetry import MbedUsbTelemetrySampler
+
+
+class MbedSingleFlight():
+    """ coalescing of identical concurrent operations"""
+
+    def __init__(self):
+        """ Constuctor"""
+        # key -> dictionary describing the operation in flight
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, func):
+        """! perform func(), or share the result of the identical operation in flight
+
+        @param key      hashable identifying the operation
+        @param func     function performing the operation
+        @return the tuple (result, shared) where shared is True if the result
+                was that of an operation started by another caller. An
+                exception raised by func() is raised in all the callers.
+        """
+        with self.lock:
+            flight = self.flights.get(key, None)
+            leader = flight is None
+            if leader:
+                flight = {'event' : threading.Event(), 'result' : None, 'error' : None, 'shared' : 0}
+                self.flights[key] = flight
+            else:
+                flight['shared'] += 1
+
+        if not leader:
+            flight['event'].wait()
+            if flight['error'] is not None:
+                raise flight['error']
+            return (flight['result'], True)
+
+        try:
+            flight['result'] = func()
+        except Exception as e:
+            flight['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight['event'].set()
+        return (flight['result'], False)
+
+
+class MbedPortLeaseManager():
+    """ exclusive, time limited leases of hub ports"""
+
+    DEFAULT_DURATION = 3600
+
+    def __init__(self):
+        """ Constuctor"""
+        # key -> lease dictionary
+        self.leases = {}
+        # lease_id -> lease dictionary
+        self.leases_by_id = {}
+        # notified when a lease is released
+        self.condition = threading.Condition()
+
+    @staticmethod
+    def keys_overlap(key, other_key):
+        """! return True if the ports identified by two keys overlap"""
+        if key[:2] != other_key[:2]:
+            return False
+        return key[2] == other_key[2] or MbedCambrionix.MAX_PORTS in (key[2], other_key[2])
+
+    def expire(self):
+        """! remove the leases which have expired. Called with self.condition held"""
+        now = time.time()
+        for lease in [lease for lease in self.leases.values() if lease['expires'] <= now]:
+            del self.leases[lease['key']]
+            del self.leases_by_id[lease['lease_id']]
+            self.condition.notify_all()
+
+    def find_conflict(self, key, lease_id=None):
+        """! return the lease held by someone else preventing access to the port(s), or None
+
+        Called with self.condition held.
+        """
+        for other_key in self.leases:
+            lease = self.leases[other_key]
+            if lease['lease_id'] != lease_id and self.keys_overlap(key, other_key):
+                return lease
+        return None
+
+    def acquire(self, key, owner, duration=DEFAULT_DURATION, wait=0):
+        """! acquire a lease of the port(s)
+
+        @param key          (subrack_id, hub_id, hub_port_id) tuple
+        @param owner        string identifying the lease holder e.g. jenkins job name
+        @param duration     time before the lease expires unless renewed (s)
+        @param wait         time to wait for the port(s) to become free (s)
+        @return the lease dictionary, or None if the port(s) didnt become free
+        """
+        deadline = time.time() + wait
+        with self.condition:
+            while True:
+                self.expire()
+                conflict = self.find_conflict(key)
+                if conflict is None:
+                    break
+                remaining = min(deadline, conflict['expires']) - time.time()
+                if time.time() >= deadline:
+                    return None
+                self.condition.wait(max(remaining, 0.01))
+
+            # random like uuid4, without the cost of importing uuid
+            lease = { 'lease_id' : os.urandom(16).encode('hex'),
+                      'key' : key,
+                      'owner' : owner,
+                      'expires' : time.time() + duration }
+            self.leases[key] = lease
+            self.leases_by_id[lease['lease_id']] = lease
+            return dict(lease)
+
+    def renew(self, lease_id, duration=DEFAULT_DURATION):
+        """! extend a lease
+
+        @return the lease dictionary, or None if the lease has expired or doesnt exist
+        """
+        with self.condition:
+            self.expire()
+            lease = self.leases_by_id.get(lease_id, None)
+            if lease is None:
+                return None
+            lease['expires'] = time.time() + duration
+            return dict(lease)
+
+    def release(self, lease_id):
+        """! release a lease
+
+        @return True if the lease was released, False if it had expired or doesnt exist
+        """
+        with self.condition:
+            lease = self.leases_by_id.pop(lease_id, None)
+            if lease is None:
+                return False
+            del self.leases[lease['key']]
+            self.condition.notify_all()
+            return True
+
+    def check(self, key, lease_id=None):
+        """! check the port(s) can be accessed with the lease lease_id (which may be None)
+
+        @return None if access is allowed, otherwise the conflicting lease dictionary
+        """
+        with self.condition:
+            self.expire()
+            conflict = self.find_conflict(key, lease_id)
+            if conflict is None:
+                return None
+            return dict(conflict)
+
+    def get_leases(self):
+        """! return a list of the current leases"""
+        with self.condition:
+            self.expire()
+            return [dict(lease) for lease in self.leases.values()]
+
+
+class MbedUsbDaemonRequestHandler(SocketServer.StreamRequestHandler):
+    """ handler for a client connection to the daemon, one line of json per request and response"""
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+                if request.get('cmd', '') == 'watch':
+                    self.server.mbed_usb_daemon.watch(self.wfile, float(request.get('interval', MbedUsbDaemon.WATCH_INTERVAL)))
+                    break
+                response = self.server.mbed_usb_daemon.do_request(request)
+            except Exception as e:
+                response = {'status' : 'error', 'error' : str(e)}
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+if hasattr(socket, 'AF_UNIX'):
+    class MbedUsbDaemonServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+        """ threaded unix socket server so one slow hub doesnt block clients of another hub"""
+        daemon_threads = True
+else:
+    # todo: no unix domain sockets on windows, so the daemon is only available on posix hosts
+    MbedUsbDaemonServer = None
+
+
+class MbedUsbDaemon():
+    """ long running process owning all the hubs of the rack, serving requests over a unix socket"""
+
+    DEFAULT_SOCKET_PATH = '/tmp/mbed_usb.sock'
+    WATCH_INTERVAL = 1.0
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, subrack_config_filenames=None, rack=None, config_dir=None):
+        """ Constuctor
+
+        @param socket_path                  path of the unix socket requests are served on
+        @param subrack_config_filenames     list of subrack config file names (see MbedRack)
+        @param rack                         MbedRack to use, instead of creating one from subrack_config_filenames
+        @param config_dir                   directory of the config files (see MbedRack)
+        """
+        self.DEBUG_FLAG = False     # Used to enable debug code / prints
+
+        self.socket_path = socket_path
+        self.server = None
+        self.rack = rack
+        if self.rack is None:
+            self.rack = MbedRack(subrack_config_filenames, config_dir)
+        self.lease_manager = MbedPortLeaseManager()
+        self.single_flight = MbedSingleFlight()
+        # optional MbedUsbTelemetrySampler sharing the hubs with the daemon
+        self.sampler = None
+
+    def debug(self, name, text):
+        """! Prints debug messages
+
+        @param name Called function name
+        @param text Text to be included in debug message
+        """
+        if self.DEBUG_FLAG is True:
+            print 'debug @%s.%s: %s'% (self.__class__.__name__, name, text)
+
+    def open(self):
+        """! open a connection to each hub enumerated in the subrack configs
+
+        @details hubs which arent opened here are opened when first used.
+        @return number of hubs opened
+        """
+        self.rack.set_debug(self.DEBUG_FLAG)
+        return self.rack.open_all()
+
+    def start_telemetry(self, pathname, interval=MbedUsbTelemetrySampler.DEFAULT_INTERVAL):
+        """! sample the current drawn by the ports of all the open hubs while serving requests
+
+        @param pathname     time series file the samples are flushed to
+        @param interval     time between samples of a hub (s)
+        """
+        self.sampler = MbedUsbTelemetrySampler(self.rack, pathname, interval)
+        self.sampler.DEBUG_FLAG = self.DEBUG_FLAG
+        self.sampler.start()
+        flush_thread = threading.Thread(target=self.sampler.run)
+        flush_thread.daemon = True
+        flush_thread.start()
+
+    def close(self):
+        """! close the connections to the hubs and remove the socket"""
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler = None
+        self.rack.close()
+        MbedBootTimes.flush_instance()
+        if self.server is not None:
+            self.server.server_close()
+            self.server = None
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def find_hub_port(self, request):
+        """! map the target addressed by a request to the tuple (subrack, hub_id, hub_port_id)
+
+        @return (subrack, hub_id, hub_port_id), or (None, None, None) if the target isnt found
+        """
+        platform_name_unique = request.get('platform_name_unique', '')
+        if platform_name_unique != '':
+            return self.rack.find(platform_name_unique=platform_name_unique)
+
+        port_num = int(request.get('port_num', MbedCambrionix.MAX_PORTS))
+        (subrack, hub_id) = self.rack.find_hub(request.get('hub_id', None), request.get('usb_hub_com_port', ''), request.get('subrack_id', '0'))
+        if subrack is None:
+            return (None, None, None)
+
+        return (subrack, hub_id, port_num)
+
+    @staticmethod
+    def lease_to_result(lease):
+        """! convert a lease dictionary to the json serialisable form returned to clients"""
+        (subrack_id, hub_id, hub_port_id) = lease['key']
+        return { 'lease_id' : lease['lease_id'],
+                 'owner' : lease['owner'],
+                 'subrack_id' : subrack_id,
+                 'hub_id' : hub_id,
+                 'port_num' : hub_port_id,
+                 'expires' : lease['expires'] }
+
+    def do_request(self, request):
+        """! perform the operation described by the request dictionary
+
+        @param request  one of
+            {"cmd" : "get", "platform_name_unique" : "K64F[0]"}
+            {"cmd" : "set", "platform_name_unique" : "K64F[0]", "state" : "on", "wait" : 10}
+            {"cmd" : "get", "usb_hub_com_port" : "COM51", "port_num" : 3}
+            {"cmd" : "get", "subrack_id" : "0", "hub_id" : "1", "port_num" : 3}
+            {"cmd" : "set_batch", "ops" : [<set request>, <set request>, ...]}
+            {"cmd" : "set_all", "state" : "off", "lease_ids" : [<lease_id>, ...]}
+            {"cmd" : "state"}
+            {"cmd" : "lease", "platform_name_unique" : "K64F[0]", "owner" : "job_1", "duration" : 600, "wait" : 60}
+            {"cmd" : "renew", "lease_id" : <lease_id>, "duration" : 600}
+            {"cmd" : "release", "lease_id" : <lease_id>}
+            {"cmd" : "leases"}
+        @return {"status" : "ok", "result" : <cmd specific>} or {"status" : "error", "error" : <string>}
+        @details a set with "wait" reports whether the target enumerated (on) or
+        was removed (off) as "ready", and identical concurrent sets share one
+        power transition (see MbedSingleFlight). Leased ports are only set with
+        the "lease_id" of the lease, or for set_all the "lease_ids" of all the leases.
+        """
+        self.debug(__name__, "request=%s" % request)
+        cmd = request.get('cmd', '')
+
+        if cmd == 'state':
+            # result of the form {<subrack_id> : {<hub_id> : [<port state>, ...]}}
+            snapshots = self.rack.port_state_snapshot()
+            result = {}
+            for (subrack_id, hub_id) in snapshots:
+                snapshot = snapshots[(subrack_id, hub_id)]
+                result.setdefault(subrack_id, {})[hub_id] = [snapshot[port]._asdict() for port in sorted(snapshot)]
+            return {'status' : 'ok', 'result' : result}
+
+        if cmd == 'leases':
+            return {'status' : 'ok', 'result' : [self.lease_to_result(lease) for lease in self.lease_manager.get_leases()]}
+
+        if cmd == 'renew':
+            lease = self.lease_manager.renew(request.get('lease_id', ''), float(request.get('duration', MbedPortLeaseManager.DEFAULT_DURATION)))
+            if lease is None:
+                return {'status' : 'error', 'error' : 'lease %s has expired or doesnt exist' % request.get('lease_id', '')}
+            return {'status' : 'ok', 'result' : self.lease_to_result(lease)}
+
+        if cmd == 'release':
+            if not self.lease_manager.release(request.get('lease_id', '')):
+                return {'status' : 'error', 'error' : 'lease %s has expired or doesnt exist' % request.get('lease_id', '')}
+            return {'status' : 'ok', 'result' : request['lease_id']}
+
+        on_off_map = { 'off' : MbedUsbHub.PORT_STATE_OFF , 'on' : MbedUsbHub.PORT_STATE_ON  }
+
+        if cmd == 'set_all':
+            if request.get('state', '') not in on_off_map:
+                return {'status' : 'error', 'error' : 'invalid set arg. valid args are %s' % on_off_map.keys()}
+            # only the leases held by the caller allow it to set all the ports
+            lease_ids = list(request.get('lease_ids', []))
+            if request.get('lease_id', None):
+                lease_ids.append(request['lease_id'])
+            owners = sorted(set([other['owner'] for other in self.lease_manager.get_leases() if other['lease_id'] not in lease_ids]))
+            if owners:
+                return {'status' : 'error', 'error' : 'ports are leased by %s' % owners}
+            return {'status' : 'ok', 'result' : self.rack.port_state_set_all(on_off_map[request['state']])}
+
+        if cmd == 'set_batch':
+            ops = []
+            for op in request.get('ops', []):
+                (subrack, hub_id, hub_port_id) = self.find_hub_port(op)
+                if subrack is None:
+                    return {'status' : 'error', 'error' : 'failed to find a valid hub for target %s' % op}
+                if op.get('state', '') not in on_off_map:
+                    return {'status' : 'error', 'error' : 'invalid set arg. valid args are %s' % on_off_map.keys()}
+                conflict = self.lease_manager.check((subrack.subrack_id, hub_id, hub_port_id), op.get('lease_id', request.get('lease_id', None)))
+                if conflict is not None:
+                    return {'status' : 'error', 'error' : 'port leased by %s' % conflict['owner']}
+                ops.append((subrack, hub_id, hub_port_id, on_off_map[op['state']]))
+            return {'status' : 'ok', 'result' : self.rack.port_state_set_batch(ops)}
+
+        if cmd not in ['get', 'set', 'lease']:
+            return {'status' : 'error', 'error' : 'unknown cmd (%s)' % cmd}
+
+        (subrack, hub_id, hub_port_id) = self.find_hub_port(request)
+        if subrack is None:
+            return {'status' : 'error', 'error' : 'failed to find a valid hub for this target'}
+        key = (subrack.subrack_id, hub_id, hub_port_id)
+
+        if cmd == 'lease':
+            # blocks this client's handler thread for upto wait seconds, other clients are unaffected
+            lease = self.lease_manager.acquire(key, request.get('owner', ''),
+                                               float(request.get('duration', MbedPortLeaseManager.DEFAULT_DURATION)),
+                                               float(request.get('wait', 0)))
+            if lease is None:
+                conflict = self.lease_manager.check(key)
+                return {'status' : 'error', 'error' : 'port leased by %s' % (conflict['owner'] if conflict else 'another client')}
+            return {'status' : 'ok', 'result' : self.lease_to_result(lease)}
+
+        if cmd == 'get':
+            if not MbedCambrionix().is_port_num_in_range(hub_port_id):
+                return {'status' : 'error', 'error' : 'port number (%d) out of range' % hub_port_id}
+            ret = subrack.port_state_get(hub_id, hub_port_id)
+            on_off_map = dict((v, k) for (k, v) in on_off_map.items())
+            return {'status' : 'ok', 'result' : on_off_map.get(ret, 'unknown')}
+
+        if request.get('state', '') not in on_off_map:
+            return {'status' : 'error', 'error' : 'invalid set arg. valid args are %s' % on_off_map.keys()}
+        conflict = self.lease_manager.check(key, request.get('lease_id', None))
+        if conflict is not None:
+            return {'status' : 'error', 'error' : 'port leased by %s' % conflict['owner']}
+
+        state = request['state']
+        # 'auto' waits for a time derived from the boot times of the target
+        wait = request.get('wait', 0)
+        wait = None if wait == 'auto' else float(wait)
+        start = time.time()
+
+        def power():
+            if subrack.port_state_set(hub_id, hub_port_id, on_off_map[state]) is None:
+                return {'status' : 'error', 'error' : 'failed to set port on hub %s' % hub_id}
+            response = {'status' : 'ok', 'result' : state}
+            if wait is None or wait > 0:
+                (ready, elapsed) = MbedTargetReadiness.wait_port(subrack.topology, hub_id, hub_port_id, on_off_map[state], wait)
+                response['ready'] = ready
+                response['elapsed'] = elapsed
+            return response
+
+        # requests which dont wait are only coalesced with each other, so a
+        # caller asking to wait is never given a response without a wait
+        (response, shared) = self.single_flight.do(key + (state, wait is None or wait > 0), power)
+        if shared:
+            self.debug(__name__, "shared in flight %s of %s" % (state, key))
+            response = dict(response, shared=True)
+            if response.get('ready', None) is False:
+                # the request in flight may have waited less than this caller
+                # asked, in which case the wait is continued for the remainder
+                remaining = MbedTargetReadiness.get_timeout(subrack.topology, hub_id, hub_port_id, on_off_map[state], wait) - (time.time() - start)
+                if remaining > 0:
+                    readiness = MbedTargetReadiness(subrack.topology.get_hub_port_data(hub_id, hub_port_id))
+                    response['ready'] = readiness.wait(on_off_map[state], remaining)[0]
+                    response['elapsed'] = time.time() - start
+        return response
+
+    def watch(self, wfile, interval=WATCH_INTERVAL):
+        """! stream port state change events to a client until it disconnects
+
+        @details the response {"status" : "ok", "result" : "watching"} is
+        written first, followed by a line of json for each event (see
+        MbedPortStateCache). The hubs are polled every interval seconds, but
+        only while at least one client is watching.
+        """
+        events = Queue.Queue()
+        self.rack.subscribe(events.put)
+        self.rack.start_watch(interval)
+        try:
+            wfile.write(json.dumps({'status' : 'ok', 'result' : 'watching'}) + '\n')
+            wfile.flush()
+            while True:
+                try:
+                    event = events.get(timeout=interval)
+                except Queue.Empty:
+                    # an empty line checks the client is still connected
+                    event = None
+                wfile.write((json.dumps(event) if event is not None else '') + '\n')
+                wfile.flush()
+        except (socket.error, IOError):
+            # client has gone away
+            pass
+        finally:
+            self.rack.unsubscribe(events.put)
+
+    def serve_forever(self):
+        """! serve client requests until interrupted"""
+        if MbedUsbDaemonServer is None:
+            raise RuntimeError('daemon requires unix domain socket support')
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.server = MbedUsbDaemonServer(self.socket_path, MbedUsbDaemonRequestHandler)
+        self.server.mbed_usb_daemon = self
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+
+class MbedUsbDaemonClient():
+    """ thin client for sending requests to a running MbedUsbDaemon"""
+
+    def __init__(self, socket_path=MbedUsbDaemon.DEFAULT_SOCKET_PATH):
+        """ Constuctor"""
+        self.socket_path = socket_path
+        self.sock = None
+        self.sock_file = None
+
+    @staticmethod
+    def is_running(socket_path=MbedUsbDaemon.DEFAULT_SOCKET_PATH):
+        """! check whether a daemon is listening on socket_path"""
+        if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+            return False
+        client = MbedUsbDaemonClient(socket_path)
+        try:
+            client.open()
+        except socket.error:
+            return False
+        client.close()
+        return True
+
+    def open(self):
+        """! connect to the daemon"""
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+        self.sock_file = self.sock.makefile('rb')
+
+    def close(self):
+        """! disconnect from the daemon"""
+        if self.sock_file is not None:
+            self.sock_file.close()
+            self.sock_file = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def request(self, request):
+        """! send a request to the daemon and wait for the response
+
+        @param request  dictionary describing the operation e.g. {"cmd" : "get", "platform_name_unique" : "K64F[0]"}
+        @return response dictionary
+        """
+        if self.sock is None:
+            self.open()
+        self.sock.sendall(json.dumps(request) + '\n')
+        line = self.sock_file.readline()
+        if not line:
+            raise socket.error('daemon closed connection')
+        return json.loads(line)
+
+    def watch(self, interval=MbedUsbDaemon.WATCH_INTERVAL):
+        """! generator yielding the port state change events sent by the daemon
+
+        @details the connection is used for nothing else once watching.
+        """
+        response = self.request({'cmd' : 'watch', 'interval' : interval})
+        if response['status'] != 'ok':
+            raise socket.error(response['error'])
+        while True:
+            line = self.sock_file.readline()
+            if not line:
+                raise socket.error('daemon closed connection')
+            if line.strip():
+                yield json.loads(line)
+
+
+class MbedHubController():
+    """ library interface for controlling the power of targets, via the daemon if running"""
+
+    DEFAULT_WAIT_TIMEOUT = MbedTargetReadiness.DEFAULT_TIMEOUT
+
+    def __init__(self, subrack_config_filenames=None, daemon_socket=MbedUsbDaemon.DEFAULT_SOCKET_PATH, use_daemon=True, config_dir=None):
+        """ Constuctor
+
+        @param subrack_config_filenames     list of subrack config file names (see MbedRack)
+        @param daemon_socket                path of the daemon unix socket
+        @param use_daemon                   if False the hubs are always controlled in process
+        @param config_dir                   directory of the config and boot times files,
+                                            by default MbedUsbTheApp.DIR_PATH (see MbedRack)
+        """
+        self.DEBUG_FLAG = False     # Used to enable debug code / prints
+
+        self.daemon_socket = daemon_socket
+        self.use_daemon = use_daemon
+        # used to find the targets, and owns the hubs when controlling them in process
+        self.rack = MbedRack(subrack_config_filenames, config_dir)
+        # MbedUsbDaemonClient when a daemon is running, otherwise an MbedUsbDaemon performing the requests in process
+        self.backend = None
+        # platform_name_unique -> lease_id of the leases held by this controller
+        self.leases = {}
+        # serialises creating the backend and the requests sent to a daemon, so
+        # the controller can be shared between threads (e.g. mbed_jenkins.py --matrix)
+        self.lock = threading.Lock()
+
+    def debug(self, name, text):
+        """! Prints debug messages
+
+        @param name Called function name
+        @param text Text to be included in debug message
+        """
+        if self.DEBUG_FLAG is True:
+            print 'debug @%s.%s: %s'% (self.__class__.__name__, name, text)
+
+    def close(self):
+        """! release any leases held and close the connection to the daemon, or the hubs"""
+        for platform_name_unique in self.leases.keys():
+            self.release(platform_name_unique)
+        if self.backend is not None:
+            self.backend.close()
+            self.backend = None
+        self.rack.close()
+        MbedBootTimes.flush_instance()
+
+    def request(self, request):
+        """! perform a daemon request (see MbedUsbDaemon), in process if no daemon is running
+
+        @return response dictionary
+        """
+        with self.lock:
+            if self.backend is None:
+                if self.use_daemon and MbedUsbDaemonClient.is_running(self.daemon_socket):
+                    self.backend = MbedUsbDaemonClient(self.daemon_socket)
+                else:
+                    self.backend = MbedUsbDaemon(self.daemon_socket, rack=self.rack)
+                    self.rack.set_debug(self.DEBUG_FLAG)
+                self.debug(__name__, "using %s" % self.backend.__class__.__name__)
+
+            if isinstance(self.backend, MbedUsbDaemonClient):
+                try:
+                    return self.backend.request(request)
+                except socket.error as e:
+                    # the daemon has gone away so take over the hubs
+                    sys.stderr.write('Warning: lost connection to daemon (%s), controlling hubs in process\n' % e)
+                    self.backend.close()
+                    self.backend = MbedUsbDaemon(self.daemon_socket, rack=self.rack)
+            backend = self.backend
+
+        # the in process daemon serves concurrent requests (as it does for its clients)
+        return backend.do_request(request)
+
+    def get(self, platform_name_unique):
+        """! get the power state of a target
+
+        @return 'on' or 'off', or None if the state couldnt be determined
+        """
+        response = self.request({'cmd' : 'get', 'platform_name_unique' : platform_name_unique})
+        if response['status'] != 'ok':
+            sys.stderr.write('Error: %s\n' % response['error'])
+            return None
+        return {'on' : 'on', 'off' : 'off'}.get(response['result'], None)
+
+    def power(self, platform_name_unique, state, wait=True, timeout=DEFAULT_WAIT_TIMEOUT):
+        """! turn a target on or off
+
+        @param platform_name_unique     target e.g. K64F[0]
+        @param state                    'on', 'off', True (on) or False (off)
+        @param wait                     if True wait for the target to enumerate (on) or be removed (off)
+        @param timeout                  maximum time to wait (s), or None to derive it from
+                                        the boot times of the target (see MbedBootTimes)
+        @return ERROR_SUCCESS, or ERROR_FAIL if the target wasnt set to the state or didnt become ready.
+                ERROR_SUCCESS is returned without waiting if the readiness of the
+                target cant be detected (see MbedTargetReadiness.wait_port())
+        """
+        if state is True or state is False:
+            state = {True : 'on', False : 'off'}[state]
+
+        # the wait is performed with the set so that it is shared by concurrent
+        # identical requests
+        request = {'cmd' : 'set', 'platform_name_unique' : platform_name_unique, 'state' : state}
+        if wait:
+            request['wait'] = 'auto' if timeout is None else timeout
+        if platform_name_unique in self.leases:
+            request['lease_id'] = self.leases[platform_name_unique]
+        response = self.request(request)
+        if response['status'] != 'ok':
+            sys.stderr.write('Error: %s\n' % response['error'])
+            return MbedUsbHub.ERROR_FAIL
+
+        if wait and response.get('ready', False) is None:
+            sys.stderr.write('Warning: cant detect if %s is %s, target_id not in the card config\n' % (platform_name_unique, {'on' : 'enumerated', 'off' : 'removed'}[state]))
+        elif wait and not response.get('ready', False):
+            sys.stderr.write('Warning: %s not %s after %ds\n' % (platform_name_unique, {'on' : 'enumerated', 'off' : 'removed'}[state], response.get('elapsed', 0)))
+            return MbedUsbHub.ERROR_FAIL
+        return MbedUsbHub.ERROR_SUCCESS
+
+    def lease(self, platform_name_unique, owner, duration=MbedPortLeaseManager.DEFAULT_DURATION, wait=0):
+        """! acquire exclusive control of the port a target is on
+
+        @details leases are only shared between processes when a daemon is
+        running, so executors sharing the hubs should run mbed_usb.py --daemon.
+        Subsequent power() calls for the target use the lease.
+        @param owner        string identifying the lease holder e.g. jenkins job name
+        @param duration     time before the lease expires unless renewed (s)
+        @param wait         time to wait for a lease held by someone else to be released (s)
+        @return ERROR_SUCCESS, or ERROR_FAIL if the port is leased by someone else
+        """
+        response = self.request({'cmd' : 'lease', 'platform_name_unique' : platform_name_unique,
+                                 'owner' : owner, 'duration' : duration, 'wait' : wait})
+        if response['status'] != 'ok':
+            sys.stderr.write('Error: %s\n' % response['error'])
+            return MbedUsbHub.ERROR_FAIL
+        self.leases[platform_name_unique] = response['result']['lease_id']
+        return MbedUsbHub.ERROR_SUCCESS
+
+    def renew(self, platform_name_unique, duration=MbedPortLeaseManager.DEFAULT_DURATION):
+        """! extend the lease of the port a target is on
+
+        @return ERROR_SUCCESS, or ERROR_FAIL if the lease had expired
+        """
+        response = self.request({'cmd' : 'renew', 'lease_id' : self.leases.get(platform_name_unique, ''), 'duration' : duration})
+        if response['status'] != 'ok':
+            sys.stderr.write('Error: %s\n' % response['error'])
+            self.leases.pop(platform_name_unique, None)
+            return MbedUsbHub.ERROR_FAIL
+        return MbedUsbHub.ERROR_SUCCESS
+
+    def release(self, platform_name_unique):
+        """! release the lease of the port a target is on"""
+        lease_id = self.leases.pop(platform_name_unique, None)
+        if lease_id is not None:
+            self.request({'cmd' : 'release', 'lease_id' : lease_id})
+
+    def restart(self, platform_name_unique, timeout_off=3, timeout_on=DEFAULT_WAIT_TIMEOUT):
+        """! power cycle a target, waiting for it to be removed and then to enumerate
+
+        @return ERROR_SUCCESS, or ERROR_FAIL if the target didnt come back up
+        """
+        # carry on if the target isnt seen to go away, it may not have been on
+        self.power(platform_name_unique, 'off', True, timeout_off)
+        return self.power(platform_name_unique, 'on', True, timeout_on)
+
+    def power_all(self, state):
+        """! turn all the ports on all the hubs on or off
+
+        @return ERROR_SUCCESS or ERROR_FAIL
+        """
+        response = self.request({'cmd' : 'set_all', 'state' : state, 'lease_ids' : self.leases.values()})
+        if response['status'] != 'ok':
+            sys.stderr.write('Error: %s\n' % response['error'])
+            return MbedUsbHub.ERROR_FAIL
+        return MbedUsbHub.ERROR_SUCCESS
+
+    def wait(self, platform_name_unique, state, timeout=DEFAULT_WAIT_TIMEOUT):
+        """! wait for a target to enumerate (on) or be removed (off)
+
+        @details if the target or its target_id isnt in the card config its
+        presence cant be detected, so nothing is waited.
+        @param timeout  maximum time to wait (s), or None to derive it from the boot times of the target
+        @return True if the target is ready, False if it isnt, or None if its readiness cant be detected
+        """
+        (subrack, hub_id, hub_port_id) = self.rack.find(platform_name_unique=platform_name_unique)
+        ready = None
+        if subrack is not None:
+            on_off_map = { 'off' : MbedUsbHub.PORT_STATE_OFF , 'on' : MbedUsbHub.PORT_STATE_ON  }
+            (ready, elapsed) = MbedTargetReadiness.wait_port(subrack.topology, hub_id, hub_port_id, on_off_map[state], timeout)
+            self.debug(__name__, "target %s ready=%s after %.2fs" % (platform_name_unique, ready, elapsed))
+        if ready is None:
+            sys.stderr.write('Warning: cant detect if %s is %s, target_id not in the card config\n' % (platform_name_unique, {'on' : 'enumerated', 'off' : 'removed'}[state]))
+        elif not ready:
+            sys.stderr.write('Warning: %s not %s after %ds\n' % (platform_name_unique, {'on' : 'enumerated', 'off' : 'removed'}[state], elapsed))
+        return ready
+
+
+class MbedUsbBatch():
+    """ runs a script of operations with one MbedHubController (see parse_line())"""
+
+    # cmd -> names of the arguments of the text form, the trailing ones being optional
+    TEXT_OPS = { 'set' : (['platform_name_unique', 'state'], ['wait']),
+                 'get' : (['platform_name_unique'], []),
+                 'wait' : (['platform_name_unique', 'state'], ['timeout']),
+                 'state' : ([], []),
+                 'set_all' : (['state'], []),
+                 'lease' : (['platform_name_unique', 'owner'], ['duration']),
+                 'sleep' : (['time'], []) }
+
+    def __init__(self, controller, outfile=sys.stdout):
+        """ Constuctor
+
+        @param controller   MbedHubController performing the operations
+        @param outfile      file the json lines results are written to
+        """
+        self.DEBUG_FLAG = False     # Used to enable debug code / prints
+
+        self.controller = controller
+        self.outfile = outfile
+
+    def debug(self, name, text):
+        """! Prints debug messages
+
+        @param name Called function name
+        @param text Text to be included in debug message
+        """
+        if self.DEBUG_FLAG is True:
+            print 'debug @%s.%s: %s'% (self.__class__.__name__, name, text)
+
+    @classmethod
+    def parse_line(cls, line):
+        """! parse a line of the script
+
+        @param line     a daemon request in json (see MbedUsbDaemon.do_request()), or one of
+            set <platform_name_unique> on|off [<wait timeout (s)>|auto]
+            get <platform_name_unique>
+            wait <platform_name_unique> on|off [<timeout (s)>|auto]
+            state
+            set_all on|off
+            lease <platform_name_unique> <owner> [<duration (s)>]
+            sleep <time (s)>
+        @return the operation dictionary, or None for a blank or comment line
+        @details ValueError is raised if the line isnt valid.
+        """
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            return None
+        if line.startswith('{'):
+            op = json.loads(line)
+            if not isinstance(op, dict) or 'cmd' not in op:
+                raise ValueError('json operation without a cmd')
+            return op
+
+        words = line.split()
+        if words[0] not in cls.TEXT_OPS:
+            raise ValueError('unknown operation %s. valid operations are %s' % (words[0], sorted(cls.TEXT_OPS)))
+        (required, optional) = cls.TEXT_OPS[words[0]]
+        args = words[1:]
+        if len(args) < len(required) or len(args) > len(required) + len(optional):
+            raise ValueError('usage: %s %s' % (words[0], ' '.join(required + ['[%s]' % name for name in optional])))
+        op = {'cmd' : words[0]}
+        for (name, value) in zip(required + optional, args):
+            op[name] = value
+        return op
+
+    @staticmethod
+    def get_timeout(value):
+        """! convert a wait/timeout argument to seconds, or None for 'auto'"""
+        if value is None or value == 'auto':
+            return None
+        return float(value)
+
+    def execute(self, op):
+        """! perform an operation
+
+        @return response dictionary as for MbedUsbDaemon.do_request()
+        """
+        cmd = op['cmd']
+
+        if cmd == 'sleep':
+            time.sleep(float(op['time']))
+            return {'status' : 'ok', 'result' : float(op['time'])}
+
+        if cmd == 'wait':
+            if op.get('state', '') not in ['on', 'off']:
+                return {'status' : 'error', 'error' : 'invalid wait state. valid states are %s' % ['on', 'off']}
+            ready = self.controller.wait(op['platform_name_unique'], op['state'], self.get_timeout(op.get('timeout', 'auto')))
+            return {'status' : 'ok', 'result' : op['state'], 'ready' : ready}
+
+        request = dict(op)
+        if cmd == 'set':
+            if 'wait' in op:
+                timeout = self.get_timeout(op['wait'])
+                request['wait'] = 'auto' if timeout is None else timeout
+            if 'lease_id' not in op and op.get('platform_name_unique', '') in self.controller.leases:
+                request['lease_id'] = self.controller.leases[op['platform_name_unique']]
+        elif cmd == 'set_all':
+            request['lease_ids'] = self.controller.leases.values()
+
+        response = self.controller.request(request)
+        if cmd == 'lease' and response['status'] == 'ok':
+            self.controller.leases[op['platform_name_unique']] = response['result']['lease_id']
+        return response
+
+    def run(self, infile, stop_on_error=False):
+        """! perform the operations in a script
+
+        @param infile           file to read the script from e.g. sys.stdin
+        @param stop_on_error    if True stop at the first operation which fails
+        @return the number of operations which failed
+        """
+        failures = 0
+        line_num = 0
+        # readline rather than iteration so lines piped on stdin are performed as they arrive
+        for line in iter(infile.readline, ''):
+            line_num += 1
+            start = time.time()
+            op = None
+            try:
+                op = self.parse_line(line)
+                if op is None:
+                    continue
+                response = self.execute(op)
+            except (ValueError, KeyError, IOError, socket.error) as e:
+                response = {'status' : 'error', 'error' : '%s: %s' % (e.__class__.__name__, e)}
+
+            result = dict(response, line=line_num, op=op if op is not None else line.strip(), elapsed=time.time() - start)
+            self.outfile.write(json.dumps(result, sort_keys=True) + '\n')
+            self.outfile.flush()
+
+            if response['status'] != 'ok':
+                failures += 1
+                if stop_on_error:
+                    break
+        return failures
@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+
+#############################################################################
+# mbed_usb_sim.py
+#  Script to:
+#   - simulate Cambrionix USB Hubs on pseudo terminals so the hub control
+#     code in mbed_usb.py can be exercised and benchmarked without hardware
+#     e.g. to simulate 2 hubs taking 5ms to process each command:
+#       python mbed_usb_sim.py --hubs 2 --latency 0.005
+#     The pty device of each simulated hub is printed, and can be passed to
+#     mbed_usb.py in place of the hub com port.
+#
+#############################################################################
+# version 0.0.1     simulator speaking the system, state and mode commands
+# version 0.0.2     --write_config also writes the card config files
+
+
+"""
+mbed USB hub simulator
+Copyright (c) 2011-2015 ARM Limited
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import sys
+import optparse
+import time
+import json
+import random
+import select
+import threading
+import pty
+import tty
+
+
+class MbedCambrionixSimulator():
+    """ simulation of a Cambrionix hub on a pseudo terminal
+
+    The simulator speaks the subset of the Cambrionix command line protocol
+    used by MbedCambrionix:
+        - each command is terminated by '\\r' and echoed back
+        - the command output follows the echo
+        - the response is terminated by the '>> ' prompt
+        - ctrl-c (0x03) abandons the current line and prints a new prompt
+    The system, state and mode commands are implemented. Each port is either
+    in sync mode (powered, flag S) or off (flag O), and a port with a target
+    attached draws current and accumulates energy while powered.
+
+    Faults can be injected with probability fault_rate per command:
+        drop        no response at all
+        truncate    the response is cut short and the prompt is missing
+        garble      a byte of the response is corrupted
+        delay       the response is delayed by fault_delay seconds
+    """
+
+    DESCRIPTION = 'cambrionix U12S 12 Port USB Charge+Sync'
+    PROMPT = '>> '
+    FAULTS = ['drop', 'truncate', 'garble', 'delay']
+    # current drawn by a powered port with a target attached (mA)
+    TARGET_CURRENT_MA = 100
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, num_ports=12, latency=0.0, fault_rate=0.0, faults=None, fault_delay=3.0, attached=None, seed=None):
+        """ Constuctor
+
+        @param num_ports    number of ports on the hub
+        @param latency      time taken to process a command (s). Either a number
+                            applying to all commands, or a dictionary keyed by
+                            command name (e.g. {'state' : 0.01, 'mode' : 0.002})
+        @param fault_rate   probability of a fault being injected into a response
+        @param faults       list of the faults to inject, defaults to FAULTS
+        @param fault_delay  time a response is delayed by the delay fault (s)
+        @param attached     list of the ports (enumerating from 0) with a target
+                            attached. Defaults to all the ports.
+        @param seed         seed for the fault injection random number generator
+        """
+        self.DEBUG_FLAG = False     # Used to enable debug code / prints
+
+        self.num_ports = num_ports
+        self.latency = latency
+        self.fault_rate = fault_rate
+        self.faults = faults
+        if self.faults is None:
+            self.faults = self.FAULTS
+        self.fault_delay = fault_delay
+        self.attached = attached
+        if self.attached is None:
+            self.attached = range(0, num_ports)
+        self.random = random.Random(seed)
+
+        # port mode, 's' (sync) or 'o' (off), enumerating from 0
+        self.modes = ['s'] * num_ports
+        self.energy = [0.0] * num_ports
+        self.energy_time = time.time()
+
+        # number of commands processed, keyed by command name
+        self.cmd_counts = {}
+        # number of faults injected, keyed by fault name
+        self.fault_counts = {}
+
+        self.master_fd = None
+        self.slave_fd = None
+        self.port = ''
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def debug(self, name, text):
+        """! Prints debug messages
+
+        @param name Called function name
+        @param text Text to be included in debug message
+        """
+        if self.DEBUG_FLAG is True:
+            print 'debug @%s.%s: %s'% (self.__class__.__name__, name, text)
+
+    def open(self):
+        """! create the pseudo terminal and start serving commands
+
+        @return the name of the pty device to be opened as the hub serial port
+        """
+        (self.master_fd, self.slave_fd) = pty.openpty()
+        # no echo or line editing by the terminal driver, the simulator does its own echo
+        tty.setraw(self.slave_fd)
+        self.port = os.ttyname(self.slave_fd)
+
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+        self.debug(__name__, "simulating hub on %s" % self.port)
+        return self.port
+
+    def close(self):
+        """! stop serving commands and remove the pseudo terminal"""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for fd in [self.master_fd, self.slave_fd]:
+            if fd is not None:
+                os.close(fd)
+        self.master_fd = None
+        self.slave_fd = None
+
+    def serve(self):
+        """! read commands from the pty and write the responses until closed"""
+        line = ''
+        while not self.stop_event.is_set():
+            (readable, writable, exceptional) = select.select([self.master_fd], [], [], self.POLL_INTERVAL)
+            if not readable:
+                continue
+            try:
+                data = os.read(self.master_fd, 4096)
+            except OSError:
+                break
+
+            for char in data:
+                if char == '\x03':
+                    # ctrl-c abandons the line
+                    line = ''
+                    self.write('^C\r\n' + self.PROMPT)
+                elif char == '\r':
+                    self.do_command(line)
+                    line = ''
+                elif char != '\n':
+                    line += char
+
+    def write(self, data):
+        """! write data to the pty"""
+        while data:
+            written = os.write(self.master_fd, data)
+            data = data[written:]
+
+    def get_latency(self, name):
+        """! return the time taken to process the command name"""
+        if isinstance(self.latency, dict):
+            return self.latency.get(name, 0.0)
+        return self.latency
+
+    def do_command(self, line):
+        """! process a command line and write the response, injecting a fault if one is due"""
+        name = line.split()[0] if line.split() else ''
+        self.cmd_counts[name] = self.cmd_counts.get(name, 0) + 1
+
+        response = line + '\r\n' + self.execute(line) + '\r\n' + self.PROMPT
+        time.sleep(self.get_latency(name))
+
+        if self.fault_rate > 0 and self.random.random() < self.fault_rate:
+            fault = self.random.choice(self.faults)
+            self.fault_counts[fault] = self.fault_counts.get(fault, 0) + 1
+            self.debug(__name__, "injecting %s fault into response to '%s'" % (fault, line))
+            if fault == 'drop':
+                return
+            elif fault == 'truncate':
+                response = response[:self.random.randint(0, len(response) - len(self.PROMPT))]
+            elif fault == 'garble':
+                index = self.random.randint(0, len(response) - 1)
+                response = response[:index] + chr(self.random.randint(0x80, 0xff)) + response[index+1:]
+            elif fault == 'delay':
+                time.sleep(self.fault_delay)
+
+        self.write(response)
+
+    def execute(self, line):
+        """! execute a command line
+
+        @return the command output (without the echo or prompt)
+        """
+        args = line.split()
+        if not args:
+            return ''
+
+        if args[0] == 'system':
+            return self.cmd_system()
+        elif args[0] == 'state':
+            return self.cmd_state(args[1:])
+        elif args[0] == 'mode':
+            return self.cmd_mode(args[1:])
+
+        return 'Error: unknown command %s' % args[0]
+
+    def cmd_system(self):
+        """! output of the system command"""
+        return '\r\n'.join([self.DESCRIPTION,
+                            'Hardware: U12S',
+                            'Firmware: 1.55 (simulated)',
+                            'Group: -',
+                            'Panel ID: Absent'])
+
+    def update_energy(self):
+        """! accumulate the energy consumed by the powered ports since the last update"""
+        now = time.time()
+        hours = (now - self.energy_time) / 3600.0
+        self.energy_time = now
+        for port_num in range(0, self.num_ports):
+            self.energy[port_num] += self.port_current_ma(port_num) * 5.0 / 1000.0 * hours
+
+    def port_current_ma(self, port_num):
+        """! current drawn by a port (mA)"""
+        if self.modes[port_num] == 's' and port_num in self.attached:
+            return self.TARGET_CURRENT_MA
+        return 0
+
+    def cmd_state(self, args):
+        """! output of the state command, for all the ports or the port args[0]"""
+        if args:
+            if not args[0].isdigit() or not 1 <= int(args[0]) <= self.num_ports:
+                return 'Error: invalid port %s' % args[0]
+            port_nums = [int(args[0]) - 1]
+        else:
+            port_nums = range(0, self.num_ports)
+
+        self.update_energy()
+        lines = []
+        for port_num in port_nums:
+            flags = ['R']
+            flags.append('A' if port_num in self.attached and self.modes[port_num] == 's' else 'D')
+            flags.append('S' if self.modes[port_num] == 's' else 'O')
+            lines.append('%d, %04d, %s, 0, 0, x, %.2f' % (port_num + 1, self.port_current_ma(port_num), ' '.join(flags), self.energy[port_num]))
+        return '\r\n'.join(lines)
+
+    def cmd_mode(self, args):
+        """! output of the mode command i.e. mode o|s <port>"""
+        if len(args) != 2 or args[0] not in ['o', 's'] or not args[1].isdigit() or not 1 <= int(args[1]) <= self.num_ports:
+            return 'Error: usage mode o|s <port>'
+        self.update_energy()
+        self.modes[int(args[1]) - 1] = args[0]
+        return ''
+
+
+class MbedUsbSimTheApp():
+    """ the mbed_usb_sim.py command line application"""
+
+    def __init__(self):
+        """ Constuctor"""
+        self.DEBUG_FLAG = False
+        self.opts = None
+        self.args = None
+        self.hubs = []
+
+    def mbed_usb_sim_cmd_parser_setup(self):
+        """! Configure CLI (Command Line OPtions) options
+
+        @return Returns OptionParser's tuple of (options, arguments)
+        """
+        parser = optparse.OptionParser()
+
+        parser.add_option('-d', '--debug',
+                          dest='debug',
+                          default=False,
+                          action="store_true",
+                          help='Outputs extra debug information')
+
+        parser.add_option('--hubs',
+                          type ='int',
+                          dest ='hubs',
+                          default=1,
+                          help='number of hubs to simulate (default 1)')
+
+        parser.add_option('--ports',
+                          type ='int',
+                          dest ='ports',
+                          default=12,
+                          help='number of ports per hub (default 12)')
+
+        parser.add_option('--latency',
+                          type ='float',
+                          dest ='latency',
+                          default=0.0,
+                          help='time taken by the hub to process a command in seconds (default 0)')
+
+        parser.add_option('--fault_rate',
+                          type ='float',
+                          dest ='fault_rate',
+                          default=0.0,
+                          help='probability of a fault being injected into each response (default 0)')
+
+        parser.add_option('--faults',
+                          type ='string',
+                          dest ='faults',
+                          default=','.join(MbedCambrionixSimulator.FAULTS),
+                          help='comma separated list of faults to inject (default %s)' % ','.join(MbedCambrionixSimulator.FAULTS))
+
+        parser.add_option('--seed',
+                          type ='int',
+                          dest ='seed',
+                          default=None,
+                          help='seed for the fault injection so runs are repeatable')
+
+        parser.add_option('--write_config',
+                          type ='string',
+                          dest ='write_config',
+                          default="",
+                          help='write a subrack config json file listing the simulated hubs, and the card config files it names, for use with mbed_usb.py --config_dir and --subrack_config')
+
+        return parser.parse_args()
+
+    def mbed_usb_sim_write_config(self, pathname):
+        """write a subrack config file with an entry for each simulated hub, and
+        the card config files it names in the same directory
+
+        each attached port has a simulated target named SIM[n], which can be
+        addressed by platform_name_unique. The simulated targets have no
+        target_id, serial port or mount point, so mbed_usb.py cant detect
+        when they are ready.
+
+        @return list of the pathnames of the files written
+        """
+        dir_path = os.path.dirname(os.path.abspath(pathname))
+        pathnames = [pathname]
+        config = {}
+        index = 0
+        for hub_id in range(0, len(self.hubs)):
+            config_file = 'MBED_USB_SIM_HUB_%02d.json' % hub_id
+            config[str(hub_id)] = { 'hub_name' : 'Cambrionix simulator %02d' % hub_id,
+                                    'hub_id' : str(hub_id),
+                                    'serial_port' : self.hubs[hub_id].port,
+                                    'config_file' : config_file }
+
+            # card config keyed by target_id as written by mbed_usb.py --commission
+            card_config = {}
+            for hub_port_id in sorted(self.hubs[hub_id].attached):
+                card_config['SIM_HUB_%02d_PORT_%02d' % (hub_id, hub_port_id)] = {
+                    'mount_point' : '',
+                    'platform_name' : 'SIM',
+                    'platform_name_unique' : 'SIM[%d]' % index,
+                    'serial_port' : '',
+                    'target_id' : '',
+                    'target_id_mbed_htm' : '',
+                    'target_id_usb_id' : '',
+                    'hub_id' : str(hub_id),
+                    'hub_port_id' : str(hub_port_id),
+                    }
+                index += 1
+            pathnames.append(os.path.join(dir_path, config_file))
+            with open(pathnames[-1], 'w') as data_file:
+                json.dump(card_config, data_file, indent=4, sort_keys=True)
+
+        with open(pathname, 'w') as data_file:
+            json.dump(config, data_file, indent=4, sort_keys=True)
+        return pathnames
+
+    def mbed_usb_sim_main(self):
+        """! Function used to drive CLI (command line interface) application
+
+        @return Function exits with successcode
+        """
+        (self.opts, self.args) = self.mbed_usb_sim_cmd_parser_setup()
+        self.DEBUG_FLAG = self.opts.debug
+
+        faults = [fault for fault in self.opts.faults.split(',') if fault]
+        for fault in faults:
+            if fault not in MbedCambrionixSimulator.FAULTS:
+                sys.stderr.write('Error: unknown fault %s. valid faults are %s\n' % (fault, MbedCambrionixSimulator.FAULTS))
+                return 1
+
+        for hub_id in range(0, self.opts.hubs):
+            seed = None if self.opts.seed is None else self.opts.seed + hub_id
+            hub = MbedCambrionixSimulator(self.opts.ports, self.opts.latency, self.opts.fault_rate, faults, seed=seed)
+            hub.DEBUG_FLAG = self.opts.debug
+            hub.open()
+            self.hubs.append(hub)
+            print "hub %d on %s" % (hub_id, hub.port)
+
+        if self.opts.write_config != "":
+            for pathname in self.mbed_usb_sim_write_config(self.opts.write_config):
+                print "wrote %s" % pathname
+
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+        for hub_id in range(0, len(self.hubs)):
+            hub = self.hubs[hub_id]
+            hub.close()
+            print "hub %d commands=%s faults=%s" % (hub_id, hub.cmd_counts, hub.fault_counts)
+        return 0
+
+
+# usage examples
+#
+# To simulate a hub and turn one of its ports off using mbed_usb.py:
+#
+#  python mbed_usb_sim.py
+#  python mbed_usb.py --usb_hub_com_port /dev/pts/5 --port 3 --set off --no_daemon
+#
+# To simulate 2 slow, unreliable hubs, run the mbed_usb.py daemon on them and
+# turn off the target SIM[3] (the config files are written to /tmp/sim):
+#
+#  python mbed_usb_sim.py --hubs 2 --latency 0.01 --fault_rate 0.05 --seed 1 --write_config /tmp/sim/mbed_usb_hubs_sim.json
+#  python mbed_usb.py --daemon --config_dir /tmp/sim --subrack_config mbed_usb_hubs_sim.json
+#  python mbed_usb.py --platform_name_unique SIM[3] --set off
+#
+# To run the regression tests of mbed_usb.py against the simulator:
+#
+#  python mbed_usb_test.py
+#
+if __name__=='__main__':
+
+    app = MbedUsbSimTheApp()
+    sys.exit(app.mbed_usb_sim_main())
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+
+#############################################################################
+# mbed_usb_telemetry.py
+#  Telemetry of the hubs managed by mbed_usb.py: the current drawn by each
+#  hub port is sampled into ring buffers and flushed to a time series file
+#  e.g. python mbed_usb.py --telemetry samples.bin
+#
+#############################################################################
+# version 0.0.1     split out of mbed_usb.py
+
+
+"""
+mbed USB telemetry
+Copyright (c) 2011-2015 ARM Limited
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import time
+import json
+import threading
+import array
+import struct
+
+
+class MbedPortRingBuffer():
+    """ fixed size ring buffer of the telemetry samples of a hub port"""
+
+    def __init__(self, capacity):
+        """ Constuctor
+
+        @param capacity     maximum number of samples held
+        """
+        self.capacity = capacity
+        self.timestamps = array.array('d', [0.0] * capacity)
+        self.current_ma = array.array('i', [0] * capacity)
+        self.flags = array.array('H', [0] * capacity)
+        self.energy = array.array('f', [0.0] * capacity)
+        # index of the next sample to be written
+        self.head = 0
+        # number of samples held
+        self.count = 0
+        # number of samples held which havent been flushed
+        self.unflushed = 0
+        # number of samples overwritten before being flushed
+        self.dropped = 0
+
+    def append(self, timestamp, current_ma, flags, energy):
+        """! add a sample, overwriting the oldest one if the buffer is full"""
+        self.timestamps[self.head] = timestamp
+        self.current_ma[self.head] = current_ma
+        self.flags[self.head] = flags
+        self.energy[self.head] = energy
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        if self.unflushed == self.capacity:
+            self.dropped += 1
+        else:
+            self.unflushed += 1
+
+    def samples(self, num=None):
+        """! return the most recent samples, oldest first
+
+        @param num  number of samples to return. Defaults to all the samples held
+        @return list of (timestamp, current_ma, flags, energy) tuples
+        """
+        if num is None or num > self.count:
+            num = self.count
+        result = []
+        for i in range(self.head - num, self.head):
+            result.append((self.timestamps[i], self.current_ma[i], self.flags[i], self.energy[i]))
+        return result
+
+    def take_unflushed(self):
+        """! return the samples which havent yet been flushed and mark them as flushed"""
+        result = self.samples(self.unflushed)
+        self.unflushed = 0
+        return result
+
+
+class MbedUsbTelemetrySampler():
+    """ class sampling the current drawn by the ports of the hubs of a rack (see RECORD_FORMAT)"""
+
+    DEFAULT_INTERVAL = 1.0
+    DEFAULT_CAPACITY = 3600
+    FLUSH_INTERVAL = 10.0
+
+    # timestamp, series, port_num, flags, current_ma, energy
+    RECORD_FORMAT = '<dHBHif'
+    RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+    # state flags recorded as a bit mask, bit n set if the flag FLAG_CHARS[n] is reported
+    FLAG_CHARS = 'OSBIPCFADRTE'
+
+    def __init__(self, rack, pathname='', interval=DEFAULT_INTERVAL, capacity=DEFAULT_CAPACITY):
+        """ Constuctor
+
+        @param rack         MbedRack instance owning the hubs
+        @param pathname     time series file the samples are flushed to. The samples
+                            are only held in memory if this isnt specified.
+        @param interval     time between samples of a hub (s)
+        @param capacity     number of samples held per port
+        """
+        self.DEBUG_FLAG = False     # Used to enable debug code / prints
+
+        self.rack = rack
+        self.pathname = pathname
+        self.interval = interval
+        self.capacity = capacity
+
+        # (subrack_id, hub_id, port_num) -> MbedPortRingBuffer
+        self.buffers = {}
+        # (subrack_id, hub_id) -> series number used in the time series file
+        self.series = {}
+        # number of samples skipped because the hub was busy
+        self.skipped = 0
+        # lock protecting self.buffers and self.series
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.threads = []
+
+    def debug(self, name, text):
+        """! Prints debug messages
+
+        @param name Called function name
+        @param text Text to be included in debug message
+        """
+        if self.DEBUG_FLAG is True:
+            print 'debug @%s.%s: %s'% (self.__class__.__name__, name, text)
+
+    @staticmethod
+    def flags_to_mask(flags):
+        """! convert a tuple of state flags e.g. ('R', 'D', 'S') to a bit mask"""
+        mask = 0
+        for flag in flags:
+            bit = MbedUsbTelemetrySampler.FLAG_CHARS.find(flag)
+            if bit != -1:
+                mask |= 1 << bit
+        return mask
+
+    @staticmethod
+    def mask_to_flags(mask):
+        """! convert a bit mask back to a tuple of state flags"""
+        chars = MbedUsbTelemetrySampler.FLAG_CHARS
+        return tuple([chars[bit] for bit in range(0, len(chars)) if mask & (1 << bit)])
+
+    def record(self, key, timestamp, snapshot):
+        """! store a hub port_state_snapshot() in the ring buffers
+
+        @param key          (subrack_id, hub_id) tuple identifying the hub
+        @param timestamp    time the snapshot was taken
+        @param snapshot     dictionary of MbedCambrionixPortState records keyed by port number
+        """
+        with self.lock:
+            if key not in self.series:
+                self.series[key] = len(self.series)
+            for port_num in snapshot:
+                buffer_key = key + (port_num,)
+                if buffer_key not in self.buffers:
+                    self.buffers[buffer_key] = MbedPortRingBuffer(self.capacity)
+                port_state = snapshot[port_num]
+                self.buffers[buffer_key].append(timestamp, port_state.current_ma, self.flags_to_mask(port_state.flags), port_state.energy)
+
+    def sample_hub(self, key, hub, hub_lock):
+        """! take a sample of a hub, unless the hub is busy
+
+        @return True if the sample was taken, otherwise False
+        """
+        if not hub_lock.acquire(False):
+            self.skipped += 1
+            return False
+        try:
+            timestamp = time.time()
+            snapshot = hub.port_state_snapshot()
+        finally:
+            hub_lock.release()
+        self.record(key, timestamp, snapshot)
+        # the sample also refreshes the cached port state, so watchers see the changes
+        self.rack.subracks[key[0]].state_cache.update(key[1], snapshot, timestamp)
+        return True
+
+    def run_hub(self, key, hub, hub_lock):
+        """! sample a hub every interval until stopped"""
+        next_time = time.time()
+        while not self.stop_event.is_set():
+            self.sample_hub(key, hub, hub_lock)
+            next_time += self.interval
+            delay = next_time - time.time()
+            if delay < 0:
+                # the hub is slower than the sampling rate so dont try to catch up
+                next_time = time.time()
+                delay = 0
+            self.stop_event.wait(delay)
+
+    def start(self):
+        """! start sampling all the hubs in the rack
+
+        @return number of hubs being sampled
+        """
+        (hubs, hub_locks) = self.rack.get_hubs()
+        self.stop_event.clear()
+        for key in sorted(hubs):
+            thread = threading.Thread(target=self.run_hub, args=(key, hubs[key], hub_locks[key]))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        self.debug(__name__, "sampling %d hub(s) every %ss" % (len(hubs), self.interval))
+        return len(hubs)
+
+    def stop(self):
+        """! stop sampling and flush the samples held"""
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.flush()
+
+    def run(self, duration=0):
+        """! sample until interrupted or for duration seconds, flushing every FLUSH_INTERVAL"""
+        end_time = time.time() + duration
+        try:
+            while True:
+                delay = self.FLUSH_INTERVAL
+                if duration > 0:
+                    if time.time() >= end_time:
+                        break
+                    delay = min(delay, end_time - time.time())
+                if self.stop_event.wait(delay):
+                    break
+                self.flush()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def flush(self):
+        """! append the samples which havent yet been flushed to the time series file
+
+        @return number of samples written
+        """
+        if self.pathname == '':
+            return 0
+
+        with self.lock:
+            records = []
+            for (subrack_id, hub_id, port_num) in self.buffers:
+                series = self.series[(subrack_id, hub_id)]
+                for (timestamp, current_ma, flags, energy) in self.buffers[(subrack_id, hub_id, port_num)].take_unflushed():
+                    records.append(struct.pack(self.RECORD_FORMAT, timestamp, series, port_num, flags, current_ma, energy))
+            series_list = [None] * len(self.series)
+            for key in self.series:
+                series_list[self.series[key]] = list(key)
+
+        # the series list is rewritten first so every record in the file can be decoded
+        with open(self.pathname + '.series.json', 'w') as data_file:
+            json.dump(series_list, data_file)
+        with open(self.pathname, 'ab') as data_file:
+            data_file.write(''.join(records))
+
+        self.debug(__name__, "flushed %d samples to %s" % (len(records), self.pathname))
+        return len(records)
+
+    def get_samples(self, subrack_id, hub_id, port_num, num=None):
+        """! return the most recent samples of a port held in memory, oldest first
+
+        @return list of (timestamp, current_ma, flags, energy) tuples
+        """
+        with self.lock:
+            ring_buffer = self.buffers.get((subrack_id, hub_id, port_num), None)
+            if ring_buffer is None:
+                return []
+            return ring_buffer.samples(num)
+
+    @staticmethod
+    def read(pathname):
+        """! read a time series file written by flush()
+
+        @return list of (timestamp, subrack_id, hub_id, port_num, flags, current_ma, energy) tuples
+        sorted by timestamp. flags is a tuple of the state flags.
+        """
+        with open(pathname + '.series.json') as data_file:
+            series_list = json.load(data_file)
+        with open(pathname, 'rb') as data_file:
+            data = data_file.read()
+
+        size = MbedUsbTelemetrySampler.RECORD_SIZE
+        result = []
+        for offset in range(0, len(data) - len(data) % size, size):
+            (timestamp, series, port_num, flags, current_ma, energy) = struct.unpack_from(MbedUsbTelemetrySampler.RECORD_FORMAT, data, offset)
+            (subrack_id, hub_id) = series_list[series]
+            result.append((timestamp, subrack_id, hub_id, port_num, MbedUsbTelemetrySampler.mask_to_flags(flags), current_ma, energy))
+        result.sort()
+        return result
@@ -0,0 +1,444 @@
+#!/usr/bin/env python
+
+#############################################################################
+# mbed_usb_test.py
+#  Regression tests of the hub control code in mbed_usb.py, run against
+#  the Cambrionix hub simulator in mbed_usb_sim.py so no hardware is needed
+#  e.g. for CI:
+#       python mbed_usb_test.py
+#  The simulator uses pseudo terminals, so the tests need a posix host and
+#  pyserial, and are skipped otherwise.
+#
+#############################################################################
+# version 0.0.1     recv framing, pipelining, io loop, daemon and power scheduler
+
+
+"""
+mbed USB tests
+Copyright (c) 2011-2015 ARM Limited
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from mbed_usb import MbedUsbHub
+from mbed_usb import MbedCambrionix
+from mbed_usb import MbedHubIoLoop
+from mbed_usb import MbedPowerScheduler
+from mbed_usb import MbedBootTimes
+from mbed_usb import MbedTargetReadiness
+from mbed_usb_daemon import MbedUsbDaemon
+from mbed_usb_daemon import MbedHubController
+from mbed_usb_commission import MbedUsbCommissioner
+
+try:
+    import serial
+    from mbed_usb_sim import MbedCambrionixSimulator
+    from mbed_usb_sim import MbedUsbSimTheApp
+except ImportError:
+    # pyserial isnt installed, or pseudo terminals arent supported (e.g.
+    # windows), so the tests needing the simulator are skipped
+    serial = None
+    MbedCambrionixSimulator = object
+    MbedUsbSimTheApp = None
+
+SIMULATOR_SKIP_REASON = 'the hub simulator needs pyserial and pseudo terminals'
+
+
+class MbedCambrionixSlowSimulator(MbedCambrionixSimulator):
+    """ simulator taking slow_time seconds to process the command line slow_command"""
+
+    slow_command = None
+    slow_time = 0.0
+
+    def do_command(self, line):
+        if line == self.slow_command:
+            time.sleep(self.slow_time)
+        MbedCambrionixSimulator.do_command(self, line)
+
+
+@unittest.skipIf(serial is None, SIMULATOR_SKIP_REASON)
+class MbedCambrionixTestCase(unittest.TestCase):
+    """ base class of the tests of an MbedCambrionix connected to a simulated hub"""
+
+    def open_hub(self, sim):
+        """! start the simulator and return an MbedCambrionix connected to it"""
+        hub = MbedCambrionix()
+        hub.open(sim.open())
+        self.assertIsNotNone(hub.handle, 'failed to open simulated hub on %s' % sim.port)
+        self.addCleanup(sim.close)
+        # run before sim.close() as cleanups are run last in first out
+        self.addCleanup(hub.close)
+        return hub
+
+
+class MbedCambrionixTest(MbedCambrionixTestCase):
+    """ tests of the MbedCambrionix serial protocol"""
+
+    def setUp(self):
+        self.sim = MbedCambrionixSlowSimulator()
+        self.hub = self.open_hub(self.sim)
+
+    def test_recv_prompt_framing(self):
+        # two responses arriving together are split at the prompt, and the
+        # command echo removed from each
+        self.hub.handle.write('state 1\rstate 2\r')
+        first = MbedCambrionix.parse_state(self.hub.recv('state 1'))
+        second = MbedCambrionix.parse_state(self.hub.recv('state 2'))
+        self.assertEqual([port_data['port_num'] for port_data in first], ['1'])
+        self.assertEqual([port_data['port_num'] for port_data in second], ['2'])
+        self.assertEqual(self.hub.rx_buf, '')
+
+    def test_recv_timeout_returns_none(self):
+        self.sim.fault_rate = 1.0
+        self.sim.faults = ['drop']
+        self.hub.send('state')
+        start = time.time()
+        self.assertIsNone(self.hub.recv('state', timeout=0.3))
+        self.assertLess(time.time() - start, MbedCambrionix.RECV_TIMEOUT)
+
+        # callers parsing the response see no data rather than a partial response
+        self.hub.RECV_TIMEOUT = 0.3
+        self.assertEqual(self.hub.cmd_state(), [])
+        self.assertEqual(self.hub.cmd_system(), {})
+
+    def test_port_state_set_batch_pipelined(self):
+        writes = []
+        write = self.hub.handle.write
+        def counting_write(data):
+            writes.append(data)
+            return write(data)
+        self.hub.handle.write = counting_write
+
+        acks = self.hub.port_state_set_batch([(num, MbedUsbHub.PORT_STATE_OFF) for num in range(0, MbedCambrionix.MAX_PORTS)])
+        self.assertEqual(acks, [''] * MbedCambrionix.MAX_PORTS)
+        self.assertEqual(self.sim.modes, ['o'] * MbedCambrionix.MAX_PORTS)
+        self.assertEqual(self.sim.cmd_counts['mode'], MbedCambrionix.MAX_PORTS)
+        # the first write fills the pipeline
+        self.assertEqual(writes[0].count('\r'), MbedCambrionix.PIPELINE_DEPTH)
+        self.assertLess(len(writes), MbedCambrionix.MAX_PORTS)
+
+    def test_port_state_set_batch_timeout_resyncs(self):
+        self.hub.RECV_TIMEOUT = 0.3
+        self.sim.slow_command = 'mode o 3'
+        self.sim.slow_time = 0.6
+
+        acks = self.hub.port_state_set_batch([(num, MbedUsbHub.PORT_STATE_OFF) for num in range(0, MbedCambrionix.MAX_PORTS)])
+        self.assertEqual(acks[:2], ['', ''])
+        self.assertEqual(acks[2:], [None] * (MbedCambrionix.MAX_PORTS - 2))
+        # the pipeline is topped up as the first 2 are acknowledged, and
+        # nothing is written after the timeout
+        self.assertEqual(self.sim.cmd_counts['mode'], MbedCambrionix.PIPELINE_DEPTH + 2)
+
+        # the responses to the commands in flight arent taken for later ones
+        self.sim.slow_command = None
+        self.assertEqual(self.hub.port_state_set(5, MbedUsbHub.PORT_STATE_ON), '')
+        self.assertEqual(self.hub.port_state_get(5), MbedUsbHub.PORT_STATE_ON)
+        self.assertEqual(self.hub.port_state_get(4), MbedUsbHub.PORT_STATE_OFF)
+        self.assertEqual(self.hub.port_state_get(11), MbedUsbHub.PORT_STATE_ON)
+
+
+class MbedHubIoLoopTest(MbedCambrionixTestCase):
+    """ tests of driving many hubs from MbedHubIoLoop"""
+
+    def setUp(self):
+        self.sims = [MbedCambrionixSimulator(latency=0.002) for hub_id in range(0, 2)]
+        self.hubs = dict([(hub_id, self.open_hub(self.sims[hub_id])) for hub_id in range(0, 2)])
+        self.io_loop = MbedHubIoLoop()
+        self.io_loop.start()
+        self.addCleanup(self.io_loop.stop)
+
+    def test_set_and_snapshot(self):
+        ops = [(0, num, MbedUsbHub.PORT_STATE_OFF) for num in range(0, MbedCambrionix.MAX_PORTS)] + [(1, 3, MbedUsbHub.PORT_STATE_OFF)]
+        result = self.io_loop.port_state_set_hubs(self.hubs, ops)
+        self.assertEqual(result, {0 : [''] * MbedCambrionix.MAX_PORTS, 1 : ['']})
+        self.assertEqual(self.sims[0].modes, ['o'] * MbedCambrionix.MAX_PORTS)
+
+        snapshots = self.io_loop.port_state_snapshot_hubs(self.hubs)
+        self.assertEqual(sorted(snapshots[1]), range(0, MbedCambrionix.MAX_PORTS))
+        self.assertIn('O', snapshots[1][3].flags)
+        self.assertIn('S', snapshots[1][4].flags)
+
+        # the hubs are handed back usable once the loop has finished with them
+        self.assertEqual(self.hubs[0].port_state_get(0), MbedUsbHub.PORT_STATE_OFF)
+
+    def test_restart(self):
+        self.io_loop.stop()
+        self.io_loop.stop()
+        self.io_loop.wake()
+        self.io_loop.start()
+        snapshots = self.io_loop.port_state_snapshot_hubs(self.hubs)
+        self.assertEqual(sorted(snapshots), [0, 1])
+
+    def test_eof_fails_commands(self):
+        # a serial port which has gone away reads as end of file
+        (read_fd, write_fd) = os.pipe()
+        os.close(write_fd)
+        self.addCleanup(os.close, read_fd)
+
+        class EofHandle():
+            def fileno(self):
+                return read_fd
+            def write(self, data):
+                return len(data)
+
+        hub = MbedCambrionix()
+        hub.handle = EofHandle()
+        future = self.io_loop.submit(hub, 'state')
+        self.assertRaises(IOError, future.result, 2.0)
+        self.assertNotIn(id(hub), self.io_loop.channels)
+
+
+@unittest.skipIf(serial is None, SIMULATOR_SKIP_REASON)
+class MbedUsbDaemonTest(unittest.TestCase):
+    """ tests of the daemon requests, performed in process on a rack of simulated hubs"""
+
+    SUBRACK_CONFIG_FILENAME = 'mbed_usb_hubs_sim.json'
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir_path)
+
+        # the config files written by mbed_usb_sim.py --write_config
+        self.sims = [MbedCambrionixSimulator() for hub_id in range(0, 2)]
+        for sim in self.sims:
+            sim.open()
+            self.addCleanup(sim.close)
+        sim_app = MbedUsbSimTheApp()
+        sim_app.hubs = self.sims
+        sim_app.mbed_usb_sim_write_config(os.path.join(self.dir_path, self.SUBRACK_CONFIG_FILENAME))
+
+        self.daemon = MbedUsbDaemon(os.path.join(self.dir_path, 'mbed_usb.sock'), [self.SUBRACK_CONFIG_FILENAME], config_dir=self.dir_path)
+        self.assertEqual(self.daemon.open(), 2)
+        self.addCleanup(self.daemon.close)
+
+    def test_get_set(self):
+        # SIM[3] is on port 3 of hub 0 and SIM[13] on port 1 of hub 1
+        for (name, sim, port) in [('SIM[3]', self.sims[0], 3), ('SIM[13]', self.sims[1], 1)]:
+            response = self.daemon.do_request({'cmd' : 'set', 'platform_name_unique' : name, 'state' : 'off'})
+            self.assertEqual(response, {'status' : 'ok', 'result' : 'off'})
+            self.assertEqual(sim.modes[port], 'o')
+            response = self.daemon.do_request({'cmd' : 'get', 'platform_name_unique' : name})
+            self.assertEqual(response, {'status' : 'ok', 'result' : 'off'})
+
+        response = self.daemon.do_request({'cmd' : 'get', 'platform_name_unique' : 'SIM[99]'})
+        self.assertEqual(response['status'], 'error')
+
+    def test_set_wait_readiness_unknown(self):
+        # the simulated targets have no target_id, so cant be waited for
+        start = time.time()
+        response = self.daemon.do_request({'cmd' : 'set', 'platform_name_unique' : 'SIM[0]', 'state' : 'on', 'wait' : 5})
+        self.assertEqual(response['status'], 'ok')
+        self.assertIsNone(response['ready'])
+        self.assertLess(time.time() - start, 5)
+
+    def test_set_wait_shared_with_shorter_wait(self):
+        # SIM[1] enumerates 0.6s after the test starts
+        topology = self.daemon.rack.subracks['0'].topology
+        (hub_id, hub_port_id) = topology.find('SIM[1]')
+        topology.get_hub_port_data(hub_id, hub_port_id)['target_id'] = 'SIM1'
+        ready_time = time.time() + 0.6
+        is_ready = MbedTargetReadiness.is_ready
+        MbedTargetReadiness.is_ready = lambda readiness, state: time.time() >= ready_time
+        self.addCleanup(setattr, MbedTargetReadiness, 'is_ready', is_ready)
+
+        responses = {}
+        def request(name, wait):
+            responses[name] = self.daemon.do_request({'cmd' : 'set', 'platform_name_unique' : 'SIM[1]', 'state' : 'on', 'wait' : wait})
+        leader = threading.Thread(target=request, args=('leader', 0.2))
+        leader.start()
+        time.sleep(0.05)
+        # joins the request in flight, but is prepared to wait longer
+        request('follower', 5)
+        leader.join()
+
+        self.assertIs(responses['leader']['ready'], False)
+        self.assertTrue(responses['follower']['shared'])
+        self.assertIs(responses['follower']['ready'], True)
+        self.assertLess(responses['follower']['elapsed'], 5)
+
+    def test_lease(self):
+        response = self.daemon.do_request({'cmd' : 'lease', 'platform_name_unique' : 'SIM[0]', 'owner' : 'job_1', 'duration' : 60})
+        self.assertEqual(response['status'], 'ok')
+        lease_id = response['result']['lease_id']
+
+        response = self.daemon.do_request({'cmd' : 'set', 'platform_name_unique' : 'SIM[0]', 'state' : 'off'})
+        self.assertEqual(response, {'status' : 'error', 'error' : 'port leased by job_1'})
+        self.assertEqual(self.sims[0].modes[0], 's')
+        response = self.daemon.do_request({'cmd' : 'lease', 'platform_name_unique' : 'SIM[0]', 'owner' : 'job_2'})
+        self.assertEqual(response['status'], 'error')
+
+        response = self.daemon.do_request({'cmd' : 'set', 'platform_name_unique' : 'SIM[0]', 'state' : 'off', 'lease_id' : lease_id})
+        self.assertEqual(response['status'], 'ok')
+        self.assertEqual(self.sims[0].modes[0], 'o')
+
+        self.assertEqual(self.daemon.do_request({'cmd' : 'release', 'lease_id' : lease_id})['status'], 'ok')
+        response = self.daemon.do_request({'cmd' : 'set', 'platform_name_unique' : 'SIM[0]', 'state' : 'on'})
+        self.assertEqual(response['status'], 'ok')
+
+    def test_set_all_leased(self):
+        response = self.daemon.do_request({'cmd' : 'lease', 'platform_name_unique' : 'SIM[0]', 'owner' : 'job_1'})
+        lease_id = response['result']['lease_id']
+
+        response = self.daemon.do_request({'cmd' : 'set_all', 'state' : 'off'})
+        self.assertEqual(response, {'status' : 'error', 'error' : "ports are leased by ['job_1']"})
+        # the holder of all the leases can set all the ports
+        response = self.daemon.do_request({'cmd' : 'set_all', 'state' : 'off', 'lease_ids' : [lease_id]})
+        self.assertEqual(response['status'], 'ok')
+        self.assertEqual(self.sims[0].modes, ['o'] * MbedCambrionix.MAX_PORTS)
+
+        response = self.daemon.do_request({'cmd' : 'lease', 'platform_name_unique' : 'SIM[13]', 'owner' : 'job_2'})
+        response = self.daemon.do_request({'cmd' : 'set_all', 'state' : 'on', 'lease_id' : lease_id})
+        self.assertEqual(response, {'status' : 'error', 'error' : "ports are leased by ['job_2']"})
+
+    def test_controller_in_process(self):
+        controller = MbedHubController([self.SUBRACK_CONFIG_FILENAME], os.path.join(self.dir_path, 'none.sock'), use_daemon=False, config_dir=self.dir_path)
+        self.addCleanup(controller.close)
+        self.assertEqual(controller.power('SIM[13]', 'off', wait=False), MbedUsbHub.ERROR_SUCCESS)
+        self.assertEqual(self.sims[1].modes[1], 'o')
+        self.assertEqual(controller.get('SIM[13]'), 'off')
+
+    def test_scheduled_power_on_returns_hub_response(self):
+        subrack = self.daemon.rack.subracks['0']
+        self.assertEqual(subrack.port_state_set('0', MbedCambrionix.MAX_PORTS, MbedUsbHub.PORT_STATE_OFF), '')
+        self.assertEqual(self.sims[0].modes, ['o'] * MbedCambrionix.MAX_PORTS)
+        # all ports on is sequenced by the power scheduler
+        self.assertIsNotNone(subrack.power_scheduler)
+        self.assertEqual(subrack.port_state_set('0', MbedCambrionix.MAX_PORTS, MbedUsbHub.PORT_STATE_ON), '')
+        self.assertEqual(self.sims[0].modes, ['s'] * MbedCambrionix.MAX_PORTS)
+
+
+class MbedCambrionixBootSimulator(MbedCambrionixSimulator):
+    """ simulator recording when each port was last switched on"""
+
+    def __init__(self, *args, **kwargs):
+        MbedCambrionixSimulator.__init__(self, *args, **kwargs)
+        self.on_times = [0.0] * self.num_ports
+
+    def cmd_mode(self, args):
+        if len(args) == 2 and args[1].isdigit() and 1 <= int(args[1]) <= self.num_ports:
+            if args[0] == 's' and self.modes[int(args[1]) - 1] != 's':
+                self.on_times[int(args[1]) - 1] = time.time()
+        return MbedCambrionixSimulator.cmd_mode(self, args)
+
+
+class MbedUsbSimCommissioner(MbedUsbCommissioner):
+    """ commissioner enumerating the targets attached to a simulated hub
+
+    The target on port num is T<num> and enumerates boot_times[num] seconds
+    after the port is switched on. OTHER is attached to another hub.
+    """
+
+    SETTLE_TIME = 0.1
+    POLL_INTERVAL = 0.02
+    DEFAULT_BOOT_WAIT = 0.5
+
+    def __init__(self, hub, sim, boot_times, target_boot_times):
+        MbedUsbCommissioner.__init__(self, hub, '0', boot_times)
+        self.sim = sim
+        self.target_boot_times = target_boot_times
+
+    def enumerate(self):
+        result = {'OTHER' : {'target_id' : 'OTHER', 'platform_name' : 'FAST'}}
+        for num in range(0, self.sim.num_ports):
+            if self.sim.modes[num] == 's' and time.time() - self.sim.on_times[num] >= self.target_boot_times[num]:
+                platform_name = 'SLOW' if self.target_boot_times[num] > self.SETTLE_TIME else 'FAST'
+                result['T%d' % num] = {'target_id' : 'T%d' % num, 'platform_name' : platform_name}
+        return result
+
+
+class MbedUsbCommissionerTest(MbedCambrionixTestCase):
+    """ tests of finding the hub port of each target"""
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir_path)
+        self.sim = MbedCambrionixBootSimulator(latency=0.002)
+        self.hub = self.open_hub(self.sim)
+
+    def test_slow_targets(self):
+        # T5 enumerates well after the set of targets has been stable for SETTLE_TIME
+        target_boot_times = [0.02] * MbedCambrionix.MAX_PORTS
+        target_boot_times[5] = 0.4
+        boot_times = MbedBootTimes(os.path.join(self.dir_path, MbedBootTimes.BOOT_TIMES_FILENAME))
+        commissioner = MbedUsbSimCommissioner(self.hub, self.sim, boot_times, target_boot_times)
+        result = commissioner.commission()
+        self.assertEqual(sorted(result), sorted(['T%d' % num for num in range(0, MbedCambrionix.MAX_PORTS)]))
+        for num in range(0, MbedCambrionix.MAX_PORTS):
+            self.assertEqual(result['T%d' % num][0], num)
+        self.assertEqual(self.sim.modes, ['s'] * MbedCambrionix.MAX_PORTS)
+
+    def test_misread_target_reported(self):
+        # T6 (code 7) is missed in the round for bit 0, as if it took longer than the boot wait
+        target_boot_times = [0.02] * MbedCambrionix.MAX_PORTS
+        boot_times = MbedBootTimes(os.path.join(self.dir_path, MbedBootTimes.BOOT_TIMES_FILENAME))
+        commissioner = MbedUsbSimCommissioner(self.hub, self.sim, boot_times, target_boot_times)
+        rounds = []
+        enumerate_settled = commissioner.enumerate_settled
+        def misreading_enumerate_settled(min_wait=0.0):
+            targets = enumerate_settled(min_wait)
+            rounds.append(min_wait)
+            if len(rounds) == 2:
+                targets.pop('T6', None)
+            return targets
+        commissioner.enumerate_settled = misreading_enumerate_settled
+        result = commissioner.commission()
+        self.assertNotIn('T6', result)
+        self.assertEqual(len(result), MbedCambrionix.MAX_PORTS - 1)
+        # round 0, a round per bit of the codes and the check round
+        self.assertEqual(len(rounds), 6)
+
+
+class MbedPowerSchedulerTest(MbedCambrionixTestCase):
+    """ tests of the sequencing of ports being powered on"""
+
+    def test_concurrency(self):
+        # without targets attached the ports only settle after settle_timeout
+        sim = MbedCambrionixSimulator(attached=[])
+        hub = self.open_hub(sim)
+        hub.port_state_set(MbedCambrionix.MAX_PORTS, MbedUsbHub.PORT_STATE_OFF)
+
+        starts = []
+        port_state_set = hub.port_state_set
+        def timed_port_state_set(num, state):
+            starts.append(time.time())
+            return port_state_set(num, state)
+        hub.port_state_set = timed_port_state_set
+
+        scheduler = MbedPowerScheduler(concurrency=3, stagger=0.0, current_limit_ma=0, settle_timeout=0.3)
+        responses = {}
+        settled = scheduler.power_on_hub(hub, range(0, MbedCambrionix.MAX_PORTS), responses=responses)
+        self.assertEqual(sorted(settled), range(0, MbedCambrionix.MAX_PORTS))
+        self.assertEqual(responses, dict([(num, '') for num in range(0, MbedCambrionix.MAX_PORTS)]))
+        self.assertEqual(sim.modes, ['s'] * MbedCambrionix.MAX_PORTS)
+
+        # no more than concurrency ports are started within a settle_timeout
+        for index in range(3, len(starts)):
+            self.assertGreaterEqual(starts[index] - starts[index - 3], 0.25)
+
+    def test_disabled(self):
+        scheduler = MbedPowerScheduler(concurrency=0)
+        self.assertFalse(scheduler.is_enabled())
+        self.assertTrue(scheduler.is_enabled({'power_concurrency' : 2}))
+        self.assertGreater(scheduler.get_hub_params()[2], 0)
+
+
+if __name__=='__main__':
+
+    unittest.main()